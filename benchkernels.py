@@ -0,0 +1,112 @@
+'''
+  File name: benchkernels.py
+  Author(s):  Jeramy Luo - entire file
+  Purpose: Compares the per-call time and results of the Numba kernels (jitkernels.py) with the NumPy code they replace.
+'''
+
+import argparse
+import time
+import numpy as np
+
+import jitkernels
+
+from ultrafastLaneDetector import UltrafastLaneDetector, ModelType
+from ultrafastLaneDetector.ultrafastLaneDetector import ModelConfig
+from visualtaskspec import vistaskspec
+from pid import pdcontroller
+from mockactuator import mockactuator
+
+def synthetic_output(cfg, rng, lanes=4):
+    # model output with four straight lanes, peaked around their grid cell on every anchor (and some anchors without points)
+
+    cells = np.arange(cfg.griding_num + 1)[:, np.newaxis, np.newaxis]
+    anchors = np.arange(cfg.cls_num_per_lane)[np.newaxis, :, np.newaxis]
+    start = np.array([0.2, 0.4, 0.6, 0.8])[:lanes]*cfg.griding_num
+    slope = np.array([-0.6, -0.2, 0.2, 0.6])[:lanes]*cfg.griding_num/cfg.cls_num_per_lane
+    center = start + slope*(cfg.cls_num_per_lane - anchors)
+    output = -(cells - center)**2/8 + rng.normal(0, 0.5, (cfg.griding_num + 1, cfg.cls_num_per_lane, lanes))
+    # the no-lane cell wins on the top anchors
+    output[-1] = np.where(anchors[0] < cfg.cls_num_per_lane//5, 10, -10)
+    return [output[np.newaxis].astype(np.float32)]
+
+def time_call(function, repeat):
+    # mean time of a call in microseconds
+    function()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        function()
+    return (time.perf_counter() - start)/repeat*1e6
+
+def benchmark(repeat=2000, seed=0):
+    # times every kernel against its NumPy code and checks that both give the same results
+
+    rng = np.random.default_rng(seed)
+    cfg = ModelConfig(ModelType.TUSIMPLE)
+    output = synthetic_output(cfg, rng)
+    detection = UltrafastLaneDetector.process_output(output, cfg)
+    vts = vistaskspec(cfg.img_w)
+    controller = pdcontroller(actuator=mockactuator(), controls=False)
+    controller.set_gains(0.002, 0.004, 2, 0.5)
+    errors = rng.normal(0, 100, 64)
+
+    def control_run():
+        # runs the controller from rest over the errors and returns its state (update_controls itself returns None)
+        controller.t = 0
+        controller.last = 0
+        controller.command_history.clear()
+        controller.j.axes.clear()
+        for err in errors:
+            controller.update_controls(err)
+        return controller_state(controller)
+
+    # (name, timed call, call whose result both paths must agree on)
+    cases = [("process_output", lambda: UltrafastLaneDetector.process_output(output, cfg), None)]
+    for mode, task in enumerate(vts.task_list):
+        cases.append((f"vistaskspec.{task}", lambda mode=mode: vts.get_error(detection, None, mode), None))
+    cases.append(("pdcontroller.update_controls", lambda: controller.update_controls(0.3), control_run))
+
+    results = []
+    for name, function, result in cases:
+        row = {"name": name}
+        for path in ["numpy", "numba"]:
+            jitkernels.enable(path == "numba")
+            row[path] = time_call(function, repeat)
+            row[path + "_result"] = (result or function)()
+        results.append(row)
+    jitkernels.enable(False)
+    return results
+
+def controller_state(controller):
+    # turn rate, derivative term, speed, last joystick axis values and the turn rates of the recent commands
+    return {
+        "t": controller.t,
+        "last": controller.last,
+        "final_speed": controller.final_speed,
+        "axes": [controller.j.axes[axis] for axis in sorted(controller.j.axes)],
+        "commands": [t for _, t in controller.command_history],
+    }
+
+def same_result(a, b):
+    # compares detections, errors and controller states
+    if isinstance(a, dict):
+        return a.keys() == b.keys() and all(np.allclose(a[key], b[key]) for key in a)
+    if hasattr(a, "points"):
+        return (np.array_equal(a.points, b.points) and np.array_equal(a.valid, b.valid) and np.array_equal(a.detected, b.detected)
+                and np.allclose(a.confidence, b.confidence))
+    if a is None or b is None:
+        return a is b
+    return bool(np.isclose(a, b))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="benchmark the Numba kernels against the NumPy code")
+    parser.add_argument("--repeat", type=int, default=2000, help="calls timed per kernel and path")
+    args = parser.parse_args()
+
+    if jitkernels.numba is None:
+        raise SystemExit("Numba is not installed, only the NumPy code is available")
+    jitkernels.warmup()
+
+    print(f"{'call':<32}{'numpy us':>10}{'numba us':>10}{'speedup':>9}{'same':>6}")
+    for row in benchmark(args.repeat):
+        same = same_result(row["numpy_result"], row["numba_result"])
+        print(f"{row['name']:<32}{row['numpy']:>10.2f}{row['numba']:>10.2f}{row['numpy']/row['numba']:>8.1f}x{str(same):>6}")
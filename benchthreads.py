@@ -0,0 +1,144 @@
+'''
+  File name: benchthreads.py
+  Author(s):  Jeramy Luo - entire file
+  Purpose: Sweeps thread budgets (onnxruntime and OpenCV threads, CPU pinning) and reports the control loop latency percentiles.
+'''
+
+import argparse
+import itertools
+import multiprocessing as mp
+import os
+import threading
+import time
+import numpy as np
+import cv2
+
+from threadbudget import threadbudget
+
+# size of the frames process_input returns (grabscreen.FRAME_SHAPE, not imported as grabscreen needs win32)
+FRAME_SHAPE = (600, 1600, 3)
+
+def available_cpus():
+    # CPUs this process may run on
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count()))
+
+def pinned_layout(intra_op, cpus):
+    # control loop on the first CPU, renderer-like background work on the next, onnxruntime pool threads on the rest
+    # (CPUs are shared when there are too few; a single intra-op thread has no pool threads to pin)
+    control = cpus[:1]
+    background = cpus[1:2] or control
+    inference = cpus[2:2 + max(1, (intra_op or len(cpus)) - 1)] or cpus[-1:]
+    if intra_op == 1:
+        inference = None
+    return inference, control, background
+
+def load_frames(recording, count, seed=0):
+    # frames of a telemetry recording made with --record-frames, or random frames
+    if recording:
+        from telemetry import telemetryreader
+        reader = telemetryreader(recording)
+        frames = [np.array(frame) for frame in map(reader.frame, range(len(reader))) if frame is not None]
+        if not frames:
+            raise ValueError(f"{recording} has no frames")
+        return frames
+    rng = np.random.default_rng(seed)
+    return [rng.integers(0, 255, FRAME_SHAPE, np.uint8) for _ in range(count)]
+
+def background_load(budget, frames, stop):
+    # renderer-like OpenCV work competing with the control loop, on the background CPUs like the renderer
+    budget.pin_background()
+    i = 0
+    while not stop.is_set():
+        frame = frames[i % len(frames)]
+        small = cv2.resize(cv2.cvtColor(frame, cv2.COLOR_RGB2BGR), (1280, 720))
+        cv2.addWeighted(small, 0.7, small, 0.3, 0)
+        i += 1
+
+def run_budget(budget, model_path, recording, frames, warmup, load_threads, results):
+    # one benchmark run in a fresh process: per-frame latency of detect_lanes, the visual task and the controller
+
+    # imported here so the library thread pools start with this process's settings
+    from ultrafastLaneDetector import UltrafastLaneDetector, model_type_from_path
+    from visualtaskspec import vistaskspec
+    from pid import pdcontroller
+    from mockactuator import mockactuator
+
+    budget.apply_opencv()
+    lane_detector = UltrafastLaneDetector(model_path, model_type_from_path(model_path), backend_options=budget.backend_options())
+    vts = vistaskspec(lane_detector.cfg.img_w)
+    controller = pdcontroller(actuator=mockactuator(), controls=False)
+    controller.set_gains(0.002, 0.004, 2, 0.5)
+    images = load_frames(recording, frames)
+
+    stop = threading.Event()
+    threads = [threading.Thread(target=background_load, args=(budget, images, stop), daemon=True) for _ in range(load_threads)]
+    for thread in threads:
+        thread.start()
+    budget.pin_control()
+
+    latencies = []
+    for i in range(warmup + frames):
+        start = time.perf_counter()
+        _, detection = lane_detector.detect_lanes(images[i % len(images)], draw=False)
+        err = vts.get_error(detection, None, 0)
+        if err is not None:
+            controller.update_controls(err)
+        if i >= warmup:
+            latencies.append(time.perf_counter() - start)
+
+    stop.set()
+    for thread in threads:
+        thread.join()
+    results.put(latencies)
+
+def measure(budget, model_path, recording=None, frames=200, warmup=20, load_threads=1):
+    # runs a budget in a spawned process and returns its latency percentiles in milliseconds
+
+    context = mp.get_context("spawn")
+    results = context.Queue()
+    process = context.Process(target=run_budget, args=(budget, model_path, recording, frames, warmup, load_threads, results))
+    process.start()
+    latencies = np.array(results.get())*1000
+    process.join()
+    return {
+        "mean": float(latencies.mean()),
+        "p50": float(np.percentile(latencies, 50)),
+        "p90": float(np.percentile(latencies, 90)),
+        "p99": float(np.percentile(latencies, 99)),
+        "max": float(latencies.max()),
+    }
+
+def parse_values(spec):
+    # comma separated thread counts, "default" for the library default
+    return [None if value == "default" else int(value) for value in spec.split(",")]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="sweep thread budgets and report control loop latency percentiles")
+    parser.add_argument("--model", default="models/tusimple.onnx")
+    parser.add_argument("--recording", help="telemetry recording with frames to run on (default: random frames)")
+    parser.add_argument("--intra-op", default="1,2,4,default", help="onnxruntime intra-op thread counts to sweep")
+    parser.add_argument("--cv-threads", default="1,default", help="OpenCV thread counts to sweep")
+    parser.add_argument("--pin", choices=["off", "on", "both"], default="both", help="run with and/or without CPU pinning")
+    parser.add_argument("--no-spin", action="store_true", help="let idle onnxruntime threads sleep instead of spinning")
+    parser.add_argument("--load-threads", type=int, default=1, help="renderer-like OpenCV threads running alongside the control loop")
+    parser.add_argument("--frames", type=int, default=200)
+    args = parser.parse_args()
+
+    cpus = available_cpus()
+    pins = {"off": [False], "on": [True], "both": [False, True]}[args.pin]
+    intra_ops = [n for n in parse_values(args.intra_op) if n is None or n <= len(cpus)]
+
+    rows = []
+    for intra_op, cv_threads, pin in itertools.product(intra_ops, parse_values(args.cv_threads), pins):
+        layout = pinned_layout(intra_op, cpus) if pin else (None, None, None)
+        budget = threadbudget(intra_op, 1, cv_threads, not args.no_spin, *layout)
+        result = measure(budget, args.model, args.recording, args.frames, load_threads=args.load_threads)
+        rows.append((budget.describe(), result))
+        print(f"{budget.describe()}: " + " ".join(f"{key} {value:.2f}" for key, value in result.items()))
+
+    print(f"\n{len(cpus)} CPUs, latency in ms, best p99 first")
+    print(f"{'p50':>8}{'p90':>8}{'p99':>8}{'max':>8}  budget")
+    for description, result in sorted(rows, key=lambda row: row[1]["p99"]):
+        print(f"{result['p50']:>8.2f}{result['p90']:>8.2f}{result['p99']:>8.2f}{result['max']:>8.2f}  {description}")
@@ -0,0 +1,109 @@
+'''
+  File name: checkallocations.py
+  Author(s):  Jeramy Luo - entire file
+  Purpose: Checks with tracemalloc that the zero-allocation control loop (--zero-alloc) stays under a per-frame allocation budget.
+'''
+
+import argparse
+import tracemalloc
+import numpy as np
+
+from collections import deque
+
+from ultrafastLaneDetector import UltrafastLaneDetector, model_type_from_path
+from visualtaskspec import vistaskspec
+from pid import pdcontroller
+from framecontext import framecontextpool
+from grabscreen import process_input, CAPTURE_SHAPE, FRAME_SHAPE
+from mockactuator import mockactuator
+from profilemodels import load_frames
+
+# columns of border process_input adds on each side of the screen region
+BORDER = (FRAME_SHAPE[1] - CAPTURE_SHAPE[1])//2
+
+class screengrab():
+    def __init__(self):
+        # grab function for process_input that copies the screen region of a frame instead of the screen
+        self.screen = None
+
+    def __call__(self, region, out=None):
+        # region rows are counted from the top of the captured region, which starts 26 rows down the screen
+        screen = self.screen[region[1] - 26:]
+        if out is None:
+            return screen.copy()
+        np.copyto(out, screen)
+        return out
+
+def measure(lane_detector, frames, contexts=None, mode=5, warmup=20, draw=True, held=2):
+    # runs the hot path of the control loop on every frame (after warm-up frames): process_input on the screen region
+    # of the frame, the detection, the visual task and the controller; returns the peak bytes allocated within each
+    # frame, as seen by tracemalloc
+    # frame contexts are handed off like to the renderer and recorder, which keep the last held ones busy
+
+    vts = vistaskspec(lane_detector.cfg.img_w)
+    controller = pdcontroller(actuator=mockactuator(), controls=False)
+    grab = screengrab()
+    screens = [frame[:, BORDER:-BORDER] for frame in frames]
+    handed_off = deque()
+
+    def tick(screen):
+        grab.screen = screen
+        context = contexts.acquire() if contexts is not None else None
+        if context is not None:
+            frame = process_input(context.frame, context.capture, context.rgb, grab=grab)
+        else:
+            frame = process_input(grab=grab)
+        output_img, detection = lane_detector.detect_lanes(frame, draw=draw, buffers=context.buffers if context is not None else None)
+        err = vts.get_error(detection, None, mode)
+        if err is not None:
+            controller.update_controls(err)
+        if context is not None:
+            if context.pooled:
+                context.hold()
+                handed_off.append(context)
+                if len(handed_off) > held:
+                    handed_off.popleft().release()
+            context.release()
+
+    for i in range(warmup):
+        tick(screens[i % len(screens)])
+
+    peaks = []
+    tracemalloc.start()
+    for screen in screens:
+        tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+        tick(screen)
+        peaks.append(tracemalloc.get_traced_memory()[1] - base)
+    tracemalloc.stop()
+
+    while handed_off:
+        handed_off.popleft().release()
+    return np.array(peaks)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="check the per-frame allocations of the zero-allocation control loop")
+    parser.add_argument("--model", default="models/tusimple.onnx", help="path of the lane detection model")
+    parser.add_argument("--recording", help="telemetry recording with frames (lanecontrol.py --record PATH --record-frames); random frames if omitted")
+    parser.add_argument("--frames", type=int, default=100)
+    parser.add_argument("--max-bytes", type=int, default=64*1024, help="largest allowed peak allocation within a frame (as in tests/test_allocations.py)")
+    args = parser.parse_args()
+
+    if args.recording:
+        frames = load_frames(args.recording, args.frames)
+    else:
+        rng = np.random.default_rng(0)
+        frames = [rng.integers(0, 256, FRAME_SHAPE, dtype=np.uint8) for _ in range(args.frames)]
+
+    lane_detector = UltrafastLaneDetector(args.model, model_type_from_path(args.model))
+
+    # reference: the allocating path, then the preallocated buffers
+    allocating = measure(lane_detector, frames)
+    preallocated = measure(lane_detector, frames, framecontextpool(lane_detector, FRAME_SHAPE, CAPTURE_SHAPE))
+
+    for name, peaks in (("allocating", allocating), ("zero-alloc", preallocated)):
+        print(f"{name:<12} peak per frame: median {np.median(peaks)/1024:.1f} KiB, max {peaks.max()/1024:.1f} KiB")
+
+    if preallocated.max() > args.max_bytes:
+        raise SystemExit(f"FAIL: zero-alloc frames allocate up to {preallocated.max()} bytes (budget {args.max_bytes})")
+    print(f"OK: zero-alloc frames stay under {args.max_bytes} bytes")
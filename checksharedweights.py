@@ -0,0 +1,62 @@
+'''
+  File name: checksharedweights.py
+  Author(s):  Jeramy Luo - entire file
+  Purpose: Measures the memory of worker processes loading a model separately and on weights shared with SharedWeights (Linux).
+'''
+
+import argparse
+import multiprocessing as mp
+import numpy as np
+
+from ultrafastLaneDetector import UltrafastLaneDetector, SharedWeights, model_type_from_path
+
+def memory():
+    # private memory (pages no other process maps) and proportional set size (shared pages split between their users), in MiB
+    fields = {}
+    with open("/proc/self/smaps_rollup") as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) >= 2 and parts[1].isdigit():
+                fields[parts[0].rstrip(":")] = int(parts[1])
+    return {"private": (fields["Private_Clean"] + fields["Private_Dirty"])/1024, "pss": fields["Pss"]/1024}
+
+def worker(model_path, shared, prepack, loaded, results):
+    # loads the model, runs it once and measures once every worker has done the same
+
+    if shared is not None:
+        lane_detector = shared.detector(prepack=prepack)
+    else:
+        lane_detector = UltrafastLaneDetector(model_path, model_type_from_path(model_path))
+    lane_detector.detect_lanes(np.zeros((600, 1600, 3), np.uint8), draw=False)
+    loaded.wait()
+    results.put(memory())
+    loaded.wait()
+
+def measure(model_path, workers, mode):
+    # memory of each of workers forked processes for mode "separate", "shared" or "shared-prepack"
+
+    shared = SharedWeights(model_path) if mode != "separate" else None
+    loaded = mp.Barrier(workers)
+    results = mp.Queue()
+    processes = [mp.Process(target=worker, args=(model_path, shared, mode == "shared-prepack", loaded, results)) for _ in range(workers)]
+    for process in processes:
+        process.start()
+    stats = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+    return stats
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="compare the memory of workers with separate and shared model weights")
+    parser.add_argument("--model", default="models/tusimple.onnx")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--modes", default="separate,shared,shared-prepack")
+    args = parser.parse_args()
+
+    mp.set_start_method("fork")
+    print(f"{'mode':<16}{'private/worker':>16}{'pss/worker':>12}{'pss total':>12}  (MiB)")
+    for mode in args.modes.split(","):
+        stats = measure(args.model, args.workers, mode)
+        private = np.mean([s["private"] for s in stats])
+        pss = [s["pss"] for s in stats]
+        print(f"{mode:<16}{private:>16.1f}{np.mean(pss):>12.1f}{np.sum(pss):>12.1f}")
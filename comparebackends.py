@@ -0,0 +1,79 @@
+'''
+  File name: comparebackends.py
+  Author(s):  Jeramy Luo - entire file
+  Purpose: Compares the latency and numeric agreement of the inference backends (onnxruntime, OpenCV DNN, PyTorch).
+'''
+
+import argparse
+import time
+import numpy as np
+
+from ultrafastLaneDetector import UltrafastLaneDetector, ModelType, model_type_from_path
+from profilemodels import load_frames
+
+def run_backend(lane_detector, frames, warmup=5):
+    # returns the raw outputs, detections and inference times (ms) of a detector on the frames
+
+    for frame in frames[:warmup]:
+        lane_detector.inference(lane_detector.prepare_input(frame))
+
+    outputs, detections, times = [], [], []
+    for frame in frames:
+        input_tensor = lane_detector.prepare_input(frame)
+        start = time.perf_counter()
+        output = lane_detector.inference(input_tensor)
+        times.append((time.perf_counter() - start)*1000)
+        outputs.append(output[0])
+        detections.append(lane_detector.process_output(output, lane_detector.cfg))
+    return outputs, detections, np.array(times)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="compare the inference backends of UltrafastLaneDetector")
+    parser.add_argument("--model", default="models/tusimple.onnx", help=".onnx model for the onnxruntime and opencv backends")
+    parser.add_argument("--weights", help=".pth checkpoint for the torch backends (the same weights as --model)")
+    parser.add_argument("--backbone", default="18", help="backbone of the checkpoint")
+    parser.add_argument("--model-type", choices=["tusimple", "culane"], help="model type; guessed from the model file name if not given")
+    parser.add_argument("--recording", help="telemetry recording with frames; random frames if omitted")
+    parser.add_argument("--max-frames", type=int, default=100)
+    parser.add_argument("--threads", type=int, help="number of PyTorch threads")
+    args = parser.parse_args()
+
+    model_type = ModelType[args.model_type.upper()] if args.model_type else model_type_from_path(args.model)
+    if args.recording:
+        frames = load_frames(args.recording, args.max_frames)
+    else:
+        rng = np.random.default_rng(0)
+        frames = [rng.integers(0, 256, (600, 1600, 3), dtype=np.uint8) for _ in range(args.max_frames)]
+
+    # (name, model path, backend, backend options)
+    candidates = [
+        ("onnxruntime", args.model, "onnxruntime", {}),
+        ("opencv", args.model, "opencv", {}),
+    ]
+    if args.weights:
+        torch_options = {"backbone": args.backbone, "num_threads": args.threads}
+        candidates += [
+            ("torch", args.weights, "torch", dict(torch_options, channels_last=False)),
+            ("torch channels_last", args.weights, "torch", dict(torch_options, channels_last=True)),
+            ("torchscript channels_last", args.weights, "torch", dict(torch_options, channels_last=True, torchscript=True)),
+        ]
+
+    reference = None
+    print(f"{len(frames)} frames\n")
+    print(f"{'backend':<28}{'mean ms':>9}{'p50 ms':>9}{'p95 ms':>9}{'max |diff|':>12}{'points equal':>14}{'detected equal':>16}")
+    for name, path, backend, options in candidates:
+        try:
+            lane_detector = UltrafastLaneDetector(path, model_type, backend=backend, backend_options=options)
+            outputs, detections, times = run_backend(lane_detector, frames)
+        except Exception as e:
+            print(f"{name:<28}failed: {e}")
+            continue
+
+        if reference is None:
+            # the first backend (onnxruntime) is the reference for the agreement columns
+            reference = (outputs, detections)
+
+        diff = max(float(np.max(np.abs(o - r))) for o, r in zip(outputs, reference[0])) if outputs[0].shape == reference[0][0].shape else float("nan")
+        points_equal = np.mean([np.mean((d.points == r.points)[r.valid | d.valid]) if (r.valid | d.valid).any() else 1.0 for d, r in zip(detections, reference[1])])
+        detected_equal = np.mean([np.array_equal(d.detected, r.detected) for d, r in zip(detections, reference[1])])
+        print(f"{name:<28}{times.mean():>9.2f}{np.percentile(times, 50):>9.2f}{np.percentile(times, 95):>9.2f}{diff:>12.2e}{points_equal:>14.1%}{detected_equal:>16.1%}")
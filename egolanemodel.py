@@ -0,0 +1,103 @@
+'''
+  File name: egolanemodel.py
+  Author(s):  Jeramy Luo - entire file
+  Purpose: Slices a lane detection ONNX model down to the two ego lanes (lanes 1 and 2) used by the visual tasks.
+'''
+
+import argparse
+import numpy as np
+import onnx
+
+from onnx import numpy_helper
+
+# lanes kept in the ego-lane model, in the order they are output
+EGO_LANES = [1, 2]
+
+def find_producer(graph, name):
+    # returns the node producing the tensor name
+    for node in graph.node:
+        if name in node.output:
+            return node
+    raise ValueError(f"no node produces {name}")
+
+def get_constant(graph, name):
+    # returns the value of an initializer or Constant node output
+    for init in graph.initializer:
+        if init.name == name:
+            return numpy_helper.to_array(init)
+    for node in graph.node:
+        if node.op_type == "Constant" and name in node.output:
+            return numpy_helper.to_array(node.attribute[0].t)
+    raise ValueError(f"{name} is not a constant")
+
+def set_constant(graph, name, value):
+    # stores value under a new initializer name and returns it, leaving other users of the old tensor untouched
+    new_name = name + "_ego"
+    graph.initializer.append(numpy_helper.from_array(value, new_name))
+    return new_name
+
+def slice_ego_lanes(model):
+    # keeps only the ego lane outputs of the final linear layer and updates the output reshape
+
+    graph = model.graph
+    output = graph.output[0]
+    dims = [d.dim_value if d.HasField("dim_value") else -1 for d in output.type.tensor_type.shape.dim]
+    griding, anchors, lanes = dims[1:]
+    if lanes != 4:
+        raise ValueError(f"expected a model with 4 lanes, got {lanes}")
+
+    # output indices of the ego lanes in the flattened (griding+1, anchors, lanes) logits
+    keep = np.arange(griding*anchors*lanes).reshape(griding, anchors, lanes)[:, :, EGO_LANES].ravel()
+
+    # Reshape(linear, shape) -> output
+    reshape = find_producer(graph, output.name)
+    if reshape.op_type != "Reshape":
+        raise ValueError(f"expected the output to come from a Reshape, got {reshape.op_type}")
+    shape = get_constant(graph, reshape.input[1]).copy()
+    shape[-1] = len(EGO_LANES)
+    reshape.input[1] = set_constant(graph, reshape.input[1], shape)
+
+    # final linear layer: Gemm, or MatMul optionally followed by Add
+    linear = find_producer(graph, reshape.input[0])
+    if linear.op_type == "Add":
+        bias_idx = 1 if any(init.name == linear.input[1] for init in graph.initializer) else 0
+        bias = get_constant(graph, linear.input[bias_idx])
+        linear.input[bias_idx] = set_constant(graph, linear.input[bias_idx], bias[..., keep])
+        linear = find_producer(graph, linear.input[1 - bias_idx])
+
+    if linear.op_type == "Gemm":
+        trans_b = next((a.i for a in linear.attribute if a.name == "transB"), 0)
+        weight = get_constant(graph, linear.input[1])
+        weight = weight[keep] if trans_b else weight[:, keep]
+        linear.input[1] = set_constant(graph, linear.input[1], np.ascontiguousarray(weight))
+        if len(linear.input) > 2 and linear.input[2]:
+            bias = get_constant(graph, linear.input[2])
+            linear.input[2] = set_constant(graph, linear.input[2], bias[..., keep])
+    elif linear.op_type == "MatMul":
+        weight = get_constant(graph, linear.input[1])
+        linear.input[1] = set_constant(graph, linear.input[1], np.ascontiguousarray(weight[:, keep]))
+    else:
+        raise ValueError(f"expected the final layer to be Gemm or MatMul, got {linear.op_type}")
+
+    # updating the declared output shape and dropping stale shape information
+    output.type.tensor_type.shape.dim[3].dim_value = len(EGO_LANES)
+    del graph.value_info[:]
+
+    # removing initializers that are no longer used
+    used = {name for node in graph.node for name in node.input}
+    kept = [init for init in graph.initializer if init.name in used]
+    del graph.initializer[:]
+    graph.initializer.extend(kept)
+
+    onnx.checker.check_model(model)
+    return model
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="slice a lane detection model down to the ego lanes")
+    parser.add_argument("model", help="input .onnx model (4 lanes)")
+    parser.add_argument("output", help="output .onnx model (ego lanes only)")
+    args = parser.parse_args()
+
+    model = slice_ego_lanes(onnx.load(args.model))
+    onnx.save(model, args.output)
+    print(f"saved {args.output}")
@@ -0,0 +1,176 @@
+'''
+  File name: evaltusimple.py
+  Author(s):  Jeramy Luo - entire file
+  Purpose: Evaluates the lane detection accuracy, false positives and false negatives of a model on a TuSimple-format dataset.
+'''
+
+import argparse
+import json
+import multiprocessing as mp
+import os
+import numpy as np
+import cv2
+
+from collections import defaultdict
+from ultrafastLaneDetector import UltrafastLaneDetector, SharedWeights, model_type_from_path
+
+# TuSimple benchmark thresholds: largest x distance (px, before the angle correction) of a matching point
+# and smallest fraction of matching points for a lane to count as detected
+PIXEL_THRESH = 20
+PT_THRESH = 0.85
+
+def load_labels(paths):
+    # reads TuSimple label files (one JSON object with lanes, h_samples and raw_file per line)
+
+    labels = []
+    for path in paths:
+        with open(path) as f:
+            labels.extend(json.loads(line) for line in f if line.strip())
+    return labels
+
+def anchor_indices(cfg, h_samples):
+    # index into the (bottom to top) detection anchors of each label row; the TuSimple row anchors are its h_samples
+
+    anchor_y = cfg.img_h*np.asarray(cfg.row_anchor[::-1])/288
+    idx = np.abs(anchor_y[np.newaxis, :] - np.asarray(h_samples)[:, np.newaxis]).argmin(axis=1)
+    if np.abs(anchor_y[idx] - h_samples).max() > 1:
+        raise ValueError("The label h_samples do not match the row anchors of the model")
+    return idx
+
+def detected_lanes(detection, idx):
+    # x coordinates of the detected lanes at the label rows, -2 where a lane has no point
+
+    lanes = np.flatnonzero(detection.detected)
+    x = detection.points[lanes][:, idx, 0].astype(np.float64)
+    x[~detection.valid[lanes][:, idx]] = -2
+    return x
+
+def lane_angles(gt, h_samples):
+    # angle of a least squares line x(y) through the labelled points of each lane (0 for lanes with fewer than 2 points)
+
+    valid = gt >= 0
+    n = valid.sum(axis=1)
+    y = np.broadcast_to(np.asarray(h_samples, np.float64), gt.shape)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        y_mean = np.where(valid, y, 0).sum(axis=1)/n
+        x_mean = np.where(valid, gt, 0).sum(axis=1)/n
+        dy = np.where(valid, y - y_mean[:, np.newaxis], 0)
+        dx = np.where(valid, gt - x_mean[:, np.newaxis], 0)
+        slope = (dy*dx).sum(axis=1)/(dy*dy).sum(axis=1)
+    return np.where(n > 1, np.arctan(np.nan_to_num(slope)), 0)
+
+def score(pred, gt, h_samples):
+    # TuSimple accuracy, FP and FN of one image; pred and gt are (lanes, h_samples) x coordinates, negative where missing
+    # all predicted/labelled lane pairs are compared at once
+
+    num_pred, num_gt = len(pred), len(gt)
+    if num_gt + 2 < num_pred:
+        return 0., 0., 1.
+
+    thresh = PIXEL_THRESH/np.cos(lane_angles(gt, h_samples))
+
+    # missing points are moved to -100 (a point missing from both counts as a match, as in the benchmark)
+    pred = np.where(pred >= 0, pred, -100)
+    gt = np.where(gt >= 0, gt, -100)
+    hits = np.abs(pred[np.newaxis, :, :] - gt[:, np.newaxis, :]) < thresh[:, np.newaxis, np.newaxis]
+    line_accs = hits.mean(axis=2).max(axis=1) if num_pred else np.zeros(num_gt)
+
+    matched = np.sum(line_accs >= PT_THRESH)
+    fn = num_gt - matched
+    fp = num_pred - matched
+    # images with 5 labelled lanes are scored on their best 4
+    if num_gt > 4 and fn > 0:
+        fn -= 1
+    accuracy = line_accs.sum()
+    if num_gt > 4:
+        accuracy -= line_accs.min()
+
+    return accuracy/max(min(4.0, num_gt), 1.), fp/num_pred if num_pred else 0., fn/max(min(num_gt, 4.), 1.)
+
+# detector of a worker process
+worker_detector = None
+
+def init_worker(model_path, threads, shared=None):
+    # creates the detector of a worker process, with the onnxruntime threads split between the workers
+    # (on the weights mapped by the parent if shared is given)
+    global worker_detector
+
+    import onnxruntime
+    options = onnxruntime.SessionOptions()
+    options.intra_op_num_threads = threads
+    options.inter_op_num_threads = 1
+    if shared is not None:
+        worker_detector = shared.detector(session_options=options)
+    else:
+        worker_detector = UltrafastLaneDetector(model_path, model_type_from_path(model_path), backend_options={"session_options": options})
+
+def evaluate_batch(args):
+    # detects the lanes of a batch of labelled images and scores them
+
+    root, labels = args
+    images = [cv2.imread(os.path.join(root, label["raw_file"])) for label in labels]
+    missing = [label["raw_file"] for label, image in zip(labels, images) if image is None]
+    if missing:
+        raise FileNotFoundError(f"Could not read {missing[0]} in {root}")
+
+    results = []
+    for label, detection in zip(labels, worker_detector.detect_lanes_batch(images)):
+        idx = anchor_indices(worker_detector.cfg, label["h_samples"])
+        pred = detected_lanes(detection, idx)
+        gt = np.asarray(label["lanes"], np.float64).reshape(-1, len(label["h_samples"]))
+        accuracy, fp, fn = score(pred, gt, label["h_samples"])
+        results.append({"raw_file": label["raw_file"], "accuracy": accuracy, "fp": fp, "fn": fn})
+    return results
+
+def evaluate(model_path, root, labels, workers=None, batch=8, share_weights=False):
+    # scores every labelled image, spreading the batches over the worker processes; returns the per-image results
+    # with share_weights the weights are mapped once here and the workers' sessions use the same pages
+
+    workers = workers or os.cpu_count()
+    threads = max(1, os.cpu_count()//workers)
+    batches = [(root, labels[i:i+batch]) for i in range(0, len(labels), batch)]
+    shared = SharedWeights(model_path) if share_weights else None
+
+    with mp.Pool(workers, init_worker, (model_path, threads, shared)) as pool:
+        results = []
+        for batch_results in pool.imap_unordered(evaluate_batch, batches):
+            results.extend(batch_results)
+    return results
+
+def clip_name(raw_file):
+    # clip set of an image, e.g. clips/0530 for clips/0530/1492626760788443246_0/20.jpg
+    return "/".join(raw_file.split("/")[:2])
+
+def report(results):
+    # prints the mean accuracy, FP and FN per clip set and over the whole dataset
+
+    clips = defaultdict(list)
+    for result in results:
+        clips[clip_name(result["raw_file"])].append(result)
+
+    print(f"{'clip':<20}{'images':>8}{'accuracy':>10}{'FP':>8}{'FN':>8}")
+    for name, clip_results in sorted(clips.items()) + [("all", results)]:
+        mean = lambda key: np.mean([result[key] for result in clip_results])
+        print(f"{name:<20}{len(clip_results):>8}{mean('accuracy'):>10.2%}{mean('fp'):>8.4f}{mean('fn'):>8.4f}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="evaluate a lane detection model on a TuSimple-format dataset")
+    parser.add_argument("root", help="dataset directory the raw_file paths of the labels are relative to")
+    parser.add_argument("--labels", nargs="+", default=["test_label.json"], help="label files, relative to the dataset directory")
+    parser.add_argument("--model", default="models/tusimple.onnx", help="path of the lane detection model (TuSimple type)")
+    parser.add_argument("--workers", type=int, help="number of worker processes (default: one per core)")
+    parser.add_argument("--batch", type=int, default=8, help="images per detect_lanes_batch call")
+    parser.add_argument("--share-weights", action="store_true", help="map the model weights once and share them between the workers")
+    parser.add_argument("--limit", type=int, help="only evaluate the first N labelled images")
+    parser.add_argument("--output", metavar="PATH", help="write the per-image results as JSON lines")
+    args = parser.parse_args()
+
+    labels = load_labels([os.path.join(args.root, path) for path in args.labels])[:args.limit]
+    results = evaluate(args.model, args.root, labels, args.workers, args.batch, args.share_weights)
+    results.sort(key=lambda result: result["raw_file"])
+
+    report(results)
+    if args.output:
+        with open(args.output, "w") as f:
+            for result in results:
+                f.write(json.dumps(result) + "\n")
@@ -0,0 +1,117 @@
+'''
+  File name: exportonnx.py
+  Author(s):  Jeramy Luo - entire file
+  Purpose: Exports parsingNet to ONNX with a dynamic batch axis, folded BatchNorms and no auxiliary segmentation branch.
+'''
+
+import argparse
+import copy
+import inspect
+import os
+import tempfile
+import numpy as np
+import onnxruntime
+import torch
+
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+
+from ultrafastLaneDetector.backends import build_parsingnet
+from ultrafastLaneDetector.ultrafastLaneDetector import ModelConfig, ModelType
+
+# backbones accepted by ultrafastLaneDetector.backbone.resnet
+BACKBONES = ["18", "34", "50", "101", "152", "50next", "101next", "50wide", "101wide"]
+
+# onnxruntime offline optimization levels (all would add hardware-specific nodes to the saved model, and extended adds
+# com.microsoft fused operators that only onnxruntime can read)
+OPT_LEVELS = {
+    "basic": onnxruntime.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+    "extended": onnxruntime.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+}
+
+def build_model(backbone, model_type, weights=None):
+    # builds parsingNet for the model type without the auxiliary segmentation branch and loads the weights
+    return build_parsingnet(backbone, ModelConfig(model_type), weights)
+
+def fold_batchnorms(module):
+    # folds every BatchNorm2d that directly follows a Conv2d into the convolution; covers conv_bn_relu (conv/bn),
+    # the resnet stem and blocks (convN/bnN) and downsample branches (Sequential(conv, bn))
+
+    folded = 0
+    for parent in list(module.modules()):
+        # conv/bn and convN/bnN attribute pairs
+        for name, child in list(parent.named_children()):
+            if isinstance(child, torch.nn.Conv2d):
+                bn_name = "bn" + name[len("conv"):] if name.startswith("conv") else None
+                bn = getattr(parent, bn_name, None) if bn_name else None
+                if isinstance(bn, torch.nn.BatchNorm2d):
+                    setattr(parent, name, fuse_conv_bn_eval(child, bn))
+                    setattr(parent, bn_name, torch.nn.Identity())
+                    folded += 1
+
+        # Sequential(conv, bn, ...) containers
+        if isinstance(parent, torch.nn.Sequential):
+            for i in range(len(parent) - 1):
+                if isinstance(parent[i], torch.nn.Conv2d) and isinstance(parent[i + 1], torch.nn.BatchNorm2d):
+                    parent[i] = fuse_conv_bn_eval(parent[i], parent[i + 1])
+                    parent[i + 1] = torch.nn.Identity()
+                    folded += 1
+    return folded
+
+def export(net, path, opset=13, size=(288, 800)):
+    # exports the network to ONNX with a dynamic batch axis
+
+    dummy = torch.zeros(1, 3, *size)
+
+    # newer PyTorch versions default to the dynamo exporter; the TorchScript exporter handles dynamic_axes directly
+    kwargs = {"dynamo": False} if "dynamo" in inspect.signature(torch.onnx.export).parameters else {}
+    torch.onnx.export(net, dummy, path, input_names=["input"], output_names=["output"],
+                      dynamic_axes={"input": {0: "batch"}, "output": {0: "batch"}},
+                      opset_version=opset, do_constant_folding=True, **kwargs)
+
+def optimize(path, output_path, level="basic"):
+    # runs the onnxruntime graph optimizations offline and saves the optimized model
+
+    options = onnxruntime.SessionOptions()
+    options.graph_optimization_level = OPT_LEVELS[level]
+    options.optimized_model_filepath = output_path
+    onnxruntime.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+
+def verify(net, path, batch=2, size=(288, 800), atol=1e-3):
+    # compares the ONNX model against the PyTorch network on random input; returns the largest absolute difference
+
+    x = torch.randn(batch, 3, *size)
+    with torch.no_grad():
+        expected = net(x).numpy()
+
+    session = onnxruntime.InferenceSession(path, providers=["CPUExecutionProvider"])
+    output = session.run(None, {session.get_inputs()[0].name: x.numpy()})[0]
+
+    diff = float(np.max(np.abs(output - expected)))
+    if output.shape != expected.shape or diff > atol:
+        raise RuntimeError(f"{path} does not match the PyTorch model (shape {output.shape} vs {expected.shape}, max diff {diff:.2e})")
+    return diff
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="export parsingNet to ONNX")
+    parser.add_argument("--backbone", choices=BACKBONES, default="18")
+    parser.add_argument("--model-type", choices=["tusimple", "culane"], default="tusimple")
+    parser.add_argument("--weights", help="Ultra-Fast-Lane-Detection checkpoint (.pth); random weights if omitted")
+    parser.add_argument("--output", required=True, help="path of the exported .onnx model")
+    parser.add_argument("--opset", type=int, default=13)
+    parser.add_argument("--optimize", choices=list(OPT_LEVELS), default="basic", help="onnxruntime offline optimization level (extended models only run on onnxruntime)")
+    parser.add_argument("--atol", type=float, default=1e-3, help="largest allowed difference to the PyTorch output")
+    args = parser.parse_args()
+
+    net = build_model(args.backbone, ModelType[args.model_type.upper()], args.weights)
+    reference = copy.deepcopy(net)
+    with torch.no_grad():
+        folded = fold_batchnorms(net)
+    print(f"folded {folded} BatchNorm layers")
+
+    # exporting, optimizing and checking the result against the unfolded network
+    with tempfile.TemporaryDirectory() as tmp:
+        raw_path = os.path.join(tmp, "raw.onnx")
+        export(net, raw_path, args.opset)
+        optimize(raw_path, args.output, args.optimize)
+    diff = verify(reference, args.output, atol=args.atol)
+    print(f"saved {args.output} (max difference to PyTorch {diff:.2e})")
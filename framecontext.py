@@ -0,0 +1,61 @@
+'''
+  File name: framecontext.py
+  Author(s):  Jeramy Luo - entire file
+  Purpose: Preallocated per-frame buffers of the control loop, so the steady-state hot path allocates no new arrays.
+'''
+
+import threading
+import numpy as np
+
+class framecontext():
+    def __init__(self, lane_detector, shape, capture_shape=None):
+        # process_input buffers (see grabscreen.py): the bordered frame (FRAME_SHAPE) and,
+        # given the CAPTURE_SHAPE, the screenshot before and after colour conversion
+        self.frame = np.zeros(shape, np.uint8)
+        self.capture = np.zeros(capture_shape, np.uint8) if capture_shape is not None else None
+        self.rgb = np.zeros(capture_shape, np.uint8) if capture_shape is not None else None
+
+        # detect_lanes buffers, including the detection and the visualization image
+        self.buffers = lane_detector.allocate_buffers(shape)
+
+        # number of holders (control loop, renderer, recorder) still using the buffers
+        self.users = 0
+        # False for the scratch context of a pool, which may not be handed off
+        self.pooled = True
+        self.lock = threading.Lock()
+
+    def hold(self):
+        # marks the buffers as in use until the matching release
+        with self.lock:
+            self.users += 1
+
+    def release(self):
+        with self.lock:
+            self.users -= 1
+
+class framecontextpool():
+    def __init__(self, lane_detector, shape, capture_shape=None, size=4):
+        # the control loop fills one context while the renderer and recorder may still hold older ones
+        self.lane_detector = lane_detector
+        self.shape = shape
+        self.capture_shape = capture_shape
+        self.contexts = [framecontext(lane_detector, shape, capture_shape) for _ in range(size)]
+
+        # context of the frames that find every pooled context held; it is never handed to the renderer or
+        # recorder, so the pool stays at size contexts however far behind they fall
+        self.scratch = framecontext(lane_detector, shape, capture_shape)
+        self.scratch.pooled = False
+        self.exhausted = 0
+
+    def acquire(self):
+        # returns a held context that no one else is using, or the scratch context if all are busy
+        # (only the control loop acquires, so a context seen unused stays unused)
+
+        for context in self.contexts:
+            if context.users == 0:
+                context.hold()
+                return context
+
+        self.exhausted += 1
+        self.scratch.hold()
+        return self.scratch
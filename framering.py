@@ -0,0 +1,171 @@
+'''
+  File name: framering.py
+  Author(s):  Jeramy Luo - entire file
+  Purpose: Contains the shared-memory frame ring buffer and the capture process that fills it.
+'''
+
+import multiprocessing as mp
+import time
+import numpy as np
+
+from multiprocessing import shared_memory
+
+# header fields of the ring
+WRITE_SEQ = 0
+LATEST = 1
+READ_SLOT = 2
+HEADER_SIZE = 4
+
+class framering():
+    def __init__(self, shape, slots=4, name=None, create=True, lock=None):
+        # a fixed number of frame slots in one shared memory block; the writer fills the slots in turn, skipping the
+        # slot the reader holds, so the reader can use the newest frame in place without it being overwritten.
+        # The hand-off of a slot goes through a lock shared by both sides (the side opening an existing ring is given
+        # the lock of the side that created it): the header and sequence numbers are plain shared memory, so without
+        # the fences of the lock either side could act on stale values of the other's
+
+        if slots < 3:
+            raise ValueError("framering needs at least 3 slots")
+
+        self.shape = tuple(shape)
+        self.slots = slots
+        frame_size = int(np.prod(self.shape))
+        size = 8*HEADER_SIZE + 8*slots + 8*slots + frame_size*slots
+
+        self.shm = shared_memory.SharedMemory(name=name, create=create, size=size)
+        self.name = self.shm.name
+        self.owner = create
+        self.lock = lock if lock is not None else mp.Lock()
+
+        # header, per-slot sequence numbers and capture timestamps, and the frames themselves
+        buf = self.shm.buf
+        self.header = np.ndarray((HEADER_SIZE,), np.int64, buf, 0)
+        self.seq = np.ndarray((slots,), np.int64, buf, 8*HEADER_SIZE)
+        self.timestamps = np.ndarray((slots,), np.float64, buf, 8*HEADER_SIZE + 8*slots)
+        self.frames = np.ndarray((slots,) + self.shape, np.uint8, buf, 8*HEADER_SIZE + 16*slots)
+
+        if create:
+            self.header[:] = 0
+            self.header[LATEST] = -1
+            self.header[READ_SLOT] = -1
+            self.seq[:] = 0
+
+        # writer state
+        self.write_slot = -1
+
+        # reader state and statistics
+        self.last_seq = 0
+        self.reads = 0
+        self.dropped = 0
+        self.waits = 0
+        self.age_sum = 0
+        self.age_max = 0
+
+    def begin_write(self):
+        # picks the slot for the next frame and returns it; the frame is written to self.frames[slot]
+
+        slot = (self.write_slot + 1) % self.slots
+        with self.lock:
+            # moving past the slot the reader holds and marking the slot as being written
+            if slot == self.header[READ_SLOT]:
+                slot = (slot + 1) % self.slots
+            self.seq[slot] = -1
+        self.write_slot = slot
+        return slot
+
+    def end_write(self, slot, timestamp):
+        # publishes the frame written to slot as the newest frame
+
+        with self.lock:
+            seq = self.header[WRITE_SEQ] + 1
+            self.timestamps[slot] = timestamp
+            self.seq[slot] = seq
+            self.header[LATEST] = slot
+            self.header[WRITE_SEQ] = seq
+
+    def read(self, timeout=1.0):
+        # returns a view of the newest frame and its capture timestamp (time.perf_counter), waiting for a frame newer
+        # than the last one read; the view stays valid until the next read. Returns (None, None) on timeout
+
+        deadline = time.perf_counter() + timeout
+        waited = False
+        while True:
+            with self.lock:
+                # holding the newest slot; the writer skips it from now on
+                slot = int(self.header[LATEST])
+                if slot >= 0:
+                    self.header[READ_SLOT] = slot
+                    seq = int(self.seq[slot])
+            if slot >= 0 and seq > self.last_seq:
+                break
+            if time.perf_counter() > deadline:
+                return None, None
+            waited = True
+            time.sleep(0.0005)
+
+        # updating statistics
+        self.waits += waited
+        if self.last_seq > 0:
+            self.dropped += seq - self.last_seq - 1
+        self.last_seq = seq
+        self.reads += 1
+        age = time.perf_counter() - self.timestamps[slot]
+        self.age_sum += age
+        self.age_max = max(self.age_max, age)
+
+        return self.frames[slot], float(self.timestamps[slot])
+
+    def stats(self):
+        # returns the ring statistics: frames written and read, frames never read (dropped), reads that had to wait
+        # for a new frame (reader faster than capture), and the age of the frames when read
+        return {
+            "written": int(self.header[WRITE_SEQ]),
+            "read": self.reads,
+            "dropped": self.dropped,
+            "waits": self.waits,
+            "age_mean_ms": 1000*float(self.age_sum)/max(self.reads, 1),
+            "age_max_ms": 1000*float(self.age_max),
+        }
+
+    def close(self):
+        # releases the shared memory (and removes it if this side created it)
+
+        del self.header, self.seq, self.timestamps, self.frames
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+def capture_loop(name, shape, slots, lock, source, stop):
+    # body of the capture process: writes frames from source into the ring until stop is set
+
+    ring = framering(shape, slots, name=name, create=False, lock=lock)
+    try:
+        while not stop.is_set():
+            timestamp = time.perf_counter()
+            slot = ring.begin_write()
+            source(out=ring.frames[slot])
+            ring.end_write(slot, timestamp)
+    finally:
+        ring.close()
+
+class captureprocess():
+    def __init__(self, source, shape, slots=4):
+        # starts a process that captures frames with source(out=...) into a shared ring buffer
+
+        self.ring = framering(shape, slots)
+        self.stop = mp.Event()
+        self.process = mp.Process(target=capture_loop, args=(self.ring.name, shape, slots, self.ring.lock, source, self.stop), daemon=True)
+        self.process.start()
+
+    def read(self, timeout=1.0):
+        # returns the newest frame (in place, no copy) and its capture timestamp
+        return self.ring.read(timeout)
+
+    def stats(self):
+        return self.ring.stats()
+
+    def close(self):
+        # stops the capture process and frees the ring
+        self.stop.set()
+        self.process.join()
+        self.ring.close()
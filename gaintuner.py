@@ -0,0 +1,169 @@
+'''
+  File name: gaintuner.py
+  Author(s):  Jeramy Luo - entire file
+  Purpose: Tunes the pdcontroller gains of every visual task with CMA-ES on the closed-loop lane simulator and writes gain profiles.
+'''
+
+import argparse
+import json
+import multiprocessing as mp
+import os
+import time
+import numpy as np
+
+import pid
+
+from lanesim import lanescenario, simulate
+from visualtaskspec import vistaskspec
+
+# searched gains as (name, trackbar, scale): the search runs over the trackbar positions (0-100), which are
+# rounded at the end so the control panel can show the tuned gains exactly
+GAINS = [("kp", "turn_kp", pid.KP_SCALE), ("kd", "turn_kd", pid.KD_SCALE), ("skp", "s_kp", pid.SKP_SCALE)]
+TRACKBAR_MAX = 100
+
+class cmaes():
+    def __init__(self, mean, sigma, popsize=None, seed=0):
+        # (mu/mu_w, lambda)-CMA-ES with rank-one and rank-mu covariance updates (Hansen's tutorial defaults)
+        n = len(mean)
+        self.n = n
+        self.mean = np.array(mean, np.float64)
+        self.sigma = sigma
+        self.popsize = popsize or 4 + int(3*np.log(n))
+        self.mu = self.popsize//2
+        self.rng = np.random.default_rng(seed)
+
+        # recombination weights
+        weights = np.log(self.mu + 1/2) - np.log(np.arange(1, self.mu + 1))
+        self.weights = weights/weights.sum()
+        self.mueff = 1/np.sum(self.weights**2)
+
+        # adaptation rates and step size damping
+        self.cc = (4 + self.mueff/n)/(n + 4 + 2*self.mueff/n)
+        self.cs = (self.mueff + 2)/(n + self.mueff + 5)
+        self.c1 = 2/((n + 1.3)**2 + self.mueff)
+        self.cmu = min(1 - self.c1, 2*(self.mueff - 2 + 1/self.mueff)/((n + 2)**2 + self.mueff))
+        self.damps = 1 + 2*max(0, np.sqrt((self.mueff - 1)/(n + 1)) - 1) + self.cs
+        self.chi_n = np.sqrt(n)*(1 - 1/(4*n) + 1/(21*n**2))
+
+        # evolution paths and covariance matrix C = B diag(D^2) B^T
+        self.pc = np.zeros(n)
+        self.ps = np.zeros(n)
+        self.B = np.eye(n)
+        self.D = np.ones(n)
+        self.C = np.eye(n)
+        self.generation = 0
+
+    def ask(self):
+        # samples a generation of candidates, (popsize, n)
+        z = self.rng.standard_normal((self.popsize, self.n))
+        return self.mean + self.sigma*(z*self.D) @ self.B.T
+
+    def tell(self, candidates, costs):
+        # updates the distribution from the costs of the candidates of ask()
+
+        order = np.argsort(costs)
+        selected = (candidates[order[:self.mu]] - self.mean)/self.sigma
+        step = self.weights @ selected
+        self.mean = self.mean + self.sigma*step
+        self.generation += 1
+
+        # step size path (in the whitened coordinates) and covariance path
+        c_invsqrt = self.B @ np.diag(1/self.D) @ self.B.T
+        self.ps = (1 - self.cs)*self.ps + np.sqrt(self.cs*(2 - self.cs)*self.mueff)*(c_invsqrt @ step)
+        hsig = np.linalg.norm(self.ps)/np.sqrt(1 - (1 - self.cs)**(2*self.generation))/self.chi_n < 1.4 + 2/(self.n + 1)
+        self.pc = (1 - self.cc)*self.pc + hsig*np.sqrt(self.cc*(2 - self.cc)*self.mueff)*step
+
+        # covariance matrix and step size
+        rank_one = np.outer(self.pc, self.pc) + (1 - hsig)*self.cc*(2 - self.cc)*self.C
+        rank_mu = (selected*self.weights[:, np.newaxis]).T @ selected
+        self.C = (1 - self.c1 - self.cmu)*self.C + self.c1*rank_one + self.cmu*rank_mu
+        self.sigma *= np.exp((self.cs/self.damps)*(np.linalg.norm(self.ps)/self.chi_n - 1))
+
+        self.C = (self.C + self.C.T)/2
+        eigenvalues, self.B = np.linalg.eigh(self.C)
+        self.D = np.sqrt(np.maximum(eigenvalues, 1e-20))
+
+# scenarios of a worker process
+worker_scenarios = None
+
+def init_worker(scenarios):
+    global worker_scenarios
+    worker_scenarios = scenarios
+
+def to_gains(position):
+    # gains of a vector of trackbar positions
+    return {name: float(p*scale) for (name, _, scale), p in zip(GAINS, position)}
+
+def evaluate(args):
+    # mean simulator cost of a candidate over the scenarios of the worker; candidates outside the trackbar range are
+    # run at the nearest position in range and pay for their distance to it
+
+    mode, position, speed, fit_degree = args
+    clipped = np.clip(position, 0, TRACKBAR_MAX)
+    gains = to_gains(clipped)
+    costs = [simulate(scenario, mode, gains["kp"], gains["kd"], gains["skp"], speed, seed=i, fit_degree=fit_degree)["cost"]
+             for i, scenario in enumerate(worker_scenarios)]
+    return float(np.mean(costs)) + 1e-3*float(np.sum((position - clipped)**2))
+
+def tune_mode(pool, mode, speed, generations=20, popsize=None, seed=0, fit_degree=1, start=(10, 10, 10), sigma=15):
+    # searches the gains of a visual task; returns the best trackbar positions (rounded) and their cost
+
+    es = cmaes(start, sigma, popsize, seed)
+    best, best_cost = np.array(start, np.float64), np.inf
+    for generation in range(generations):
+        candidates = es.ask()
+        costs = np.array(pool.map(evaluate, [(mode, c, speed, fit_degree) for c in candidates]))
+        es.tell(candidates, costs)
+        if costs.min() < best_cost:
+            best, best_cost = candidates[costs.argmin()], costs.min()
+        print(f"  generation {generation + 1}: best {costs.min():.4f}, sigma {es.sigma:.2f}, mean {np.round(es.mean, 1)}")
+
+    # scoring the rounded positions the control panel can show
+    position = np.clip(np.round(best), 0, TRACKBAR_MAX)
+    return position, pool.map(evaluate, [(mode, position, speed, fit_degree)])[0]
+
+def profile_entry(task, position, cost):
+    # profile of a visual task: the gains, their trackbar positions and the simulator cost
+    entry = {"task": task, **to_gains(position), "cost": cost}
+    entry["trackbars"] = {trackbar: int(p) for (_, trackbar, _), p in zip(GAINS, position)}
+    return entry
+
+if __name__ == "__main__":
+    task_list = vistaskspec().task_list
+
+    parser = argparse.ArgumentParser(description="tune the pdcontroller gains of each visual task on the lane simulator")
+    parser.add_argument("--modes", default=",".join(task_list), help="comma separated visual tasks to tune")
+    parser.add_argument("--speed", type=float, default=0.5, help="throttle (speed trackbar / 10) the gains are tuned for")
+    parser.add_argument("--scenarios", type=int, default=6, help="random simulated roads each candidate is driven on")
+    parser.add_argument("--recordings", nargs="*", default=[], help="telemetry recordings whose road curvature is driven as extra scenarios")
+    parser.add_argument("--generations", type=int, default=20)
+    parser.add_argument("--popsize", type=int, help="candidates per generation (default: CMA-ES default for 3 gains)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="processes evaluating the candidates of a generation")
+    parser.add_argument("--fit-degree", type=int, choices=[1, 2], default=1, help="lane fit degree of the line tasks (as lanecontrol.py --fit-degree)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="gains.json", help="gain profile file (loaded with lanecontrol.py --gains); existing modes are kept")
+    args = parser.parse_args()
+
+    scenarios = [lanescenario.random(args.seed*1000 + i) for i in range(args.scenarios)]
+    scenarios += [lanescenario.from_recording(path) for path in args.recordings]
+
+    # keeping the tuned modes of an earlier run that used the same speed
+    profiles = {"speed": args.speed, "modes": {}}
+    if os.path.exists(args.output):
+        with open(args.output) as f:
+            previous = json.load(f)
+        if previous.get("speed") == args.speed:
+            profiles = previous
+
+    with mp.Pool(args.workers, init_worker, (scenarios,)) as pool:
+        for task in args.modes.split(","):
+            mode = task_list.index(task)
+            print(f"tuning {task}")
+            start = time.perf_counter()
+            position, cost = tune_mode(pool, mode, args.speed, args.generations, args.popsize, args.seed, args.fit_degree)
+            profiles["modes"][str(mode)] = profile_entry(task, position, cost)
+            print(f"{task}: {profiles['modes'][str(mode)]} ({time.perf_counter() - start:.1f} s)")
+
+            # written after every mode so an interrupted run keeps the finished ones
+            with open(args.output, "w") as f:
+                json.dump(profiles, f, indent=2)
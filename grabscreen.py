@@ -7,21 +7,47 @@
 
 import cv2
 import numpy as np
-import win32gui, win32ui, win32con, win32api
 
-def process_input():
+# screen capture uses the Windows API; without it process_input needs another grab function (e.g. replaying frames)
+try:
+  import win32gui, win32ui, win32con, win32api
+except ImportError:
+  win32gui = win32ui = win32con = win32api = None
+
+import tracing
+
+# shape of the captured screen region and of the frames returned by process_input
+CAPTURE_SHAPE = (600, 800, 3)
+FRAME_SHAPE = (600, 1600, 3)
+
+def process_input(out=None, capture_out=None, rgb_out=None, rows=CAPTURE_SHAPE[0], grab=None):
+  # the optional out arrays (FRAME_SHAPE, CAPTURE_SHAPE, CAPTURE_SHAPE) are reused instead of allocating new frames
+  # rows < CAPTURE_SHAPE[0] grabs only the bottom rows of the region and blanks the rows above, so the frame keeps
+  # its size and the lanes their place in it
+  # grab takes the place of grab_screen, with the same region and out arguments
+  if grab is None:
+    grab = grab_screen
+
   # grabbing input screenshot from top left corner of screen
-  input = grab_screen(region=(0,26,799,625))
+  with tracing.span("grab_screen"):
+    skip = CAPTURE_SHAPE[0] - rows
+    if skip:
+      input = capture_out if capture_out is not None else np.empty(CAPTURE_SHAPE, np.uint8)
+      grab(region=(0,26+skip,799,625), out=input[skip:])
+      input[:skip] = 0
+    else:
+      input = grab(region=(0,26,799,625), out=capture_out)
 
-  # converting to RGB colour
-  input_rgb = cv2.cvtColor(input, cv2.COLOR_BGR2RGB)
+  with tracing.span("process_input"):
+    # converting to RGB colour
+    input_rgb = cv2.cvtColor(input, cv2.COLOR_BGR2RGB, dst=rgb_out)
 
-  # creating border on screenshot to improve lane detection performance
-  input_rgb_border = cv2.copyMakeBorder(input_rgb, 0, 0, 400, 400, borderType=cv2.BORDER_CONSTANT)
+    # creating border on screenshot to improve lane detection performance (written into out if given)
+    input_rgb_border = cv2.copyMakeBorder(input_rgb, 0, 0, 400, 400, borderType=cv2.BORDER_CONSTANT, dst=out)
 
   return input_rgb_border
 
-def grab_screen(region=None):
+def grab_screen(region=None, out=None):
 
     hwin = win32gui.GetDesktopWindow()
 
@@ -44,7 +70,7 @@ def grab_screen(region=None):
     memdc.BitBlt((0, 0), (width, height), srcdc, (left, top), win32con.SRCCOPY)
     
     signedIntsArray = bmp.GetBitmapBits(True)
-    img = np.fromstring(signedIntsArray, dtype='uint8')
+    img = np.frombuffer(signedIntsArray, dtype='uint8')
     img.shape = (height,width,4)
 
     srcdc.DeleteDC()
@@ -52,4 +78,4 @@ def grab_screen(region=None):
     win32gui.ReleaseDC(hwin, hwindc)
     win32gui.DeleteObject(bmp.GetHandle())
 
-    return cv2.cvtColor(img, cv2.COLOR_BGRA2RGB)
\ No newline at end of file
+    return cv2.cvtColor(img, cv2.COLOR_BGRA2RGB, dst=out)
\ No newline at end of file
@@ -0,0 +1,98 @@
+'''
+  File name: graphdecode.py
+  Author(s):  Jeramy Luo - entire file
+  Purpose: Appends the lane decoding of UltrafastLaneDetector.process_output to an ONNX model, so the model outputs lane
+           x coordinates and a validity mask instead of the raw griding logits.
+'''
+
+import argparse
+import numpy as np
+import onnx
+
+from onnx import helper, numpy_helper, TensorProto
+
+from ultrafastLaneDetector.ultrafastLaneDetector import ModelConfig, ModelType, model_type_from_path, decoded_outputs
+
+# names of the decoded outputs, which UltrafastLaneDetector recognises decoded models by
+DECODED_OUTPUTS = decoded_outputs
+
+def append_decoding(model, cfg):
+    # appends softmax expectation, argmax masking and scaling to the griding logits (N, griding+1, anchors, lanes)
+    # the new outputs are lane_x (N, anchors, lanes) int32 and lane_valid (N, anchors, lanes) bool, with the anchors
+    # ordered from the bottom of the image to the top like process_output
+
+    opset = next(o.version for o in model.opset_import if o.domain in ("", "ai.onnx"))
+    if opset < 11:
+        raise ValueError(f"in-graph decoding needs opset 11 or newer, the model uses opset {opset}")
+
+    graph = model.graph
+    logits = graph.output[0]
+    dims = [d.dim_value if d.HasField("dim_value") else d.dim_param for d in logits.type.tensor_type.shape.dim]
+    batch, griding, anchors, lanes = dims
+    if griding != cfg.griding_num + 1:
+        raise ValueError(f"model has {griding - 1} griding cells, the model type uses {cfg.griding_num}")
+
+    # scaling from griding cell to image x coordinate (see process_output)
+    col_sample = np.linspace(0, 800 - 1, cfg.griding_num)
+    scale = (col_sample[1] - col_sample[0]) * cfg.img_w / 800
+
+    constants = [
+        numpy_helper.from_array(np.array([-1], np.int64), "decode_rev_starts"),
+        numpy_helper.from_array(np.array([np.iinfo(np.int64).min], np.int64), "decode_rev_ends"),
+        numpy_helper.from_array(np.array([1], np.int64), "decode_anchor_axis"),
+        numpy_helper.from_array(np.array([-1], np.int64), "decode_rev_steps"),
+        numpy_helper.from_array(np.array([0], np.int64), "decode_cls_starts"),
+        numpy_helper.from_array(np.array([cfg.griding_num], np.int64), "decode_cls_ends"),
+        numpy_helper.from_array(np.array([3], np.int64), "decode_cls_axis"),
+        numpy_helper.from_array((np.arange(cfg.griding_num, dtype=np.float32) + 1).reshape(-1, 1), "decode_idx"),
+        numpy_helper.from_array(np.array(cfg.griding_num, np.int64), "decode_griding_num"),
+        numpy_helper.from_array(np.array(scale, np.float32), "decode_scale"),
+        numpy_helper.from_array(np.array(1, np.int32), "decode_one"),
+        numpy_helper.from_array(np.array(-1, np.int32), "decode_invalid"),
+        numpy_helper.from_array(np.array([0, 0, 0], np.int64), "decode_shape"),
+    ]
+
+    nodes = [
+        # (N, G+1, A, L) -> (N, A, L, G+1), reversing the anchors
+        helper.make_node("Transpose", [logits.name], ["decode_t"], perm=[0, 2, 3, 1]),
+        helper.make_node("Slice", ["decode_t", "decode_rev_starts", "decode_rev_ends", "decode_anchor_axis", "decode_rev_steps"], ["decode_rev"]),
+        # expected griding cell: softmax over the cells (without the "no lane" cell) times the cell index 1..G
+        helper.make_node("Slice", ["decode_rev", "decode_cls_starts", "decode_cls_ends", "decode_cls_axis"], ["decode_cls"]),
+        helper.make_node("Softmax", ["decode_cls"], ["decode_prob"], axis=3),
+        helper.make_node("MatMul", ["decode_prob", "decode_idx"], ["decode_loc"]),
+        # a point is valid unless the "no lane" cell wins the argmax
+        helper.make_node("ArgMax", ["decode_rev"], ["decode_argmax"], axis=3, keepdims=1),
+        helper.make_node("Equal", ["decode_argmax", "decode_griding_num"], ["decode_empty"]),
+        helper.make_node("Not", ["decode_empty"], ["decode_valid"]),
+        # scaling to image coordinates, truncating like int() in process_output
+        helper.make_node("Mul", ["decode_loc", "decode_scale"], ["decode_xf"]),
+        helper.make_node("Cast", ["decode_xf"], ["decode_xi"], to=TensorProto.INT32),
+        helper.make_node("Sub", ["decode_xi", "decode_one"], ["decode_x"]),
+        helper.make_node("Where", ["decode_valid", "decode_x", "decode_invalid"], ["decode_x_masked"]),
+        # (N, A, L, 1) -> (N, A, L)
+        helper.make_node("Reshape", ["decode_x_masked", "decode_shape"], [DECODED_OUTPUTS[0]]),
+        helper.make_node("Reshape", ["decode_valid", "decode_shape"], [DECODED_OUTPUTS[1]]),
+    ]
+
+    graph.initializer.extend(constants)
+    graph.node.extend(nodes)
+    del graph.output[:]
+    graph.output.extend([
+        helper.make_tensor_value_info(DECODED_OUTPUTS[0], TensorProto.INT32, [batch, anchors, lanes]),
+        helper.make_tensor_value_info(DECODED_OUTPUTS[1], TensorProto.BOOL, [batch, anchors, lanes]),
+    ])
+
+    onnx.checker.check_model(model)
+    return model
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="append the lane decoding to a lane detection model")
+    parser.add_argument("model", help="input .onnx model")
+    parser.add_argument("output", help="output .onnx model with in-graph decoding")
+    parser.add_argument("--model-type", choices=["tusimple", "culane"], help="model type; guessed from the model file name if not given")
+    args = parser.parse_args()
+
+    model_type = ModelType[args.model_type.upper()] if args.model_type else model_type_from_path(args.model)
+    model = append_decoding(onnx.load(args.model), ModelConfig(model_type))
+    onnx.save(model, args.output)
+    print(f"saved {args.output}")
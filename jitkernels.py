@@ -0,0 +1,158 @@
+'''
+  File name: jitkernels.py
+  Author(s):  Jeramy Luo - entire file
+  Purpose: Optional Numba kernels fusing the small per-frame NumPy calls of lane decoding, the visual tasks and the pd controller.
+'''
+
+import numpy as np
+
+# Numba is optional; without it the callers keep their NumPy code
+try:
+    import numba
+except ImportError:
+    numba = None
+
+# whether the callers use the kernels (only possible with Numba installed)
+enabled = numba is not None
+
+def enable(flag=True):
+    # switches the callers between the kernels and their NumPy code
+    global enabled
+    if flag and numba is None:
+        raise RuntimeError("Numba is not installed")
+    enabled = flag
+
+def jit(function):
+    # compiles the kernel in nopython mode when Numba is installed (the plain Python function still runs without it)
+    if numba is None:
+        return function
+    return numba.njit(cache=True)(function)
+
+@jit
+def decode_lanes(output, griding_num, col_sample_w, img_w, lane_x, valid, confidence):
+    # UltrafastLaneDetector.process_output decoding of a (griding_num + 1, anchors, lanes) output
+    # into (anchors, lanes) x coordinates, valid points and lane point probabilities, in the anchor order of the model
+
+    cells, anchors, lanes = output.shape
+    for a in range(anchors):
+        for l in range(lanes):
+            # most likely cell; the last cell means there is no lane point on this anchor
+            best = 0
+            best_logit = output[0, a, l]
+            for c in range(1, cells):
+                if output[c, a, l] > best_logit:
+                    best = c
+                    best_logit = output[c, a, l]
+            # softmax over the lane cells, shifted by the largest logit of all cells
+            total = 0.0
+            weighted = 0.0
+            for c in range(griding_num):
+                p = np.exp(output[c, a, l] - best_logit)
+                total += p
+                weighted += p*(c + 1)
+            # probability of a lane point: the softmax over all cells but the no-lane one
+            confidence[a, l] = total/(total + np.exp(output[griding_num, a, l] - best_logit))
+
+            if best == griding_num:
+                lane_x[a, l] = -1
+                valid[a, l] = False
+                continue
+
+            # expected cell number from the softmax over the lane cells
+            loc = weighted/total
+
+            lane_x[a, l] = int(loc*col_sample_w*img_w/800) - 1
+            valid[a, l] = True
+
+@jit
+def nearest_index(values, target):
+    # index of the first value closest to target
+    best = 0
+    best_dist = abs(values[0] - target)
+    for i in range(1, values.shape[0]):
+        dist = abs(values[i] - target)
+        if dist < best_dist:
+            best = i
+            best_dist = dist
+    return best
+
+@jit
+def lane_midpoint(left_x, left_y, right_x, right_y):
+    # midpoint of the lane at the height of the middle points of both lanes (point2point and point2line)
+    middle_y = int((left_y[left_y.shape[0]//2] + right_y[right_y.shape[0]//2])/2)
+    left_idx = nearest_index(left_y, middle_y)
+    right_idx = nearest_index(right_y, middle_y)
+    middle_x = int((left_x[left_idx] + right_x[right_idx])/2)
+    return middle_x, middle_y
+
+@jit
+def cross(a0, a1, a2, b0, b1, b2):
+    # cross product of two homogeneous 3-vectors
+    return a1*b2 - a2*b1, a2*b0 - a0*b2, a0*b1 - a1*b0
+
+@jit
+def point_line_error(x, y, width):
+    # signed distance measure between a point and the vertical vehicle path line (point2line and cent2line)
+    l0, l1, l2 = cross(width/2, 500.0, 1.0, width/2, 0.0, 1.0)
+    return (x*l0 + y*l1 + l2)/1000
+
+@jit
+def polygon_centroid(left_x, left_y, right_x, right_y):
+    # shoelace centroid of the lane polygon (left lane up, right lane back down), the mean point if it has no area
+
+    n = left_x.shape[0] + right_x.shape[0]
+    area = 0.0
+    cx = 0.0
+    cy = 0.0
+    mean_x = 0.0
+    mean_y = 0.0
+    for i in range(n):
+        j = (i + 1) % n
+        xi = left_x[i] if i < left_x.shape[0] else right_x[n - 1 - i]
+        yi = left_y[i] if i < left_y.shape[0] else right_y[n - 1 - i]
+        xj = left_x[j] if j < left_x.shape[0] else right_x[n - 1 - j]
+        yj = left_y[j] if j < left_y.shape[0] else right_y[n - 1 - j]
+        step = float(xi)*yj - float(xj)*yi
+        area += step
+        cx += (float(xi) + xj)*step
+        cy += (float(yi) + yj)*step
+        mean_x += xi
+        mean_y += yi
+
+    if area == 0:
+        return mean_x/n, mean_y/n
+    return cx/(3*area), cy/(3*area)
+
+@jit
+def lines_error(lane_start_x, lane_start_y, lane_end_x, lane_end_y, mid_start_x, mid_start_y, mid_end_x, mid_end_y):
+    # parlines error: signed norm of the intersection of the lane and vehicle path lines
+    m0, m1, m2 = cross(mid_end_x, mid_end_y, 1.0, mid_start_x, mid_start_y, 1.0)
+    l0, l1, l2 = cross(lane_end_x, lane_end_y, 1.0, lane_start_x, lane_start_y, 1.0)
+    e0, e1, e2 = cross(m0, m1, m2, l0, l1, l2)
+    return np.sign(e1)*np.sqrt(e0*e0 + e1*e1 + e2*e2)/1000000
+
+@jit
+def line_distance_error(lane_start_x, lane_start_y, lane_end_x, lane_end_y, mid_start_x, mid_start_y, mid_end_x, mid_end_y):
+    # line2line error: distance measures of the vehicle path line ends to the lane line
+    l0, l1, l2 = cross(lane_end_x, lane_end_y, 1.0, lane_start_x, lane_start_y, 1.0)
+    return (mid_end_x*l0 + mid_end_y*l1 + l2 + mid_start_x*l0 + mid_start_y*l1 + l2)/1000
+
+@jit
+def pd_update(error, last, kp, kd):
+    # pdcontroller.update_controls PD step; returns the turn rate and the new last error
+    d = -error - last
+    return -(-error*kp + d*kd), -error
+
+def warmup():
+    # compiles (or loads from the cache) the kernels for the argument types of the control loop, so the first frame doesn't wait
+
+    output = np.zeros((101, 56, 4), np.float32)
+    decode_lanes(output, 100, 8.07, 1280, np.empty((56, 4), np.int32), np.empty((56, 4), np.bool_), np.empty((56, 4), np.float32))
+    # lane rows as passed by vistaskspec (strided rows of a transposed int16 array)
+    lane = np.arange(8, dtype=np.int16).reshape(4, 2).transpose()[0]
+    lane_midpoint(lane, lane, lane, lane)
+    polygon_centroid(lane, lane, lane, lane)
+    point_line_error(1.0, 1.0, 1280.0)
+    lines_error(1.0, 1.0, 1.0, 1.0, 1.0, 1.0, 1.0, 1.0)
+    line_distance_error(1.0, 1.0, 1.0, 1.0, 1.0, 1.0, 1.0, 1.0)
+    pd_update(1.0, 0.0, 0.1, 0.1)
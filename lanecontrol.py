@@ -4,34 +4,244 @@
   Purpose: Main control loop for the Visual Task Specification for Vehicle Lane Control model.
 '''
 
+import argparse
+import logging
+import time
 import cv2
+import numpy as np
 
-from grabscreen import process_input
-from ultrafastLaneDetector import UltrafastLaneDetector, ModelType
+import tracing
+import jitkernels
+
+from grabscreen import process_input, CAPTURE_SHAPE, FRAME_SHAPE
+from ultrafastLaneDetector import UltrafastLaneDetector, ModelType, model_type_from_path
 from visualtaskspec import vistaskspec
 from pid import pdcontroller
+from renderer import lanerenderer
+from telemetry import telemetryrecorder
+from framering import captureprocess
+from framecontext import framecontextpool
+from videorecorder import videorecorder
+from threadbudget import threadbudget, parse_cpus
+from qualitygovernor import qualitygovernor, load_levels
+from lanetracker import lanetracker
+
+log = logging.getLogger("lanecontrol")
 
 if __name__ == "__main__":
+  # parsing command line options
+  parser = argparse.ArgumentParser(description="Visual Task Specification for Vehicle Lane Control")
+  parser.add_argument("--model", default="models/tusimple.onnx", help="path of the lane detection model")
+  parser.add_argument("--swap-models", nargs="+", default=[], metavar="MODEL", help="models cycled through with the m key, swapped in without stopping the control loop")
+  parser.add_argument("--model-type", choices=["tusimple", "culane"], help="model type; guessed from the model file name if not given")
+  parser.add_argument("--render-fps", type=float, default=30, help="display rate of the background renderer; 0 draws on the control thread")
+  parser.add_argument("--record", metavar="PATH", help="record the telemetry of the run to a binary file")
+  parser.add_argument("--record-frames", action="store_true", help="also store the input frames next to the telemetry file")
+  parser.add_argument("--multiprocess", action="store_true", help="capture frames in a separate process through a shared-memory ring buffer")
+  parser.add_argument("--latency-comp", action="store_true", help="predict the error over the measured capture-to-actuation delay")
+  parser.add_argument("--gains", metavar="PATH", help="gain profiles from gaintuner.py, applied whenever the mode changes")
+  parser.add_argument("--plant-gain", type=float, default=0.0, help="error decrease per second per unit turn rate in the --latency-comp plant model (0 leaves the steering out and extrapolates the error trend)")
+  parser.add_argument("--video", metavar="PATH", help="encode the annotated frames and the control panel to a video file in a background process")
+  parser.add_argument("--video-every", type=int, default=2, help="keep every Nth rendered frame in the video")
+  parser.add_argument("--video-fps", type=float, default=15, help="frame rate written to the video file")
+  parser.add_argument("--zero-alloc", action="store_true", help="reuse preallocated per-frame buffers instead of allocating new arrays every frame")
+  parser.add_argument("--fit-degree", type=int, choices=[1, 2], default=1, help="degree of the lane fits used by the parlines and line2line tasks")
+  parser.add_argument("--no-numba", action="store_true", help="use the NumPy code even if the Numba kernels are available")
+  parser.add_argument("--intra-op", type=int, help="onnxruntime intra-op threads, including the control thread (default: one per core)")
+  parser.add_argument("--inter-op", type=int, help="onnxruntime inter-op threads")
+  parser.add_argument("--cv-threads", type=int, help="OpenCV threads for resize, cvtColor and addWeighted (1 runs them on the calling thread)")
+  parser.add_argument("--no-spin", action="store_true", help="let idle onnxruntime threads sleep instead of spinning")
+  parser.add_argument("--inference-cpus", type=parse_cpus, metavar="CPUS", help="CPUs of the onnxruntime pool threads, e.g. 2-5")
+  parser.add_argument("--control-cpus", type=parse_cpus, metavar="CPUS", help="CPUs of the control loop thread")
+  parser.add_argument("--background-cpus", type=parse_cpus, metavar="CPUS", help="CPUs of the renderer, recorder and video encoder")
+  parser.add_argument("--capture-cpus", type=parse_cpus, metavar="CPUS", help="CPUs of the --multiprocess capture process")
+  parser.add_argument("--latency-budget", type=float, metavar="MS", help="frame latency budget; steps the quality down through the --quality-levels to keep within it")
+  parser.add_argument("--quality-levels", metavar="PATH", help="JSON list of quality levels for --latency-budget (default: drawing off, smaller capture, inference every other frame)")
+  parser.add_argument("--quality-log", metavar="PATH", help="append every quality level change to a JSON lines file")
+  parser.add_argument("--trace", metavar="PATH", help="write a Chrome trace / Perfetto timeline of the pipeline stages on exit")
+  parser.add_argument("--quiet", action="store_true", help="only log warnings and errors, not status changes and statistics")
+  args = parser.parse_args()
+
+  # status messages and statistics go through logging, warnings and errors are always shown
+  logging.basicConfig(level=logging.WARNING if args.quiet else logging.INFO, format="%(asctime)s %(name)s: %(message)s")
+
+  # turning on the span tracer
+  if args.trace:
+    tracing.enable()
+
+  # compiling the Numba kernels before the first frame (NumPy is used if Numba isn't installed)
+  if args.no_numba:
+    jitkernels.enable(False)
+  elif jitkernels.enabled:
+    jitkernels.warmup()
+
+  # splitting the cores between onnxruntime, OpenCV and the pipeline stages
+  budget = threadbudget(args.intra_op, args.inter_op, args.cv_threads, not args.no_spin,
+                        args.inference_cpus, args.control_cpus, args.background_cpus, args.capture_cpus)
+  budget.apply_opencv()
+  log.info("thread budget: %s", budget.describe())
+
   # initializing lane detection model
-  lane_detector = UltrafastLaneDetector("models/tusimple.onnx", ModelType.TUSIMPLE)
+  model_type = ModelType[args.model_type.upper()] if args.model_type else model_type_from_path(args.model)
+  lane_detector = UltrafastLaneDetector(args.model, model_type, backend_options=budget.backend_options())
   # initializing visual task specification class
-  vts = vistaskspec()
+  vts = vistaskspec(lane_detector.cfg.img_w, args.fit_degree)
   # initializing pd control class
-  controller = pdcontroller()
+  controller = pdcontroller(compensate=args.latency_comp, plant_gain=args.plant_gain, gains=args.gains)
+  # initializing video encoder process
+  video = videorecorder(args.video, args.video_fps, args.video_every) if args.video else None
+  if video is not None:
+    budget.pin_background_process(video.process.pid)
+  # initializing background renderer (the renderer and recorder threads pin themselves to the background CPUs)
+  renderer = lanerenderer(lane_detector.cfg, args.render_fps, video=video, cpus=budget.background_cpus) if args.render_fps > 0 else None
+  # initializing telemetry recorder
+  recorder = None
+  if args.record:
+    recorder = telemetryrecorder(args.record, lane_detector.num_lanes, lane_detector.cfg.cls_num_per_lane,
+                                 lane_detector.cfg.img_w, lane_detector.cfg.img_h, frames=args.record_frames, cpus=budget.background_cpus)
+
+  # initializing capture process
+  capture = captureprocess(process_input, FRAME_SHAPE) if args.multiprocess else None
+  if capture is not None:
+    budget.pin_capture(capture.process.pid)
+  # initializing preallocated frame buffers
+  contexts = framecontextpool(lane_detector, FRAME_SHAPE, CAPTURE_SHAPE) if args.zero_alloc else None
+
+  # quality governor and the lane tracker of frames that skip inference
+  governor = None
+  if args.latency_budget:
+    governor = qualitygovernor(load_levels(args.quality_levels), args.latency_budget/1000, log_path=args.quality_log)
+    if capture is not None and any(level["capture_rows"] != CAPTURE_SHAPE[0] for level in governor.levels):
+      log.warning("the capture process grabs the whole region, capture_rows of the quality levels is ignored")
+  level = governor.level if governor is not None else None
+  tracker = None
+
+  # models cycled through with the m key (a quality level may ask for another one)
+  models = [args.model] + args.swap_models
+  user_model = 0
+  active_path = requested_path = args.model
+  failed_models = set()
+  generation = lane_detector.generation
+
+  # keeping the control loop off the background CPUs
+  budget.pin_control()
 
   while True:
+    # starting a new frame for the tracer
+    tracing.next_frame()
+    # taking a frame context the renderer and recorder aren't using
+    context = contexts.acquire() if contexts is not None else None
     # processing input
-    frame = process_input()
-    # detecting the lanes
-    output_img, lanes_pts, lanes_detected  = lane_detector.detect_lanes(frame)
+    if capture is not None:
+      # newest frame from the capture process, used in place; it stays valid until the next read
+      with tracing.span("capture.read"):
+        frame, capture_time = capture.read()
+      if frame is None:
+        if context is not None:
+          context.release()
+        continue
+      timestamp = time.time() - (time.perf_counter() - capture_time)
+    else:
+      timestamp = time.time()
+      capture_time = time.perf_counter()
+      rows = level["capture_rows"] if level is not None else CAPTURE_SHAPE[0]
+      frame = process_input(context.frame, context.capture, context.rgb, rows) if context is not None else process_input(rows=rows)
+    draw = level is None or level["draw"]
+    if tracker is not None and tracker.skipped + 1 < level["infer_every"]:
+      # skipping inference, the lanes are extrapolated from the last inferred frames
+      with tracing.span("track_lanes"):
+        detection = tracker.predict(context.buffers.detection if context is not None else None)
+      output_img = None
+    else:
+      # detecting the lanes (drawing is left to the renderer if there is one)
+      output_img, detection = lane_detector.detect_lanes(frame, draw=draw and renderer is None, buffers=context.buffers if context is not None else None)
+      if tracker is not None:
+        tracker.update(detection)
+    # following a model swap made by detect_lanes
+    if lane_detector.generation != generation:
+      generation = lane_detector.generation
+      active_path = requested_path
+      log.info("switched to %s", active_path)
+      vts.width = lane_detector.cfg.img_w
+      if renderer is not None:
+        renderer.cfg = lane_detector.cfg
+      if recorder is not None and (lane_detector.num_lanes, lane_detector.cfg.cls_num_per_lane) != recorder.dtype["points"].shape[:2]:
+        log.warning("the new model has another number of lanes or anchors, stopping the telemetry recording")
+        recorder.close()
+        recorder = None
     # acquiring error term
-    err = vts.get_error(lanes_pts, lanes_detected, output_img, controller.get_mode())
+    err = vts.get_error(detection, output_img, controller.get_mode())
+    # frames in the scratch context of an exhausted pool are not handed to the renderer and recorder
+    handoff = context is None or context.pooled
+    # ring buffer slots are reused by the capture process, so a frame handed to the renderer or recorder is first
+    # copied out of the ring (into the frame context if there is one)
+    if capture is not None and handoff and ((renderer is not None and draw) or (recorder is not None and args.record_frames)):
+      if context is not None:
+        np.copyto(context.frame, frame)
+        frame = context.frame
+      else:
+        frame = frame.copy()
+    # handing the frame to the background renderer
+    if renderer is not None and draw and handoff:
+      renderer.submit(frame, detection, vts.overlays, context, controller.display.copy() if video is not None else None)
+    elif video is not None and output_img is not None:
+      video.submit(vistaskspec.crop(output_img), controller.display)
     # updating pid controller if valid error received
     if err != None:
-      controller.update_controls(err)
+      controller.update_controls(err, capture_time)
+    # stepping the quality down or up on the capture-to-control latency of the frame
+    if governor is not None and governor.update(time.perf_counter() - capture_time):
+      level = governor.level
+      if level["infer_every"] > 1 and tracker is None:
+        tracker = lanetracker(lane_detector.num_lanes, lane_detector.cfg.cls_num_per_lane)
+        tracker.update(detection)
+      elif level["infer_every"] == 1:
+        tracker = None
+    # recording the tick (counted as dropped without a context to hand off)
+    if recorder is not None and not handoff:
+      recorder.dropped += 1
+    elif recorder is not None:
+      recorder.record(timestamp, detection, controller.get_mode(), err, controller, frame, context)
+    # handing the frame context back to the pool once the renderer and recorder are done with it
+    if context is not None:
+      context.release()
     # updating controls from control window
     controller.update_trackbars()
-    # showing windows
-    if cv2.waitKey(25) & 0xFF == ord('q'):
+    # showing windows (the renderer's latest image is shown from this thread, which runs the HighGUI event loop)
+    if renderer is not None:
+      renderer.show()
+    key = cv2.waitKey(25) & 0xFF
+    # picking the next model with the m key
+    if key == ord('m') and len(models) > 1:
+      user_model = (user_model + 1) % len(models)
+    # loading the model of the quality level, or else the one picked, in the background
+    wanted_path = level["model"] if level is not None and level["model"] else models[user_model]
+    if wanted_path != requested_path and wanted_path not in failed_models:
+      if lane_detector.swap_thread is None or not lane_detector.swap_thread.is_alive():
+        requested_path = wanted_path
+        lane_detector.swap_model(requested_path, model_type_from_path(requested_path), backend_options=budget.backend_options())
+    if lane_detector.swap_error is not None:
+      log.error("could not load %s: %s", requested_path, lane_detector.swap_error)
+      lane_detector.swap_error = None
+      failed_models.add(requested_path)
+      requested_path = active_path
+    if key == ord('q'):
+        if renderer is not None:
+          log.info("renderer: %s", renderer.stats())
+          renderer.close()
+        if video is not None:
+          log.info("video: %s", video.stats())
+          if not video.close():
+            log.warning("the video encoder did not finish cleanly, %s may be incomplete", args.video)
+        if recorder is not None:
+          log.info("telemetry: %d ticks dropped", recorder.dropped)
+          recorder.close()
+        if contexts is not None and contexts.exhausted:
+          log.info("frame contexts: %d frames found the pool exhausted", contexts.exhausted)
+        if capture is not None:
+          log.info("capture: %s", capture.stats())
+          capture.close()
+        if args.trace:
+          tracing.dump(args.trace)
         cv2.destroyAllWindows()
-        break
\ No newline at end of file
+        break
@@ -0,0 +1,44 @@
+'''
+  File name: lanefit.py
+  Author(s):  Jeramy Luo - entire file
+  Purpose: Batched weighted least squares line and quadratic fits of the detected lane points.
+'''
+
+import numpy as np
+
+# y is scaled by this factor while fitting to keep the normal equations well conditioned
+Y_SCALE = 1/1000
+
+def fit_lanes(points, valid, degree=1, weights=None):
+    # fits x = p(y) of the given degree to the valid points of every lane by weighted least squares
+    # points is (..., anchors, 2) and valid (..., anchors) for any batch of frames and lanes, e.g. detection.points[1:3]
+    # returns the (..., degree + 1) coefficients, highest power first as in np.polyval, and the mask of lanes that
+    # had more points than coefficients (the others get zero coefficients)
+
+    x = points[..., 0].astype(np.float64)
+    t = points[..., 1]*Y_SCALE
+    w = valid.astype(np.float64) if weights is None else valid*weights
+
+    # weighted normal equations for all lanes at once
+    powers = np.arange(degree, -1, -1)
+    vander = t[..., np.newaxis]**powers
+    weighted = vander*w[..., np.newaxis]
+    gram = np.einsum("...ai,...aj->...ij", weighted, vander)
+    rhs = np.einsum("...ai,...a->...i", weighted, x)
+
+    fitted = np.sum(valid, axis=-1) > degree
+    gram[~fitted] = np.eye(degree + 1)
+    coeffs = np.linalg.solve(gram, rhs[..., np.newaxis])[..., 0]
+    coeffs[~fitted] = 0
+
+    # back from the scaled y to image coordinates
+    return coeffs*Y_SCALE**powers, fitted
+
+def eval_fits(coeffs, y):
+    # evaluates the (..., degree + 1) fits at the (n,) or (..., n) y values, giving (..., n) x values (Horner's method)
+
+    y = np.asarray(y, np.float64)
+    x = 0
+    for k in range(coeffs.shape[-1]):
+        x = x*y + coeffs[..., k, np.newaxis]
+    return x
@@ -0,0 +1,200 @@
+'''
+  File name: lanesim.py
+  Author(s):  Jeramy Luo - entire file
+  Purpose: Closed-loop lane keeping simulator producing synthetic lane detections, used to score pdcontroller gains offline.
+'''
+
+import numpy as np
+
+from ultrafastLaneDetector import LaneDetection, ModelType
+from ultrafastLaneDetector.ultrafastLaneDetector import ModelConfig
+from visualtaskspec import vistaskspec
+from pid import pdcontroller
+from telemetry import telemetryreader
+from mockactuator import mockactuator
+from lanefit import fit_lanes
+
+# pinhole model of the game camera in the 1280x720 TuSimple model image: the 800x600 capture fills columns 320-960
+# (scaled by 0.8 across and 1.2 down, see grabscreen.process_input) and the rows below 620 show the vehicle
+FX = 550.0
+FY = 830.0
+CX = 640.0
+HORIZON = 330.0
+CAMERA_HEIGHT = 2.5
+VISIBLE_COLUMNS = (320, 960)
+VISIBLE_ROWS = 620
+# farthest distance (m) at which lane points are still detected
+MAX_RANGE = 80.0
+
+# vehicle: speed at full throttle (m/s), path curvature at a turn rate of 1 (1/m), steering time constant (s)
+MAX_SPEED = 30.0
+MAX_CURVATURE = 0.05
+STEER_LAG = 0.15
+
+# road: lane width (m) and lateral offsets of the four model lanes from the centre of the ego lane
+LANE_WIDTH = 3.7
+LANE_OFFSETS = np.array([-1.5, -0.5, 0.5, 1.5])*LANE_WIDTH
+
+# control loop rate (Hz) and capture-to-actuation delay in ticks
+RATE = 30
+DELAY = 2
+
+# cost weights: turn rate changes (jerky steering) and lost speed (from s_kp); leaving the lane adds
+# DEPARTURE_COST times the fraction of the run that was left
+JERK_WEIGHT = 100.0
+SPEED_WEIGHT = 0.5
+DEPARTURE_COST = 10.0
+
+class lanescenario():
+    def __init__(self, curvature, spacing=1.0, offset=0.0, heading=0.0):
+        # road curvature (1/m, positive to the right) every spacing metres and the initial lateral offset (m, positive
+        # right of the lane centre) and heading (rad, relative to the road) of the vehicle
+        self.curvature = np.asarray(curvature, np.float64)
+        self.spacing = spacing
+        self.offset = offset
+        self.heading = heading
+
+    @classmethod
+    def random(cls, seed, length=2000, max_curvature=0.004):
+        # highway-like road of constant-curvature segments joined by linear transitions, and a random start in the lane
+
+        rng = np.random.default_rng(seed)
+        knots = [0]
+        while knots[-1] < length:
+            knots.append(knots[-1] + rng.uniform(100, 300))
+        values = rng.uniform(-max_curvature, max_curvature, len(knots))
+        # straight segments between some of the bends
+        values[rng.random(len(knots)) < 0.3] = 0
+        # holding each value over the first two thirds of its segment and ramping to the next one
+        knots = np.array(knots)
+        hold = knots[:-1] + 2*np.diff(knots)/3
+        curvature = np.interp(np.arange(length), np.ravel(np.column_stack((knots[:-1], hold))), np.repeat(values[:-1], 2))
+        return cls(curvature, 1.0, rng.uniform(-0.5, 0.5), rng.uniform(-0.02, 0.02))
+
+    @classmethod
+    def from_recording(cls, path, smoothing=15):
+        # road curvature seen in a telemetry recording: the lanes of every tick are projected onto the road with the
+        # camera model above and fitted with quadratics (all ticks at once), and the curvature is placed along the road
+        # at the distance driven at the recorded speed
+
+        reader = telemetryreader(path)
+        records = reader.records
+        points = np.array(records["points"][:, 1:3], np.float64)
+        valid = np.array(records["valid"][:, 1:3]) & np.array(records["detected"][:, 1:3, np.newaxis])
+        valid &= points[..., 1] > HORIZON + 1
+
+        # ground coordinates: lateral position as x and distance ahead as y, as fit_lanes expects
+        distance = FY*CAMERA_HEIGHT/np.maximum(points[..., 1] - HORIZON, 1)
+        ground = np.stack(((points[..., 0] - CX)*distance/FX, distance), axis=-1)
+        valid &= distance < MAX_RANGE
+        coeffs, fitted = fit_lanes(ground, valid, 2)
+
+        # lateral = c2 d^2 + c1 d + c0 has curvature 2 c2; ticks without both lanes keep the last curvature
+        curvature = np.where(fitted, 2*coeffs[..., 0], np.nan)
+        curvature = np.nanmean(np.where(fitted.any(axis=1)[:, np.newaxis], curvature, np.nan), axis=1)
+        known = ~np.isnan(curvature)
+        if not known.any():
+            raise ValueError(f"{path} has no ticks with both ego lanes detected")
+        curvature = np.interp(np.arange(len(curvature)), np.flatnonzero(known), curvature[known])
+        curvature = np.convolve(curvature, np.ones(smoothing)/smoothing, mode="same")
+
+        # resampling from ticks to 1 m along the road
+        driven = np.concatenate(([0], np.cumsum(np.maximum(records["final_speed"][:-1], 0.05)*MAX_SPEED/RATE)))
+        return cls(np.interp(np.arange(0, driven[-1] + 1), driven, curvature))
+
+    def curvature_at(self, s):
+        # road curvature at the distance s (m) along the road, the last value beyond the end
+        return np.interp(s, np.arange(len(self.curvature))*self.spacing, self.curvature)
+
+class lanesimulator():
+    def __init__(self, scenario, cfg=None, noise=3.0, dropout=0.05, seed=0):
+        # vehicle on the road of a scenario, seen through the camera model with pixel noise and missed points
+        self.scenario = scenario
+        self.cfg = cfg or ModelConfig(ModelType.TUSIMPLE)
+        self.noise = noise
+        self.dropout = dropout
+        self.rng = np.random.default_rng(seed)
+
+        # anchor rows (bottom to top, as in LaneDetection), the distance ahead they show and the rows lanes are seen on
+        self.rows = (self.cfg.img_h*(np.asarray(self.cfg.row_anchor[::-1])/288)).astype(np.int32) - 1
+        self.distance = FY*CAMERA_HEIGHT/np.maximum(self.rows - HORIZON, 1)
+        self.visible = (self.rows > HORIZON) & (self.rows < VISIBLE_ROWS) & (self.distance < MAX_RANGE)
+
+        # vehicle state: distance along the road, lateral offset, heading and actual (lagged) path curvature
+        self.s = 0.0
+        self.offset = scenario.offset
+        self.heading = scenario.heading
+        self.path_curvature = 0.0
+
+    def detection(self):
+        # synthetic lane detection of the current state (the road ahead is taken to have the curvature at the vehicle)
+
+        kappa = self.scenario.curvature_at(self.s)
+        d = self.distance[np.newaxis, :]
+        lateral = LANE_OFFSETS[:, np.newaxis] - self.offset - self.heading*d + kappa*d**2/2
+        x = CX + FX*lateral/d + self.rng.normal(0, self.noise, lateral.shape)
+
+        valid = self.visible & (x >= VISIBLE_COLUMNS[0]) & (x < VISIBLE_COLUMNS[1])
+        valid &= self.rng.random(valid.shape) >= self.dropout
+        detected = valid.sum(axis=1) > 2
+        valid &= detected[:, np.newaxis]
+
+        points = np.empty(valid.shape + (2,), np.int16)
+        points[..., 0] = np.where(valid, np.clip(x, -1, self.cfg.img_w), -1)
+        points[..., 1] = self.rows
+        return LaneDetection(points, valid, detected)
+
+    def step(self, t, speed, dt=1/RATE):
+        # moves the vehicle for one tick with turn rate t and throttle speed (0-1)
+
+        v = speed*MAX_SPEED
+        target = t*MAX_CURVATURE
+        self.path_curvature += (target - self.path_curvature)*min(1.0, dt/STEER_LAG)
+        self.heading += v*(self.path_curvature - self.scenario.curvature_at(self.s))*dt
+        self.offset += v*np.sin(self.heading)*dt
+        self.s += v*dt
+
+def simulate(scenario, mode, kp, kd, skp, speed, duration=20.0, seed=0, fit_degree=1):
+    # drives a scenario closed loop with the visual task of mode and the given gains; returns the cost of the run
+    # (lateral error in half lane widths squared, plus steering jerk, lost speed and lane departure terms) and its parts
+
+    sim = lanesimulator(scenario, seed=seed)
+    vts = vistaskspec(sim.cfg.img_w, fit_degree)
+    controller = pdcontroller(actuator=mockactuator(), controls=False)
+    controller.set_gains(kp, kd, skp, speed, mode)
+
+    ticks = int(duration*RATE)
+    # commands take DELAY ticks from capture to actuation
+    commands = [(0.0, speed)]*DELAY
+    offsets = []
+    turns = []
+    speeds = []
+    departed = None
+    for tick in range(ticks):
+        err = vts.get_error(sim.detection(), None, mode)
+        if err is not None:
+            controller.update_controls(err)
+        commands.append((controller.t, controller.final_speed))
+        t, final_speed = commands.pop(0)
+        sim.step(t, final_speed)
+
+        offsets.append(sim.offset)
+        turns.append(controller.t)
+        speeds.append(final_speed)
+        if abs(sim.offset) > LANE_WIDTH/2:
+            departed = tick
+            break
+
+    offsets = np.array(offsets)/(LANE_WIDTH/2)
+    turns = np.array(turns)
+    lateral = float(np.mean(offsets**2))
+    jerk = float(np.mean(np.diff(turns)**2)) if len(turns) > 1 else 0.
+    slow = float(1 - np.mean(speeds)/speed) if speed > 0 else 0.
+    departure = DEPARTURE_COST*(1 - departed/ticks) if departed is not None else 0.
+    return {
+        "cost": lateral + JERK_WEIGHT*jerk + SPEED_WEIGHT*slow + departure,
+        "lateral": lateral,
+        "jerk": jerk,
+        "slow": slow,
+        "departed": departed is not None,
+    }
@@ -0,0 +1,72 @@
+'''
+  File name: lanetracker.py
+  Author(s):  Jeramy Luo - entire file
+  Purpose: Constant-velocity tracking of the lane points between inferred frames, for frames that skip the model.
+'''
+
+import numpy as np
+
+from ultrafastLaneDetector import LaneDetection
+
+class lanetracker():
+    def __init__(self, num_lanes, num_anchors, smoothing=0.5):
+        # last inferred detection (the valid points and y coordinates of the predictions)
+        self.detection = LaneDetection.empty(num_lanes, num_anchors)
+        # x coordinates of the last inferred detection and their change per frame since the one before
+        self.x = np.zeros((num_lanes, num_anchors), np.float32)
+        self.velocity = np.zeros((num_lanes, num_anchors), np.float32)
+        # scratch for the updates and predictions
+        self.step = np.zeros((num_lanes, num_anchors), np.float32)
+        self.both = np.zeros((num_lanes, num_anchors), np.bool_)
+        # weight of the previous velocity in each update, damping the detection noise the velocity would extrapolate
+        self.smoothing = smoothing
+
+        # frames predicted since the last inferred detection
+        self.skipped = 0
+        self.primed = False
+
+    def update(self, detection):
+        # takes the detection of an inferred frame (copied, as detect_lanes may overwrite it next frame)
+
+        if detection.points.shape != self.detection.points.shape:
+            # a model with another number of lanes or anchors was swapped in, tracking starts over
+            self.__init__(*detection.valid.shape, self.smoothing)
+
+        if self.primed:
+            # velocity of the points found in both detections, the others hold still
+            np.logical_and(self.detection.valid, detection.valid, out=self.both)
+            np.subtract(detection.points[:, :, 0], self.x, out=self.step)
+            self.step /= self.skipped + 1
+            self.velocity *= self.smoothing
+            self.step *= 1 - self.smoothing
+            self.velocity += self.step
+            self.velocity *= self.both
+        else:
+            self.velocity[:] = 0
+
+        np.copyto(self.x, detection.points[:, :, 0])
+        np.copyto(self.detection.points, detection.points)
+        np.copyto(self.detection.valid, detection.valid)
+        np.copyto(self.detection.detected, detection.detected)
+        np.copyto(self.detection.confidence, detection.confidence)
+        self.skipped = 0
+        self.primed = True
+
+    def predict(self, out=None):
+        # detection of a frame without inference, extrapolated from the last inferred one
+        # (written into out if it has the same shape, e.g. the reused detection of a framecontext)
+
+        if not self.primed:
+            raise RuntimeError("lanetracker has no detection to predict from")
+        if out is None or out.points.shape != self.detection.points.shape:
+            out = LaneDetection.empty(*self.detection.valid.shape)
+
+        self.skipped += 1
+        np.multiply(self.velocity, self.skipped, out=self.step)
+        self.step += self.x
+        np.copyto(out.points, self.detection.points)
+        np.copyto(out.points[:, :, 0], self.step, casting="unsafe")
+        np.copyto(out.valid, self.detection.valid)
+        np.copyto(out.detected, self.detection.detected)
+        np.copyto(out.confidence, self.detection.confidence)
+        return out
@@ -0,0 +1,132 @@
+'''
+  File name: lowrankhead.py
+  Author(s):  Jeramy Luo - entire file
+  Purpose: Replaces the last layer of the parsingNet classification head with a truncated-SVD low-rank factorization and
+           compares the exported models against the original for accuracy, latency and size.
+'''
+
+import argparse
+import copy
+import os
+import tempfile
+import time
+import numpy as np
+import torch
+
+from exportonnx import BACKBONES, build_model, fold_batchnorms, export, optimize, verify
+from profilemodels import load_frames
+from ultrafastLaneDetector import UltrafastLaneDetector, ModelType
+from visualtaskspec import vistaskspec
+
+def factorize_head(net, rank):
+    # replaces Linear(2048, total_dim) in net.cls with Linear(2048, rank) -> Linear(rank, total_dim) from a truncated SVD
+
+    layer = net.cls[2]
+    with torch.no_grad():
+        U, S, Vh = torch.linalg.svd(layer.weight, full_matrices=False)
+
+        first = torch.nn.Linear(layer.in_features, rank, bias=False)
+        first.weight.copy_(S[:rank, None] * Vh[:rank])
+
+        second = torch.nn.Linear(rank, layer.out_features)
+        second.weight.copy_(U[:, :rank])
+        second.bias.copy_(layer.bias)
+
+    net.cls[2] = torch.nn.Sequential(first, second)
+    return net
+
+def export_model(net, path, opset=13):
+    # folds the BatchNorms, exports and optimizes the network and checks it against PyTorch
+
+    reference = copy.deepcopy(net)
+    with torch.no_grad():
+        fold_batchnorms(net)
+    with tempfile.TemporaryDirectory() as tmp:
+        raw_path = os.path.join(tmp, "raw.onnx")
+        export(net, raw_path, opset)
+        optimize(raw_path, path)
+    verify(reference, path)
+
+def run_model(model_path, model_type, frames, warmup=5):
+    # returns the detections of the model on the frames and its mean inference time (ms)
+
+    lane_detector = UltrafastLaneDetector(model_path, model_type)
+    for frame in frames[:warmup]:
+        lane_detector.detect_lanes(frame, draw=False)
+
+    detections = []
+    inference_time = 0
+    for frame in frames:
+        input_tensor = lane_detector.prepare_input(frame)
+        start = time.perf_counter()
+        output = lane_detector.inference(input_tensor)
+        inference_time += time.perf_counter() - start
+        detections.append(lane_detector.process_output(output, lane_detector.cfg))
+    return detections, 1000*inference_time/len(frames)
+
+def compare_detections(reference, candidate, width):
+    # lane point deviation, detection agreement and vistaskspec error drift of candidate against reference
+
+    deviation = []
+    agreement = 0
+    vts = vistaskspec(width)
+    drift = {task: [] for task in vts.task_list}
+    for ref, cand in zip(reference, candidate):
+        # x deviation of the points both models found
+        both = ref.valid & cand.valid
+        deviation.append(np.abs(ref.points[..., 0][both].astype(np.int32) - cand.points[..., 0][both]))
+        agreement += np.array_equal(ref.detected, cand.detected)
+
+        # error of every visual task on both detections
+        for mode, task in enumerate(vts.task_list):
+            err_ref = vts.get_error(ref, None, mode)
+            err_cand = vts.get_error(cand, None, mode)
+            if err_ref is not None and err_cand is not None:
+                drift[task].append(abs(err_cand - err_ref))
+
+    deviation = np.concatenate(deviation) if deviation else np.zeros(0)
+    return {
+        "point_dev_mean": float(deviation.mean()) if deviation.size else 0.0,
+        "point_dev_p95": float(np.percentile(deviation, 95)) if deviation.size else 0.0,
+        "detection_agreement": agreement/max(len(reference), 1),
+        "error_drift": {task: float(np.mean(d)) if d else float("nan") for task, d in drift.items()},
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="low-rank factorization of the parsingNet classification head")
+    parser.add_argument("--backbone", choices=BACKBONES, default="18")
+    parser.add_argument("--model-type", choices=["tusimple", "culane"], default="tusimple")
+    parser.add_argument("--weights", help="Ultra-Fast-Lane-Detection checkpoint (.pth)")
+    parser.add_argument("--ranks", default="64,128,256,512", help="comma separated ranks to export")
+    parser.add_argument("--output-dir", default="models")
+    parser.add_argument("--recording", help="telemetry recording with frames for the accuracy report")
+    parser.add_argument("--max-frames", type=int, default=200)
+    parser.add_argument("--opset", type=int, default=13)
+    args = parser.parse_args()
+
+    model_type = ModelType[args.model_type.upper()]
+    net = build_model(args.backbone, model_type, args.weights)
+    name = f"{args.model_type}_{args.backbone}"
+
+    # exporting the original model and one model per rank
+    paths = {"full": os.path.join(args.output_dir, f"{name}.onnx")}
+    export_model(copy.deepcopy(net), paths["full"], args.opset)
+    for rank in [int(r) for r in args.ranks.split(",")]:
+        paths[rank] = os.path.join(args.output_dir, f"{name}_rank{rank}.onnx")
+        export_model(factorize_head(copy.deepcopy(net), rank), paths[rank], args.opset)
+
+    # running every model on the recorded frames (or a blank frame for latency only)
+    frames = load_frames(args.recording, args.max_frames) if args.recording else [np.zeros((600, 1600, 3), np.uint8)]*20
+    results = {key: run_model(path, model_type, frames) for key, path in paths.items()}
+    reference, _ = results["full"]
+    width = UltrafastLaneDetector(paths["full"], model_type).cfg.img_w
+
+    for key, path in paths.items():
+        detections, latency = results[key]
+        report = f"{str(key):>6}  size {os.path.getsize(path)/2**20:7.1f} MB  inference {latency:6.2f} ms"
+        if args.recording and key != "full":
+            accuracy = compare_detections(reference, detections, width)
+            report += (f"  point dev {accuracy['point_dev_mean']:.2f} px (p95 {accuracy['point_dev_p95']:.1f})"
+                       f"  detection agreement {accuracy['detection_agreement']:.1%}  error drift "
+                       + ", ".join(f"{task} {drift:.3f}" for task, drift in accuracy["error_drift"].items()))
+        print(report)
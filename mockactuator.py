@@ -0,0 +1,15 @@
+'''
+  File name: mockactuator.py
+  Author(s):  Jeramy Luo - entire file
+  Purpose: Stand-in for the vJoy device, used to run the pd controller in replays, benchmarks, the simulator and tests.
+'''
+
+class mockactuator():
+    def __init__(self):
+        # stand-in for pyvjoy.VJoyDevice that keeps the last value set on each axis
+        self.axes = {}
+        self.commands = 0
+
+    def set_axis(self, axis, value):
+        self.axes[axis] = value
+        self.commands += 1
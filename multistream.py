@@ -0,0 +1,215 @@
+'''
+  File name: multistream.py
+  Author(s):  Jeramy Luo - entire file
+  Purpose: Runs several independent lane control streams in one process, batching their frames into shared inference calls.
+'''
+
+import argparse
+import os
+import threading
+import time
+import cv2
+import numpy as np
+
+from ultrafastLaneDetector import UltrafastLaneDetector, model_type_from_path
+from visualtaskspec import vistaskspec
+from pid import pdcontroller
+from telemetry import telemetryreader
+from mockactuator import mockactuator
+
+class filesource():
+    def __init__(self, path, fps=30, loop=False):
+        # frame source reading a telemetry recording (made with --record-frames) or a video file at a fixed rate
+
+        self.path = path
+        self.interval = 1/fps if fps else 0
+        self.loop = loop
+        self.next_time = 0
+
+        if os.path.isdir(path + ".frames"):
+            reader = telemetryreader(path)
+            self.frames = [frame for frame in map(reader.frame, range(len(reader))) if frame is not None]
+        else:
+            self.frames = []
+            video = cv2.VideoCapture(path)
+            while True:
+                ok, frame = video.read()
+                if not ok:
+                    break
+                self.frames.append(frame)
+            video.release()
+        self.idx = 0
+
+    def __call__(self):
+        # returns the next frame, or None once the source is exhausted
+
+        if self.idx == len(self.frames):
+            if not self.loop or not self.frames:
+                return None
+            self.idx = 0
+
+        # pacing the source like a camera
+        delay = self.next_time - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        self.next_time = max(self.next_time, time.perf_counter()) + self.interval
+
+        frame = self.frames[self.idx]
+        self.idx += 1
+        return frame
+
+class stream():
+    def __init__(self, name, source, mode, controller, width=1280):
+        # one independent vehicle/camera: frame source, visual task, controller state and actuator
+        self.name = name
+        self.source = source
+        self.mode = mode
+        self.controller = controller
+        self.vts = vistaskspec(width)
+
+        # newest frame waiting for inference, its capture time and since when the stream has had a frame waiting
+        # (a newer frame replacing the waiting one doesn't restart the latency budget)
+        self.pending = None
+        self.pending_time = 0
+        self.waiting_since = 0
+        self.finished = False
+
+        # latency accounting (seconds)
+        self.frames = 0
+        self.dropped = 0
+        self.waits = []
+        self.latencies = []
+        self.batch_sizes = []
+
+    def stats(self):
+        # returns the per-stream latency statistics in milliseconds
+        waits = np.array(self.waits or [0])*1000
+        latencies = np.array(self.latencies or [0])*1000
+        return {
+            "frames": self.frames,
+            "dropped": self.dropped,
+            "wait_mean_ms": float(waits.mean()),
+            "wait_p95_ms": float(np.percentile(waits, 95)),
+            "latency_mean_ms": float(latencies.mean()),
+            "latency_p95_ms": float(np.percentile(latencies, 95)),
+            "latency_max_ms": float(latencies.max()),
+            "batch_mean": float(np.mean(self.batch_sizes or [0])),
+        }
+
+class streamscheduler():
+    def __init__(self, lane_detector, streams, max_batch=8, latency_budget=0.015):
+        # batches the pending frames of all streams into shared detect_lanes_batch calls; a batch is started once
+        # every active stream has a frame waiting or the oldest waiting frame has waited latency_budget seconds
+        self.lane_detector = lane_detector
+        self.streams = streams
+        self.max_batch = max_batch
+        self.latency_budget = latency_budget
+        self.cond = threading.Condition()
+        self.running = False
+
+    def capture(self, s):
+        # capture thread of a stream; keeps only the newest frame
+
+        while self.running:
+            frame = s.source()
+            capture_time = time.perf_counter()
+            with self.cond:
+                if frame is None:
+                    s.finished = True
+                    self.cond.notify()
+                    return
+                if s.pending is not None:
+                    s.dropped += 1
+                else:
+                    s.waiting_since = capture_time
+                s.pending = frame
+                s.pending_time = capture_time
+                self.cond.notify()
+
+    def next_batch(self):
+        # waits for a batch of pending frames according to the latency budget; returns None when all streams are done
+
+        with self.cond:
+            while True:
+                waiting = [s for s in self.streams if s.pending is not None]
+                active = [s for s in self.streams if not s.finished or s.pending is not None]
+                if not active:
+                    return None
+                if waiting:
+                    deadline = min(s.waiting_since for s in waiting) + self.latency_budget
+                    remaining = deadline - time.perf_counter()
+                    if len(waiting) >= min(len(active), self.max_batch) or remaining <= 0:
+                        break
+                    self.cond.wait(remaining)
+                else:
+                    self.cond.wait()
+
+            # streams waiting longest first
+            waiting.sort(key=lambda s: s.waiting_since)
+            batch = []
+            for s in waiting[:self.max_batch]:
+                batch.append((s, s.pending, s.pending_time))
+                s.pending = None
+            return batch
+
+    def run(self):
+        # runs the streams until every source is exhausted
+
+        self.running = True
+        threads = [threading.Thread(target=self.capture, args=(s,), name=f"capture-{s.name}", daemon=True) for s in self.streams]
+        for thread in threads:
+            thread.start()
+
+        try:
+            while True:
+                batch = self.next_batch()
+                if batch is None:
+                    break
+                start = time.perf_counter()
+
+                # shared inference for all frames in the batch
+                detections = self.lane_detector.detect_lanes_batch([frame for _, frame, _ in batch])
+
+                # per-stream visual task and control
+                for (s, frame, capture_time), detection in zip(batch, detections):
+                    err = s.vts.get_error(detection, None, s.mode)
+                    if err is not None:
+                        s.controller.update_controls(err, capture_time)
+                    s.frames += 1
+                    s.waits.append(start - capture_time)
+                    s.latencies.append(time.perf_counter() - capture_time)
+                    s.batch_sizes.append(len(batch))
+        finally:
+            self.running = False
+            for thread in threads:
+                thread.join()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="run several lane control streams with batched inference and mock actuators")
+    parser.add_argument("sources", nargs="+", help="telemetry recordings with frames or video files, one per stream")
+    parser.add_argument("--model", default="models/tusimple.onnx")
+    parser.add_argument("--modes", default="0", help="comma separated visual task mode per stream (last one repeats)")
+    parser.add_argument("--gains", default="0.002,0.004,2,0.5", help="kp,kd,skp,speed for every stream")
+    parser.add_argument("--fps", type=float, default=30, help="frame rate of each source (0 reads as fast as possible)")
+    parser.add_argument("--max-batch", type=int, default=8)
+    parser.add_argument("--budget-ms", type=float, default=15, help="longest a frame may wait for its batch to fill")
+    args = parser.parse_args()
+
+    lane_detector = UltrafastLaneDetector(args.model, model_type_from_path(args.model))
+    modes = [int(m) for m in args.modes.split(",")]
+    kp, kd, skp, speed = [float(g) for g in args.gains.split(",")]
+
+    streams = []
+    for i, path in enumerate(args.sources):
+        controller = pdcontroller(actuator=mockactuator(), controls=False)
+        controller.set_gains(kp, kd, skp, speed)
+        streams.append(stream(f"{i}:{os.path.basename(path)}", filesource(path, args.fps), modes[min(i, len(modes) - 1)], controller, lane_detector.cfg.img_w))
+
+    scheduler = streamscheduler(lane_detector, streams, args.max_batch, args.budget_ms/1000)
+    start = time.perf_counter()
+    scheduler.run()
+    elapsed = time.perf_counter() - start
+
+    for s in streams:
+        print(s.name, s.stats(), f"commands: {s.controller.j.commands}")
+    print(f"{sum(s.frames for s in streams)} frames in {elapsed:.2f} s")
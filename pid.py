@@ -4,18 +4,49 @@
   Purpose: Contains the pdcontroller class for the lane control system.
 '''
 
+import json
 import numpy as np
 import cv2
-import pyvjoy
 import time
 
-class pdcontroller():
-    def __init__(self):
-        # creating the control panel
-        self.create_controls()
+from collections import deque
+
+import tracing
+import jitkernels
+
+# virtual joystick axes used for steering and speed (pyvjoy.HID_USAGE_X and pyvjoy.HID_USAGE_SL0)
+AXIS_TURN = 0x30
+AXIS_SPEED = 0x36
+
+# gains per control panel trackbar step
+KP_SCALE = 1/10000
+KD_SCALE = 1/5000
+SKP_SCALE = 0.2
+SPEED_SCALE = 0.1
 
-        # creating the virtual joystick class
-        self.j = pyvjoy.VJoyDevice(1)
+def load_gains(path):
+    # reads a gain profile file (see gaintuner.py); returns {mode: {"kp", "kd", "skp", "trackbars", ...}}
+    with open(path) as f:
+        profiles = json.load(f)
+    return {int(mode): profile for mode, profile in profiles["modes"].items()}
+
+class pdcontroller():
+    def __init__(self, device_id=1, actuator=None, controls=True, compensate=False, plant_gain=0.0, history=5, gains=None):
+        # creating the control panel (without it, gains are set with set_gains)
+        self.controls = controls
+        if controls:
+            self.create_controls()
+
+        # tuned gains of each mode, applied whenever the mode changes on the control panel, and the mode last applied
+        self.profiles = load_gains(gains) if gains else {}
+        self.profile_mode = None
+
+        # creating the virtual joystick class, unless another actuator with a set_axis method is given
+        if actuator is None:
+            # imported here as pyvjoy exits if the vJoy driver isn't installed
+            import pyvjoy
+            actuator = pyvjoy.VJoyDevice(device_id)
+        self.j = actuator
 
         # setting initial gains
         self.kp = 0
@@ -41,6 +72,18 @@ class pdcontroller():
         # mode for task
         self.mode = 0
 
+        # latency compensation: predicts the error at actuation time from the measured capture-to-actuation delay
+        self.compensate = compensate
+        # decrease of the error per second per unit of turn rate in the plant model of the latency compensation
+        # (0 leaves the steering out of the model, see predict_error)
+        self.plant_gain = plant_gain
+        # recent (capture time, error) pairs for the lane motion estimate and (actuation time, turn rate) commands
+        self.error_history = deque(maxlen=history)
+        self.command_history = deque(maxlen=history)
+        # measured delay from frame capture to actuation and time taken by the joystick commands (seconds)
+        self.delay = 0
+        self.actuation_lag = 0
+
     def create_controls(self):
         # creates the window and taskbar for the control panel
 
@@ -55,34 +98,118 @@ class pdcontroller():
     def update_trackbars(self):
         # updating the controls on the control panel
 
-        self.kp = 1/10000 * cv2.getTrackbarPos("turn_kp", "controls")
-        self.kd = 1/5000 * cv2.getTrackbarPos("turn_kd", "controls")
-        self.skp = 0.2 * cv2.getTrackbarPos("s_kp", "controls")
-        self.speed = 0.1 * cv2.getTrackbarPos("speed", "controls")
         self.mode = cv2.getTrackbarPos("mode", "controls")
+        # moving the gain trackbars to the tuned gains of a newly selected mode (they can still be adjusted by hand)
+        if self.mode != self.profile_mode:
+            self.apply_profile(self.mode)
+
+        self.kp = KP_SCALE * cv2.getTrackbarPos("turn_kp", "controls")
+        self.kd = KD_SCALE * cv2.getTrackbarPos("turn_kd", "controls")
+        self.skp = SKP_SCALE * cv2.getTrackbarPos("s_kp", "controls")
+        self.speed = SPEED_SCALE * cv2.getTrackbarPos("speed", "controls")
         self.show()
+
+    def apply_profile(self, mode):
+        # sets the tuned gains of a mode, on the trackbars if there is a control panel; modes without a profile keep their gains
+
+        self.profile_mode = mode
+        if mode not in self.profiles:
+            return
+        profile = self.profiles[mode]
+        if self.controls:
+            for trackbar, position in profile["trackbars"].items():
+                cv2.setTrackbarPos(trackbar, "controls", position)
+        else:
+            self.kp = profile["kp"]
+            self.kd = profile["kd"]
+            self.skp = profile["skp"]
+
+    def set_gains(self, kp, kd, skp, speed, mode=None):
+        # sets the gains directly, for controllers running without a control panel
+
+        self.kp = kp
+        self.kd = kd
+        self.skp = skp
+        self.speed = speed
+        if mode is not None:
+            self.mode = mode
     
-    def update_controls(self, error):
+    def update_controls(self, error, capture_time=None):
         # main loop of the pid controller; takes in error and finds the turn rate to control the vehicle
+        # capture_time (time.perf_counter) of the frame the error was measured on is needed for latency compensation
 
-        # calculating derivative term
-        d = -error - self.last
+        # predicting the error at the time the command takes effect
+        if self.compensate and capture_time is not None:
+            error = self.predict_error(error, capture_time)
 
-        # updating last
-        self.last = -error
+        if jitkernels.enabled:
+            self.t, self.last = jitkernels.pd_update(float(error), float(self.last), float(self.kp), float(self.kd))
+        else:
+            # calculating derivative term
+            d = -error - self.last
 
-        # updating turn rate
-        self.t = -(-error * self.kp + d * self.kd)
+            # updating last
+            self.last = -error
+
+            # updating turn rate
+            self.t = -(-error * self.kp + d * self.kd)
 
         # turning the vehicle
         self.turn()
 
+        # measuring the delay from capture to actuation
+        if capture_time is not None:
+            self.delay = time.perf_counter() - capture_time
+
         # clearing image
-        self.display = np.zeros([100,600,3], np.uint8)
+        self.display.fill(0)
+
+    def predict_error(self, error, capture_time):
+        # Smith-predictor style forward prediction of the error over the pipeline delay, with the plant model
+        #   d(error)/dt = drift - plant_gain * turn rate
+        # the drift (the lane moving across the image, e.g. in a curve) is the slope of a least squares line through
+        # the recent errors with the modelled effect of the steering over the same time taken out, and the prediction
+        # adds the drift and the effect of the commands sent since the frame was captured; with plant_gain 0 the model
+        # has no steering term and the prediction extrapolates the error trend
+
+        self.error_history.append((capture_time, error))
+
+        # delay until the command is sent: time since capture plus the time the joystick commands take
+        now = time.perf_counter()
+        actuation_time = now + self.actuation_lag
+
+        # drift from the residual of the plant model: the errors with the steering since the first of them added back
+        drift = 0
+        if len(self.error_history) >= 2:
+            times, errors = np.array(self.error_history).T
+            if times[-1] > times[0]:
+                residual = errors + self.plant_gain*np.array([self.steering(times[0], t) for t in times])
+                times = times - times.mean()
+                drift = np.dot(times, residual - residual.mean())/np.dot(times, times)
+
+        return error + drift*(actuation_time - capture_time) - self.plant_gain*self.steering(capture_time, actuation_time)
+
+    def steering(self, start, end):
+        # integral of the turn rate over the time from start to end, each command held until the next one
+        # (the time before the oldest kept command counts as no steering)
+
+        total = 0
+        commands = list(self.command_history) + [(end, None)]
+        for (t0, t), (t1, _) in zip(commands[:-1], commands[1:]):
+            total += t * max(0, min(t1, end) - max(t0, start))
+        return total
 
     def turn(self):
         # finds the speed rate and calls the virtual joystick
 
+        with tracing.span("pdcontroller.turn"):
+            self.send_commands()
+
+    def send_commands(self):
+        # sends the speed and turn commands to the virtual joystick
+
+        start = time.perf_counter()
+
         # defining max value of virtual joystick
         MAX_VJOY = 32767
 
@@ -90,10 +217,15 @@ class pdcontroller():
         self.final_speed = self.p_speed()
         
         # sending virtual joystick speed command
-        self.j.set_axis(pyvjoy.HID_USAGE_SL0, int(MAX_VJOY*self.final_speed))
+        self.j.set_axis(AXIS_SPEED, int(MAX_VJOY*self.final_speed))
 
         # sending virtual joystick turn command
-        self.j.set_axis(pyvjoy.HID_USAGE_X, int(MAX_VJOY*(1/2 + self.t)))
+        self.j.set_axis(AXIS_TURN, int(MAX_VJOY*(1/2 + self.t)))
+
+        # keeping the command for latency compensation and timing the joystick calls
+        end = time.perf_counter()
+        self.command_history.append((end, self.t))
+        self.actuation_lag = 0.9*self.actuation_lag + 0.1*(end - start)
 
     def p_speed(self):
         # finds the speed coefficient
@@ -130,6 +262,10 @@ class pdcontroller():
         # displaying speed %
         cv2.putText(self.display, f"S: {np.abs(round(self.final_speed*100, 1))}%", (200, 35),cv2.FONT_HERSHEY_SIMPLEX,1, (255, 255, 255), 2, cv2.LINE_AA)
 
+        # displaying capture-to-actuation delay
+        if self.compensate:
+            cv2.putText(self.display, f"{int(self.delay*1000)} ms", (400, 85),cv2.FONT_HERSHEY_SIMPLEX,1, (255, 255, 255), 2, cv2.LINE_AA)
+
         # displaying visual task
         cv2.putText(self.display, f"Mode: {task_list[self.mode]}", (5, 85),cv2.FONT_HERSHEY_SIMPLEX,1, (255, 255, 255), 2, cv2.LINE_AA)
 
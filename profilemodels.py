@@ -0,0 +1,99 @@
+'''
+  File name: profilemodels.py
+  Author(s):  Jeramy Luo - entire file
+  Purpose: Reports the per-stage latency and detection rate of every installed lane detection model on a recorded clip.
+'''
+
+import argparse
+import glob
+import os
+import time
+import numpy as np
+
+from ultrafastLaneDetector import UltrafastLaneDetector, model_type_from_path
+from telemetry import telemetryreader
+
+# stages of detect_lanes that are timed
+STAGES = ["prepare_input", "inference", "process_output", "draw_lanes"]
+
+def profile_model(model_path, frames, warmup=5):
+    # runs every stage of the detector on the frames and returns the stage times (ms) and detection statistics
+
+    model_type = model_type_from_path(model_path)
+    lane_detector = UltrafastLaneDetector(model_path, model_type)
+
+    # warming up the session
+    for frame in frames[:warmup]:
+        lane_detector.detect_lanes(frame)
+
+    times = {stage: [] for stage in STAGES}
+    ego_detected = 0
+    ego_points = 0
+    for frame in frames:
+        t0 = time.perf_counter()
+        input_tensor = lane_detector.prepare_input(frame)
+        t1 = time.perf_counter()
+        output = lane_detector.inference(input_tensor)
+        t2 = time.perf_counter()
+        detection = lane_detector.process_output(output, lane_detector.cfg)
+        t3 = time.perf_counter()
+        lane_detector.draw_lanes(frame, detection, lane_detector.cfg)
+        t4 = time.perf_counter()
+
+        for stage, start, end in zip(STAGES, (t0, t1, t2, t3), (t1, t2, t3, t4)):
+            times[stage].append((end - start)*1000)
+
+        # lanes 1 and 2 are the ego lanes for both model types
+        if detection.detected[1] and detection.detected[2]:
+            ego_detected += 1
+            ego_points += detection.valid[1].sum() + detection.valid[2].sum()
+
+    stats = {
+        "model": os.path.basename(model_path),
+        "type": model_type.name,
+        "anchors": lane_detector.cfg.cls_num_per_lane,
+        "detection_rate": ego_detected/len(frames),
+        "ego_points": ego_points/max(ego_detected, 1)/2,
+    }
+    for stage in STAGES:
+        stats[stage] = (np.mean(times[stage]), np.percentile(times[stage], 95))
+    stats["total"] = np.mean(np.sum([times[stage] for stage in STAGES], axis=0))
+    return stats
+
+def load_frames(recording, max_frames):
+    # loads the recorded frames of a telemetry recording
+
+    reader = telemetryreader(recording)
+    frames = []
+    for i in range(len(reader)):
+        frame = reader.frame(i)
+        if frame is not None:
+            frames.append(np.array(frame))
+        if len(frames) == max_frames:
+            break
+    if not frames:
+        raise SystemExit(f"{recording} has no recorded frames (record with --record-frames)")
+    return frames
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="profile the installed lane detection models on a recorded clip")
+    parser.add_argument("recording", help="telemetry recording made with lanecontrol.py --record PATH --record-frames")
+    parser.add_argument("--models", default="models", help="directory with the .onnx models")
+    parser.add_argument("--max-frames", type=int, default=300)
+    args = parser.parse_args()
+
+    frames = load_frames(args.recording, args.max_frames)
+    model_paths = sorted(glob.glob(os.path.join(args.models, "*.onnx")))
+    if not model_paths:
+        raise SystemExit(f"no .onnx models found in {args.models}")
+
+    print(f"{len(frames)} frames from {args.recording}\n")
+    print(f"{'model':<24}{'type':<10}{'anchors':>8}" + "".join(f"{stage + ' ms':>22}" for stage in STAGES) + f"{'total ms':>10}{'fps':>7}{'detected':>10}{'ego pts':>9}")
+    for model_path in model_paths:
+        stats = profile_model(model_path, frames)
+        row = f"{stats['model']:<24}{stats['type']:<10}{stats['anchors']:>8}"
+        for stage in STAGES:
+            mean, p95 = stats[stage]
+            row += f"{f'{mean:.2f} (p95 {p95:.2f})':>22}"
+        row += f"{stats['total']:>10.2f}{1000/stats['total']:>7.1f}{stats['detection_rate']:>10.1%}{stats['ego_points']:>9.1f}"
+        print(row)
@@ -0,0 +1,121 @@
+'''
+  File name: qualitygovernor.py
+  Author(s):  Jeramy Luo - entire file
+  Purpose: Steps the pipeline quality down and up through configured levels to keep the frame latency within a budget.
+'''
+
+import json
+import logging
+import time
+import numpy as np
+
+from collections import deque
+
+log = logging.getLogger("qualitygovernor")
+
+# settings of a quality level:
+#   draw          draw the lanes and overlays (on the control thread or the renderer)
+#   capture_rows  screenshot rows grabbed, counted from the bottom of the capture region; the rows above (the sky)
+#                 are left black, which saves capture time but not inference time
+#   model         lane detection model, None for the one given on the command line (or picked with the m key)
+#   infer_every   run the model every Nth frame, tracking the lanes on the frames in between
+LEVEL_KEYS = ["name", "draw", "capture_rows", "model", "infer_every"]
+
+# levels from the best quality to the cheapest; each level only lists what it changes from the one above
+DEFAULT_LEVELS = [
+    {"name": "full", "draw": True, "capture_rows": 600, "model": None, "infer_every": 1},
+    {"name": "no-draw", "draw": False},
+    {"name": "small-capture", "capture_rows": 420},
+    {"name": "half-rate", "infer_every": 2},
+]
+
+def load_levels(path=None):
+    # quality levels from a JSON list like DEFAULT_LEVELS (e.g. with INT8 or ego-lane model levels),
+    # filled in so every level has all the settings
+
+    levels = DEFAULT_LEVELS
+    if path is not None:
+        with open(path) as f:
+            levels = json.load(f)
+    if not levels:
+        raise ValueError("At least one quality level is needed")
+
+    filled = []
+    settings = dict(DEFAULT_LEVELS[0])
+    for i, level in enumerate(levels):
+        unknown = set(level) - set(LEVEL_KEYS)
+        if unknown:
+            raise ValueError(f"Unknown quality level settings {sorted(unknown)}")
+        settings = {**settings, "name": f"level{i}", **level}
+        if settings["infer_every"] < 1 or not 0 < settings["capture_rows"] <= 600:
+            raise ValueError(f"Invalid quality level {settings}")
+        filled.append(settings)
+    return filled
+
+class qualitygovernor():
+    def __init__(self, levels, budget, window=30, down_ratio=1.0, up_ratio=0.7, up_frames=90, cooldown=30, log_path=None):
+        # levels from load_levels and the frame latency budget in seconds
+        self.levels = levels
+        self.budget = budget
+
+        # hysteresis: the 90th percentile latency of the last window frames steps the quality down as soon as it is over
+        # down_ratio * budget, and up only after staying under up_ratio * budget for up_frames frames in a row;
+        # no step is taken until cooldown frames after the last one, so the new level is measured first
+        self.window = window
+        self.down_ratio = down_ratio
+        self.up_ratio = up_ratio
+        self.up_frames = up_frames
+        self.cooldown = cooldown
+
+        self.index = 0
+        self.latencies = deque(maxlen=window)
+        self.since_change = 0
+        self.good_frames = 0
+
+        # every change is logged and, given a path, appended to a JSON lines file
+        self.log_path = log_path
+        self.changes = 0
+
+    @property
+    def level(self):
+        # settings of the current level
+        return self.levels[self.index]
+
+    def update(self, latency):
+        # adds the latency of a frame in seconds; returns True if the level changed
+
+        self.latencies.append(latency)
+        self.since_change += 1
+        if self.since_change < self.cooldown or len(self.latencies) < self.window:
+            return False
+
+        p90 = float(np.percentile(self.latencies, 90))
+        if p90 > self.down_ratio*self.budget:
+            self.good_frames = 0
+            if self.index < len(self.levels) - 1:
+                self.change(self.index + 1, p90, "over budget")
+                return True
+        elif p90 < self.up_ratio*self.budget:
+            self.good_frames += 1
+            if self.good_frames >= self.up_frames and self.index > 0:
+                self.change(self.index - 1, p90, "under budget")
+                return True
+        else:
+            self.good_frames = 0
+        return False
+
+    def change(self, index, p90, reason):
+        # moves to another level and logs it; the latencies of the old level are dropped
+
+        entry = {"time": time.time(), "from": self.level["name"], "to": self.levels[index]["name"],
+                 "p90_ms": round(p90*1000, 2), "budget_ms": round(self.budget*1000, 2), "reason": reason}
+        log.info("quality %s -> %s: p90 %s ms, budget %s ms (%s)", entry["from"], entry["to"], entry["p90_ms"], entry["budget_ms"], reason)
+        if self.log_path is not None:
+            with open(self.log_path, "a") as f:
+                f.write(json.dumps(entry) + "\n")
+
+        self.index = index
+        self.latencies.clear()
+        self.since_change = 0
+        self.good_frames = 0
+        self.changes += 1
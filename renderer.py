@@ -0,0 +1,138 @@
+'''
+  File name: renderer.py
+  Author(s):  Jeramy Luo - entire file
+  Purpose: Contains the background renderer that draws the lane detection output off the control thread.
+'''
+
+import threading
+import time
+import cv2
+import numpy as np
+
+import tracing
+
+from ultrafastLaneDetector import UltrafastLaneDetector
+from visualtaskspec import vistaskspec
+from threadbudget import pin_thread
+
+class lanerenderer():
+    def __init__(self, cfg, max_fps=30, draw_points=True, video=None, cpus=None):
+        # model configuration used to scale the frame for drawing
+        self.cfg = cfg
+        self.draw_points = draw_points
+
+        # optional videorecorder receiving the rendered frames
+        self.video = video
+
+        # CPUs the render thread pins itself to (None leaves it unpinned)
+        self.cpus = cpus
+
+        # minimum time between two rendered frames
+        self.min_interval = 1/max_fps
+
+        # latest snapshot waiting to be drawn; a newer snapshot replaces (drops) an older one
+        self.snapshot = None
+        self.cond = threading.Condition()
+
+        # finished images: the render thread draws into back and swaps it with front, which show() displays from the
+        # thread running the HighGUI event loop (HighGUI isn't thread-safe and only that thread pumps its windows)
+        self.front = None
+        self.back = None
+        self.fresh = False
+        self.image_lock = threading.Lock()
+
+        # renderer statistics
+        self.submitted = 0
+        self.rendered = 0
+        self.dropped = 0
+
+        # starting the render thread
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name="lanerenderer", daemon=True)
+        self.thread.start()
+
+    def submit(self, frame, detection, overlays, context=None, panel=None):
+        # hands a snapshot of the current frame to the renderer; only swaps a reference and never waits on drawing
+        # a framecontext holding the frame and detection is held until drawn (or dropped) and its buffers are drawn into
+        # panel is a copy of the control panel, stacked under the frame in the video recording
+
+        if context is not None:
+            context.hold()
+        with self.cond:
+            if self.snapshot is not None:
+                self.dropped += 1
+                if self.snapshot[4] is not None:
+                    self.snapshot[4].release()
+            self.snapshot = (frame, detection, overlays, tracing.frame_id(), context, panel)
+            self.submitted += 1
+            self.cond.notify()
+
+    def run(self):
+        # main loop of the render thread
+
+        pin_thread(self.cpus)
+        last_render = 0
+        while True:
+            # waiting for a snapshot
+            with self.cond:
+                while self.snapshot is None and self.running:
+                    self.cond.wait()
+                if not self.running:
+                    break
+
+            # capping the display rate; snapshots submitted while sleeping replace the pending one
+            delay = last_render + self.min_interval - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+
+            # taking the newest snapshot
+            with self.cond:
+                snapshot, self.snapshot = self.snapshot, None
+            last_render = time.perf_counter()
+
+            self.render(*snapshot)
+            self.rendered += 1
+            if snapshot[4] is not None:
+                snapshot[4].release()
+
+    def render(self, frame, detection, overlays, frame_id=0, context=None, panel=None):
+        # draws the lanes and the visual task overlays and hands the result to show()
+        # spans are tagged with the id of the frame the snapshot came from, not the frame the control loop is on
+
+        with tracing.span("draw_lanes", frame_id):
+            if context is None:
+                output_img = UltrafastLaneDetector.draw_lanes(frame, detection, self.cfg, self.draw_points)
+            else:
+                output_img = UltrafastLaneDetector.draw_lanes(frame, detection, self.cfg, self.draw_points,
+                                                              context.buffers.visualization, context.buffers.lane_segment)
+            vistaskspec.draw_overlays(output_img, overlays)
+        # copied out of the (possibly reused) visualization buffer
+        cropped = vistaskspec.crop(output_img)
+        if self.back is None or self.back.shape != cropped.shape:
+            self.back = cropped.copy()
+        else:
+            np.copyto(self.back, cropped)
+        with self.image_lock:
+            self.front, self.back = self.back, self.front
+            self.fresh = True
+
+        if self.video is not None and panel is not None:
+            self.video.submit(vistaskspec.crop(output_img), panel)
+
+    def show(self):
+        # shows the newest finished image, if there is one not yet shown; called from the control loop next to its waitKey
+        with self.image_lock:
+            if self.fresh:
+                cv2.imshow("Lane Detection", self.front)
+                self.fresh = False
+
+    def stats(self):
+        # returns the number of submitted, rendered and dropped snapshots
+        return {"submitted": self.submitted, "rendered": self.rendered, "dropped": self.dropped}
+
+    def close(self):
+        # stops the render thread
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+        self.thread.join()
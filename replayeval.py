@@ -0,0 +1,114 @@
+'''
+  File name: replayeval.py
+  Author(s):  Jeramy Luo - entire file
+  Purpose: Open-loop replay of a telemetry recording through the visual tasks and the pd controller with a given configuration.
+'''
+
+import argparse
+import json
+import numpy as np
+
+from ultrafastLaneDetector import UltrafastLaneDetector, SharedWeights, model_type_from_path
+from visualtaskspec import vistaskspec
+from pid import pdcontroller
+from telemetry import telemetryreader
+from mockactuator import mockactuator
+
+# configuration keys of a replay; gains and mode left out follow the recorded values of every tick,
+# a model re-detects the lanes on the recorded frames instead of using the recorded detections
+CONFIG_KEYS = ["mode", "kp", "kd", "skp", "speed", "fit_degree", "model"]
+
+# detectors of the process, by model path (loading a model takes far longer than replaying a short recording)
+detectors = {}
+# weights mapped with share_weights, by model path; detectors of these models use the shared weights
+shared_weights = {}
+
+def share_weights(model_paths):
+    # maps the weights of the models once, before forking workers, so the workers' detectors share them
+    for model_path in model_paths:
+        if model_path not in shared_weights:
+            shared_weights[model_path] = SharedWeights(model_path)
+
+def get_detector(model_path):
+    # returns the detector of a model, loading it on first use
+    if model_path not in detectors:
+        if model_path in shared_weights:
+            detectors[model_path] = shared_weights[model_path].detector()
+        else:
+            detectors[model_path] = UltrafastLaneDetector(model_path, model_type_from_path(model_path))
+    return detectors[model_path]
+
+def redetect(reader, model_path, batch=8):
+    # runs a model over the frames of a recording; yields the detection of every tick
+    lane_detector = get_detector(model_path)
+    if reader.frame_shape is None:
+        raise ValueError("The recording has no frames to run the model on")
+
+    for start in range(0, len(reader), batch):
+        frames = [reader.frame(i) for i in range(start, min(start + batch, len(reader)))]
+        if any(frame is None for frame in frames):
+            raise ValueError("The recording is missing some of its frames")
+        yield from lane_detector.detect_lanes_batch(frames)
+
+def replay(path, config):
+    # replays a recording open loop: the recorded detections (or those of config["model"]) go through the
+    # visual task and the controller; returns the error and steering statistics of the run
+
+    unknown = set(config) - set(CONFIG_KEYS)
+    if unknown:
+        raise ValueError(f"Unknown replay configuration keys {sorted(unknown)}")
+
+    reader = telemetryreader(path)
+    records = reader.records
+    if "model" in config:
+        lane_detector = get_detector(config["model"])
+        detections = redetect(reader, config["model"])
+        width = lane_detector.cfg.img_w
+    else:
+        detections = map(reader.detection, range(len(reader)))
+        width = reader.img_w
+
+    vts = vistaskspec(width, config.get("fit_degree", 1))
+    controller = pdcontroller(actuator=mockactuator(), controls=False)
+
+    errors = np.full(len(records), np.nan)
+    turns = np.zeros(len(records))
+    speeds = np.zeros(len(records))
+    for i, detection in enumerate(detections):
+        record = records[i]
+        controller.set_gains(*(float(config.get(key, record[key])) for key in ["kp", "kd", "skp", "speed"]),
+                             int(config.get("mode", record["mode"])))
+        err = vts.get_error(detection, None, controller.get_mode())
+        if err is not None:
+            controller.update_controls(err)
+            errors[i] = err
+        turns[i] = controller.t
+        speeds[i] = controller.final_speed
+
+    return summarize(errors, turns, speeds, records["t"])
+
+def summarize(errors, turns, speeds, recorded_turns):
+    # error, steering and speed statistics of a replay (the error ones over the ticks that had an error)
+
+    measured = errors[~np.isnan(errors)]
+    return {
+        "ticks": len(errors),
+        "error_rate": float(len(measured)/len(errors)) if len(errors) else 0.,
+        "error_mean": float(measured.mean()) if len(measured) else None,
+        "error_abs_mean": float(np.abs(measured).mean()) if len(measured) else None,
+        "error_rms": float(np.sqrt(np.mean(measured**2))) if len(measured) else None,
+        "turn_abs_mean": float(np.abs(turns).mean()) if len(turns) else 0.,
+        # mean tick-to-tick change of the turn rate, a measure of how jerky the steering is
+        "turn_jerk": float(np.abs(np.diff(turns)).mean()) if len(turns) > 1 else 0.,
+        "speed_mean": float(speeds.mean()) if len(speeds) else 0.,
+        # difference from the turn rates of the recorded run
+        "turn_diff_mean": float(np.abs(turns - recorded_turns).mean()) if len(turns) else 0.,
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="replay a telemetry recording through the visual tasks and the pd controller")
+    parser.add_argument("recording", help="telemetry recording (with frames if --model is given)")
+    parser.add_argument("--config", default="{}", help=f"replay configuration as JSON, with keys from {', '.join(CONFIG_KEYS)}")
+    args = parser.parse_args()
+
+    print(json.dumps(replay(args.recording, json.loads(args.config)), indent=2))
@@ -0,0 +1,288 @@
+'''
+  File name: sweeprunner.py
+  Author(s):  Jeramy Luo - entire file
+  Purpose: Coordinator and workers of resumable replay sweeps, sharding (recording, configuration) work units over a TCP or Unix socket queue.
+'''
+
+import argparse
+import hashlib
+import ipaddress
+import itertools
+import json
+import logging
+import multiprocessing as mp
+import os
+import secrets
+import socket
+import threading
+import time
+import traceback
+
+from multiprocessing.managers import BaseManager
+
+import replayeval
+
+log = logging.getLogger("sweeprunner")
+
+
+def load_units(spec):
+    # expands a sweep specification, {"recordings": [...], "grid": {key: [values]}}, into the
+    # (recording, configuration) work units of every recording and every combination of the grid values
+
+    keys = sorted(spec.get("grid", {}))
+    units = []
+    for recording in spec["recordings"]:
+        for values in itertools.product(*(spec["grid"][key] for key in keys)):
+            units.append({"recording": recording, "config": dict(zip(keys, values))})
+    return units
+
+def unit_id(unit):
+    # stable id of a work unit, used to find it in the checkpoint of an earlier run
+    return hashlib.sha1(json.dumps(unit, sort_keys=True).encode()).hexdigest()[:16]
+
+def parse_address(address):
+    # host:port for TCP, anything else is a Unix socket path
+    host, sep, port = address.rpartition(":")
+    if sep and port.isdigit():
+        return (host or "0.0.0.0", int(port))
+    return address
+
+def is_local(address):
+    # whether only this host can reach the address: a Unix socket path or a loopback TCP address
+    if isinstance(address, str):
+        return True
+    try:
+        return ipaddress.ip_address(socket.gethostbyname(address[0])).is_loopback
+    except (OSError, ValueError):
+        return False
+
+def load_authkey(path=None):
+    # key the coordinator and workers authenticate with, from SWEEP_AUTHKEY or a key file (None if neither is given);
+    # the manager connections unpickle what they receive, so anyone holding the key can run code on the other side
+    if os.environ.get("SWEEP_AUTHKEY"):
+        return os.environ["SWEEP_AUTHKEY"].encode()
+    if path is not None:
+        with open(path, "rb") as f:
+            return f.read().strip()
+    return None
+
+class sweepstate():
+    def __init__(self, units, checkpoint, lease_timeout=600, max_attempts=3):
+        # work units by id and the ids not yet leased to a worker
+        self.units = {unit_id(unit): unit for unit in units}
+        self.lease_timeout = lease_timeout
+        self.max_attempts = max_attempts
+        self.lock = threading.Lock()
+
+        # units finished by an earlier run of the sweep are skipped
+        self.done = set()
+        if os.path.exists(checkpoint):
+            with open(checkpoint) as f:
+                for line in f:
+                    # a line cut short by an interrupted write is ignored (the unit runs again)
+                    try:
+                        self.done.add(json.loads(line)["id"])
+                    except (ValueError, KeyError):
+                        pass
+        self.resumed = len(self.done & set(self.units))
+        self.pending = [uid for uid in self.units if uid not in self.done]
+
+        # leased units (id -> (worker, lease time)), attempts per unit and active workers
+        self.leases = {}
+        self.attempts = {}
+        self.workers = set()
+
+        # finished units are appended to the checkpoint as JSON lines
+        self.checkpoint = open(checkpoint, "a")
+
+    def lease(self, worker):
+        # hands the next unit to a worker as (id, unit); units whose lease expired (e.g. the worker died) are handed out again
+        # returns None if every remaining unit is leased
+
+        with self.lock:
+            self.workers.add(worker)
+            now = time.time()
+            for uid, (_, leased) in list(self.leases.items()):
+                if now - leased > self.lease_timeout:
+                    del self.leases[uid]
+                    self.pending.append(uid)
+
+            if not self.pending:
+                return None
+            uid = self.pending.pop(0)
+            self.leases[uid] = (worker, now)
+            self.attempts[uid] = self.attempts.get(uid, 0) + 1
+            return uid, self.units[uid]
+
+    def complete(self, uid, worker, result):
+        # checkpoints the result of a unit; a duplicate result of a unit that was handed out again is dropped
+        with self.lock:
+            if uid in self.done:
+                return
+            self.leases.pop(uid, None)
+            self.write(uid, worker, result=result)
+
+    def fail(self, uid, worker, message):
+        # hands a failed unit out again, or checkpoints the error after max_attempts tries
+        with self.lock:
+            if uid in self.done or uid not in self.leases:
+                return
+            del self.leases[uid]
+            log.warning("%s failed on %s: %s", uid, worker, message.splitlines()[-1])
+            if self.attempts[uid] < self.max_attempts:
+                self.pending.append(uid)
+            else:
+                self.write(uid, worker, error=message)
+
+    def write(self, uid, worker, result=None, error=None):
+        # appends a finished unit to the checkpoint, synced to disk so an interrupted sweep keeps it
+
+        unit = self.units[uid]
+        line = {"id": uid, "recording": unit["recording"], "config": unit["config"], "worker": worker, "result": result}
+        if error is not None:
+            line["error"] = error
+        self.checkpoint.write(json.dumps(line) + "\n")
+        self.checkpoint.flush()
+        os.fsync(self.checkpoint.fileno())
+        self.done.add(uid)
+
+    def finished(self):
+        # whether every unit of the sweep is checkpointed
+        with self.lock:
+            return not self.pending and not self.leases
+
+    def progress(self):
+        # returns the number of done, leased and pending units and the workers seen so far
+        with self.lock:
+            return {"done": len(self.done & set(self.units)), "leased": len(self.leases), "pending": len(self.pending),
+                    "total": len(self.units), "workers": len(self.workers)}
+
+    def close(self):
+        self.checkpoint.close()
+
+class sweepmanager(BaseManager):
+    pass
+
+def serve(units, checkpoint, address, authkey, local_workers=0, lease_timeout=600, max_attempts=3, report_every=10, share_weights=False):
+    # runs the coordinator of a sweep until every unit is checkpointed; workers connect to address
+    # (local_workers are started on this host, sharing the model weights mapped here with share_weights);
+    # returns the number of units run
+
+    state = sweepstate(units, checkpoint, lease_timeout, max_attempts)
+    log.info("%d units, %d already in %s", len(state.units), state.resumed, checkpoint)
+    if share_weights:
+        replayeval.share_weights({unit["config"]["model"] for unit in units if "model" in unit["config"]})
+
+    # serving the sweep state on the socket from a thread of this process
+    sweepmanager.register("sweep", callable=lambda: state)
+    server = sweepmanager(address=address, authkey=authkey).get_server()
+    thread = threading.Thread(target=server.serve_forever, name="sweepserver", daemon=True)
+    thread.start()
+
+    # Unix socket servers are reached at their path, TCP servers on any interface through localhost
+    local_address = address if isinstance(address, str) else ("127.0.0.1", server.address[1])
+    processes = [mp.Process(target=work, args=(local_address, authkey, f"{socket.gethostname()}:local{i}"), daemon=True)
+                 for i in range(local_workers)]
+    for process in processes:
+        process.start()
+
+    try:
+        last_report = time.time()
+        while not state.finished():
+            time.sleep(0.2)
+            if time.time() - last_report > report_every:
+                log.info("%s", state.progress())
+                last_report = time.time()
+    finally:
+        # workers stop when they see the sweep finished; interrupted local workers are stopped with it
+        for process in processes:
+            process.join(5)
+            if process.is_alive():
+                process.terminate()
+        server.stop_event.set()
+        thread.join()
+        state.close()
+
+    log.info("%s", state.progress())
+    return len(state.units) - state.resumed
+
+def work(address, authkey, name=None, poll=1.0, share_weights=False):
+    # worker loop: runs leased units with replayeval.replay until the sweep is finished or the coordinator goes away
+    # (with share_weights the models are loaded on weights mapped from the node-local cache, shared by the workers of a host)
+
+    name = name or f"{socket.gethostname()}:{os.getpid()}"
+    sweepmanager.register("sweep")
+    manager = sweepmanager(address=address, authkey=authkey)
+    manager.connect()
+    state = manager.sweep()
+
+    count = 0
+    try:
+        while not state.finished():
+            lease = state.lease(name)
+            if lease is None:
+                # the remaining units are leased to other workers, which may still fail
+                time.sleep(poll)
+                continue
+
+            uid, unit = lease
+            try:
+                if share_weights and "model" in unit["config"]:
+                    replayeval.share_weights([unit["config"]["model"]])
+                result = replayeval.replay(unit["recording"], unit["config"])
+            except Exception:
+                state.fail(uid, name, traceback.format_exc())
+                continue
+            state.complete(uid, name, result)
+            count += 1
+    except (EOFError, ConnectionError):
+        # the coordinator stopped; its checkpoint has everything that was completed
+        pass
+    return count
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="run resumable replay sweeps over recordings and configurations")
+    parser.add_argument("--quiet", action="store_true", help="only log failures, not progress")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    serve_parser = subparsers.add_parser("serve", help="coordinate a sweep (and optionally run local workers)")
+    serve_parser.add_argument("spec", help='sweep specification JSON: {"recordings": [...], "grid": {"mode": [...], "kp": [...], ...}}')
+    serve_parser.add_argument("--checkpoint", default="sweep.jsonl", help="JSON lines file of the finished units; an existing file resumes the sweep")
+    serve_parser.add_argument("--bind", default="127.0.0.1:50000", help="host:port (0.0.0.0:port to let other hosts join) or a Unix socket path")
+    serve_parser.add_argument("--workers", type=int, default=os.cpu_count(), help="worker processes started on this host")
+    serve_parser.add_argument("--lease-timeout", type=float, default=600, help="seconds after which a unit a worker hasn't finished is handed out again")
+    serve_parser.add_argument("--share-weights", action="store_true", help="map the model weights once and share them with the local workers")
+    serve_parser.add_argument("--authkey-file", help="file holding the key workers authenticate with (or set SWEEP_AUTHKEY); "
+                              "required unless binding to loopback or a Unix socket, where a random key is printed instead")
+    serve_parser.add_argument("--max-attempts", type=int, default=3, help="tries of a failing unit before its error is checkpointed")
+
+    work_parser = subparsers.add_parser("work", help="join a sweep as a worker (recording and model paths must resolve on this host)")
+    work_parser.add_argument("--connect", default="127.0.0.1:50000", help="host:port or Unix socket path of the coordinator")
+    work_parser.add_argument("--share-weights", action="store_true", help="share the model weights with the other workers of this host")
+    work_parser.add_argument("--authkey-file", help="file holding the key of the coordinator (or set SWEEP_AUTHKEY)")
+    work_parser.add_argument("--name", help="worker name recorded in the checkpoint")
+    args = parser.parse_args()
+
+    # progress and failures go through logging; the results below are printed
+    logging.basicConfig(level=logging.WARNING if args.quiet else logging.INFO, format="%(asctime)s %(name)s: %(message)s")
+    authkey = load_authkey(args.authkey_file)
+    if args.command == "serve":
+        address = parse_address(args.bind)
+        if authkey is None and not is_local(address):
+            parser.error(f"binding to {args.bind} needs a key, set SWEEP_AUTHKEY or give --authkey-file")
+        if authkey is None:
+            authkey = secrets.token_hex(16).encode()
+            print(f"workers join with SWEEP_AUTHKEY={authkey.decode()}")
+        with open(args.spec) as f:
+            units = load_units(json.load(f))
+        start = time.perf_counter()
+        try:
+            count = serve(units, args.checkpoint, address, authkey, args.workers, args.lease_timeout, args.max_attempts,
+                          share_weights=args.share_weights)
+        except KeyboardInterrupt:
+            raise SystemExit(f"interrupted; run the same command again to resume from {args.checkpoint}")
+        print(f"{count} units in {time.perf_counter() - start:.1f} s")
+    else:
+        if authkey is None:
+            parser.error("set SWEEP_AUTHKEY or give --authkey-file with the key of the coordinator")
+        print(f"{work(parse_address(args.connect), authkey, args.name, share_weights=args.share_weights)} units done")
@@ -0,0 +1,231 @@
+'''
+  File name: telemetry.py
+  Author(s):  Jeramy Luo - entire file
+  Purpose: Contains the binary telemetry recorder and the memory-mapped reader used to analyse and replay runs.
+'''
+
+import json
+import os
+import queue
+import struct
+import threading
+import numpy as np
+
+from ultrafastLaneDetector import LaneDetection
+from threadbudget import pin_thread
+
+# file signature and version of the record file (version 1 records have no lane point confidences)
+MAGIC = b"VTSTLM01"
+VERSION = 2
+
+# records start on a multiple of this many bytes
+HEADER_ALIGN = 64
+
+def record_dtype(num_lanes, num_anchors, version=VERSION):
+    # returns the fixed record layout of a single control loop tick
+
+    confidence = [("confidence", "<f2", (num_lanes, num_anchors))] if version >= 2 else []
+    return np.dtype([
+        ("timestamp", "<f8"),
+        ("frame", "<i8"),
+        ("points", "<i2", (num_lanes, num_anchors, 2)),
+        ("valid", "?", (num_lanes, num_anchors)),
+        ("detected", "?", (num_lanes,)),
+    ] + confidence + [
+        ("mode", "u1"),
+        ("error", "<f4"),
+        ("t", "<f4"),
+        ("final_speed", "<f4"),
+        ("kp", "<f4"),
+        ("kd", "<f4"),
+        ("skp", "<f4"),
+        ("speed", "<f4"),
+    ])
+
+class telemetryrecorder():
+    def __init__(self, path, num_lanes, num_anchors, img_w, img_h, frames=False, chunk_frames=256, queue_size=1024, cpus=None):
+        # record layout (the lane points are in the img_w x img_h image space of the model)
+        self.dtype = record_dtype(num_lanes, num_anchors)
+
+        # opening the record file and writing the header
+        self.path = path
+        self.file = open(path, "wb")
+        header = json.dumps({"version": VERSION, "num_lanes": num_lanes, "num_anchors": num_anchors,
+                             "img_w": img_w, "img_h": img_h}).encode()
+        size = len(MAGIC) + 4 + len(header)
+        header += b" " * (-size % HEADER_ALIGN)
+        self.file.write(MAGIC + struct.pack("<I", len(header)) + header)
+
+        # frame store (frames are written to fixed-size chunk files next to the record file)
+        self.frames = frames
+        self.frame_dir = path + ".frames"
+        self.chunk_frames = chunk_frames
+        self.frame_count = 0
+        self.chunk = None
+        if frames:
+            os.makedirs(self.frame_dir, exist_ok=True)
+
+        # ticks waiting to be written and the number of ticks dropped because the writer fell behind
+        self.queue = queue.Queue(queue_size)
+        self.dropped = 0
+
+        # starting the writer thread (pinned to cpus if given)
+        self.cpus = cpus
+        self.thread = threading.Thread(target=self.run, name="telemetryrecorder", daemon=True)
+        self.thread.start()
+
+    def record(self, timestamp, detection, mode, error, controller, frame=None, context=None):
+        # queues one control loop tick; only stores references so the control loop never waits on the disk
+        # a framecontext holding the detection and frame is held until the tick is written
+
+        if context is not None:
+            context.hold()
+        tick = (timestamp, detection, mode, error, controller.t, controller.final_speed,
+                controller.kp, controller.kd, controller.skp, controller.speed, frame if self.frames else None, context)
+        try:
+            self.queue.put_nowait(tick)
+        except queue.Full:
+            self.dropped += 1
+            if context is not None:
+                context.release()
+
+    def run(self):
+        # main loop of the writer thread; writes the queued ticks in batches
+
+        pin_thread(self.cpus)
+        while True:
+            ticks = [self.queue.get()]
+            while True:
+                try:
+                    ticks.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            # a None tick marks the end of the recording
+            done = ticks[-1] is None
+            if done:
+                ticks.pop()
+
+            if ticks:
+                self.write(ticks)
+            if done:
+                break
+
+    def write(self, ticks):
+        # packs the ticks into fixed-size records and appends them to the file
+
+        records = np.zeros(len(ticks), self.dtype)
+        for i, (timestamp, detection, mode, error, t, final_speed, kp, kd, skp, speed, frame, context) in enumerate(ticks):
+            record = records[i]
+            record["timestamp"] = timestamp
+            record["frame"] = self.write_frame(frame) if frame is not None else -1
+            record["points"] = detection.points
+            record["valid"] = detection.valid
+            record["detected"] = detection.detected
+            record["confidence"] = detection.confidence
+            record["mode"] = mode
+            record["error"] = np.nan if error is None else error
+            record["t"] = t
+            record["final_speed"] = final_speed
+            record["kp"] = kp
+            record["kd"] = kd
+            record["skp"] = skp
+            record["speed"] = speed
+            if context is not None:
+                context.release()
+        records.tofile(self.file)
+        self.file.flush()
+
+    def write_frame(self, frame):
+        # appends a frame to the current chunk file and returns its index in the frame store
+
+        if self.frame_count == 0:
+            # the first frame fixes the frame shape of the store
+            with open(os.path.join(self.frame_dir, "index.json"), "w") as f:
+                json.dump({"shape": list(frame.shape), "dtype": str(frame.dtype), "chunk_frames": self.chunk_frames}, f)
+
+        if self.frame_count % self.chunk_frames == 0:
+            if self.chunk is not None:
+                self.chunk.close()
+            self.chunk = open(os.path.join(self.frame_dir, f"chunk_{self.frame_count // self.chunk_frames:06d}.bin"), "wb")
+
+        np.ascontiguousarray(frame).tofile(self.chunk)
+        self.frame_count += 1
+        return self.frame_count - 1
+
+    def close(self):
+        # writes the remaining ticks and closes the files
+
+        self.queue.put(None)
+        self.thread.join()
+        self.file.close()
+        if self.chunk is not None:
+            self.chunk.close()
+
+class telemetryreader():
+    def __init__(self, path):
+        # reading the header
+        with open(path, "rb") as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{path} is not a telemetry recording")
+            header_len = struct.unpack("<I", f.read(4))[0]
+            header = json.loads(f.read(header_len))
+        if header["version"] not in (1, VERSION):
+            raise ValueError(f"unsupported telemetry version {header['version']}")
+        self.version = header["version"]
+
+        self.num_lanes = header["num_lanes"]
+        self.num_anchors = header["num_anchors"]
+        # image space of the lane points; recordings from before it was stored were all made with the TuSimple model
+        self.img_w = header.get("img_w", 1280)
+        self.img_h = header.get("img_h", 720)
+        self.dtype = record_dtype(self.num_lanes, self.num_anchors, self.version)
+
+        # memory-mapping the records; a partially written last record is ignored
+        offset = len(MAGIC) + 4 + header_len
+        count = (os.path.getsize(path) - offset) // self.dtype.itemsize
+        if count > 0:
+            self.records = np.memmap(path, dtype=self.dtype, mode="r", offset=offset, shape=(count,))
+        else:
+            self.records = np.zeros(0, self.dtype)
+
+        # frame store, if the run recorded frames
+        self.frame_dir = path + ".frames"
+        self.frame_shape = None
+        self.chunks = {}
+        index_path = os.path.join(self.frame_dir, "index.json")
+        if os.path.exists(index_path):
+            with open(index_path) as f:
+                index = json.load(f)
+            self.frame_shape = tuple(index["shape"])
+            self.frame_dtype = np.dtype(index["dtype"])
+            self.chunk_frames = index["chunk_frames"]
+
+    def __len__(self):
+        return len(self.records)
+
+    def detection(self, i):
+        # returns the lane detection of record i as views into the memory map
+        record = self.records[i]
+        confidence = record["confidence"].astype(np.float32) if self.version >= 2 else None
+        return LaneDetection(record["points"], record["valid"], record["detected"], confidence)
+
+    def frame(self, i):
+        # returns the frame stored with record i (None if no frame was stored)
+
+        frame_id = int(self.records[i]["frame"])
+        if frame_id < 0 or self.frame_shape is None:
+            return None
+
+        chunk_id, frame_idx = divmod(frame_id, self.chunk_frames)
+        if chunk_id not in self.chunks:
+            chunk_path = os.path.join(self.frame_dir, f"chunk_{chunk_id:06d}.bin")
+            frame_size = int(np.prod(self.frame_shape)) * self.frame_dtype.itemsize
+            count = os.path.getsize(chunk_path) // frame_size
+            self.chunks[chunk_id] = np.memmap(chunk_path, dtype=self.frame_dtype, mode="r", shape=(count,) + self.frame_shape)
+        return self.chunks[chunk_id][frame_idx]
+
+    def replay(self):
+        # yields the record, lane detection and frame of every tick in order
+        for i in range(len(self.records)):
+            yield self.records[i], self.detection(i), self.frame(i)
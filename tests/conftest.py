@@ -0,0 +1,10 @@
+'''
+  File name: conftest.py
+  Author(s):  Jeramy Luo - entire file
+  Purpose: Makes the top-level modules of the repository importable from the tests.
+'''
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
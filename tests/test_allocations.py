@@ -0,0 +1,68 @@
+'''
+  File name: test_allocations.py
+  Author(s):  Jeramy Luo - entire file
+  Purpose: Tests that the zero-allocation control loop (--zero-alloc) stays under its per-frame allocation budget.
+'''
+
+import numpy as np
+import pytest
+
+from ultrafastLaneDetector import UltrafastLaneDetector, ModelType, InferenceBackend
+from visualtaskspec import vistaskspec
+from framecontext import framecontextpool
+from grabscreen import CAPTURE_SHAPE, FRAME_SHAPE
+from checkallocations import measure
+
+# largest peak allocation within a frame; a fraction of the smallest per-frame buffer (the 288x800 input tensor is
+# 2.7 MiB), leaving room for the small Python objects of the visual tasks and the controller
+MAX_BYTES = 64*1024
+
+class stubbackend(InferenceBackend):
+    # stand-in for the TuSimple model: fixed griding logits with the two ego lanes slanting towards each other up the
+    # image and the outer lanes missing
+    input_shape = [1, 3, 288, 800]
+    output_names = ["output"]
+    output_shapes = [[1, 101, 56, 4]]
+
+    def __init__(self):
+        self.output = np.zeros((1, 101, 56, 4), np.float32)
+        anchors = np.arange(56)
+        self.output[0, 30 + anchors//4, anchors, 1] = 10
+        self.output[0, 70 - anchors//4, anchors, 2] = 10
+        self.output[0, 100, :, 0] = 10
+        self.output[0, 100, :, 3] = 10
+
+    def run(self, input_tensor):
+        return [self.output]
+
+@pytest.fixture(scope="module")
+def lane_detector():
+    return UltrafastLaneDetector(None, ModelType.TUSIMPLE, backend=stubbackend())
+
+@pytest.fixture(scope="module")
+def frames():
+    rng = np.random.default_rng(0)
+    return [rng.integers(0, 256, FRAME_SHAPE, dtype=np.uint8) for _ in range(8)]
+
+def test_stub_detection_has_an_error(lane_detector, frames):
+    # the measured path runs the visual task, which needs both ego lanes
+    _, detection = lane_detector.detect_lanes(frames[0], draw=False)
+    assert detection.detected.tolist() == [False, True, True, False]
+    for mode in range(6):
+        assert vistaskspec(lane_detector.cfg.img_w).get_error(detection, None, mode) is not None
+
+@pytest.mark.parametrize("draw", [True, False])
+def test_zero_alloc_frames_stay_under_budget(lane_detector, frames, draw):
+    for mode in range(6):
+        contexts = framecontextpool(lane_detector, FRAME_SHAPE, CAPTURE_SHAPE)
+        peaks = measure(lane_detector, frames, contexts, mode=mode, warmup=10, draw=draw)
+        assert peaks.max() < MAX_BYTES, f"mode {mode} allocates up to {peaks.max()} bytes per frame"
+
+        # the renderer and recorder hand-off rotates the pooled contexts without running out of them
+        assert contexts.exhausted == 0
+        assert all(context.users == 0 for context in contexts.contexts)
+
+def test_allocating_path_is_seen(lane_detector, frames):
+    # the same measurement of the allocating path sees at least the new frame of every tick
+    peaks = measure(lane_detector, frames, warmup=2)
+    assert peaks.min() > np.prod(FRAME_SHAPE)
@@ -0,0 +1,91 @@
+'''
+  File name: test_multistream.py
+  Author(s):  Jeramy Luo - entire file
+  Purpose: Tests the batching of the multi-stream scheduler on file-backed frame sources.
+'''
+
+import threading
+import time
+import numpy as np
+
+from ultrafastLaneDetector import LaneDetection
+from ultrafastLaneDetector.ultrafastLaneDetector import ModelConfig, ModelType
+from multistream import filesource, stream, streamscheduler
+from telemetry import telemetryrecorder
+from pid import pdcontroller
+from mockactuator import mockactuator
+
+class stubdetector():
+    def __init__(self):
+        # stand-in for UltrafastLaneDetector that detects no lanes and keeps the size of every batch
+        self.cfg = ModelConfig(ModelType.TUSIMPLE)
+        self.batches = []
+        self.lock = threading.Lock()
+
+    def detect_lanes_batch(self, frames):
+        with self.lock:
+            self.batches.append(len(frames))
+        return [LaneDetection.empty(4, len(self.cfg.row_anchor)) for _ in frames]
+
+def write_recording(path, count):
+    # telemetry recording of count ticks with small frames, numbered by their first pixel
+    controller = pdcontroller(actuator=mockactuator(), controls=False)
+    recorder = telemetryrecorder(str(path), 4, 56, 1280, 720, frames=True)
+    for i in range(count):
+        frame = np.full((8, 8, 3), i, np.uint8)
+        recorder.record(float(i), LaneDetection.empty(4, 56), 0, None, controller, frame)
+    recorder.close()
+    return str(path)
+
+def make_streams(tmp_path, counts, fps):
+    # one stream per (frame count, frame rate) reading its own recording
+    streams = []
+    for i, (count, rate) in enumerate(zip(counts, fps)):
+        source = filesource(write_recording(tmp_path / f"stream{i}.tlm", count), rate)
+        controller = pdcontroller(actuator=mockactuator(), controls=False)
+        controller.set_gains(0.002, 0.004, 2, 0.5)
+        streams.append(stream(str(i), source, 0, controller))
+    return streams
+
+def test_filesource_reads_recorded_frames(tmp_path):
+    source = filesource(write_recording(tmp_path / "frames.tlm", 5), fps=0)
+    frames = [source() for _ in range(6)]
+    assert [int(frame[0, 0, 0]) for frame in frames[:5]] == [0, 1, 2, 3, 4]
+    assert frames[5] is None
+
+def test_batches_start_once_every_stream_has_a_frame(tmp_path):
+    # with a budget far longer than the run, only frames of all streams being ready can start a batch
+    streams = make_streams(tmp_path, [20, 20, 20], [50, 50, 50])
+    detector = stubdetector()
+    scheduler = streamscheduler(detector, streams, max_batch=8, latency_budget=30)
+
+    start = time.perf_counter()
+    scheduler.run()
+    assert time.perf_counter() - start < 10
+
+    for s in streams:
+        assert s.frames > 0
+        assert s.batch_sizes[0] == 3
+    assert max(detector.batches) == 3
+
+def test_batches_start_on_the_latency_budget(tmp_path):
+    # a slow stream must not hold back the frames of the fast ones beyond the budget
+    budget = 0.02
+    streams = make_streams(tmp_path, [30, 30, 3], [60, 60, 2])
+    detector = stubdetector()
+    scheduler = streamscheduler(detector, streams, max_batch=8, latency_budget=budget)
+    scheduler.run()
+
+    fast = streams[:2]
+    assert min(detector.batches) < 3
+    for s in fast:
+        assert s.frames > 10
+        # the slow stream delivers a frame every 0.5 s, so waiting for it would show up in the waits
+        assert max(s.waits) < budget + 0.2
+    assert streams[2].frames == 3
+
+def test_batches_are_capped(tmp_path):
+    streams = make_streams(tmp_path, [5]*4, [0]*4)
+    detector = stubdetector()
+    streamscheduler(detector, streams, max_batch=2, latency_budget=30).run()
+    assert max(detector.batches) <= 2
@@ -0,0 +1,43 @@
+'''
+  File name: test_pid.py
+  Author(s):  Jeramy Luo - entire file
+  Purpose: Tests the latency-compensated error prediction of the pd controller.
+'''
+
+import time
+import numpy as np
+import pytest
+
+from pid import pdcontroller
+from mockactuator import mockactuator
+
+def run_plant(monkeypatch, plant_gain, drift, model_gain=None):
+    # feeds the controller errors of a plant with the given drift and gain under a steering sequence, and returns the
+    # predicted error and the plant's actual error at actuation time
+    now = 100.0
+    monkeypatch.setattr(time, "perf_counter", lambda: now)
+    controller = pdcontroller(actuator=mockactuator(), controls=False, compensate=True,
+                              plant_gain=plant_gain if model_gain is None else model_gain)
+
+    # a command every 50 ms, each frame captured 30 ms before its command
+    commands = [(now - 0.25 + 0.05*i, turn) for i, turn in enumerate([0.1, -0.2, 0.3, 0.05, -0.1])]
+    controller.command_history.extend(commands)
+    start = commands[0][0] - 0.03
+
+    def actual(t):
+        return 2.0 + drift*(t - start) - plant_gain*controller.steering(start, t)
+
+    for command_time, _ in commands[1:]:
+        controller.error_history.append((command_time - 0.03, actual(command_time - 0.03)))
+    capture_time = now - 0.03
+    return controller.predict_error(actual(capture_time), capture_time), actual(now)
+
+@pytest.mark.parametrize("plant_gain", [0.0, 40.0])
+def test_prediction_matches_the_plant(monkeypatch, plant_gain):
+    predicted, actual = run_plant(monkeypatch, plant_gain, drift=25.0)
+    assert predicted == pytest.approx(actual)
+
+def test_steering_is_not_counted_twice(monkeypatch):
+    # a plant that only responds to the steering: the error trend it causes is the steering, not drift
+    predicted, actual = run_plant(monkeypatch, 40.0, drift=0.0)
+    assert predicted == pytest.approx(actual)
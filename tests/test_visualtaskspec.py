@@ -0,0 +1,47 @@
+'''
+  File name: test_visualtaskspec.py
+  Author(s):  Jeramy Luo - entire file
+  Purpose: Tests the lane fits of the line visual tasks.
+'''
+
+import numpy as np
+import pytest
+
+from ultrafastLaneDetector import LaneDetection
+from visualtaskspec import vistaskspec
+
+def straight_lanes(outlier_confidence):
+    # both ego lanes on straight lines, with one point of the left lane far off the line
+    detection = LaneDetection.empty(4, 56)
+    y = np.linspace(710, 160, 56)
+    detection.points[:, :, 1] = y
+    detection.points[1, :, 0] = 500 - 0.5*(710 - y)
+    detection.points[2, :, 0] = 780 + 0.5*(710 - y)
+    detection.valid[1:3, :40] = True
+    detection.detected[1:3] = True
+    detection.confidence[1:3, :40] = 1
+    detection.points[1, 20, 0] += 600
+    detection.confidence[1, 20] = outlier_confidence
+    return detection
+
+@pytest.mark.parametrize("fit_degree", [1, 2])
+def test_lane_line_weights_the_points_by_confidence(fit_degree):
+    vts = vistaskspec(1280, fit_degree)
+    lanes = lambda detection: (detection.lane(1).transpose(), detection.lane(2).transpose())
+
+    # the centre line of the straight lanes is the vertical line x = 640
+    detection = straight_lanes(1e-4)
+    start, end = vts.lane_line(*lanes(detection), detection)
+    assert start[0] == pytest.approx(640, abs=1) and end[0] == pytest.approx(640, abs=1)
+
+    # the same point trusted fully pulls the fit off
+    detection = straight_lanes(1)
+    start, end = vts.lane_line(*lanes(detection), detection)
+    assert abs(start[0] - 640) > 5 or abs(end[0] - 640) > 5
+
+def test_line_tasks_run_on_recorded_detections():
+    # detections without confidences (e.g. from older recordings) count every valid point fully
+    detection = straight_lanes(1)
+    recorded = LaneDetection(detection.points, detection.valid, detection.detected)
+    vts = vistaskspec(1280)
+    assert vts.get_error(recorded, None, 5) == pytest.approx(vts.get_error(detection, None, 5))
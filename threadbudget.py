@@ -0,0 +1,125 @@
+'''
+  File name: threadbudget.py
+  Author(s):  Jeramy Luo - entire file
+  Purpose: Splits the CPU cores between onnxruntime, OpenCV and the pipeline threads and pins each stage to its cores.
+'''
+
+import os
+import cv2
+
+# Windows thread and process affinity (the capture setup of grabscreen.py); Linux uses os.sched_setaffinity
+try:
+    import win32api
+    import win32process
+except ImportError:
+    win32process = None
+
+def parse_cpus(spec):
+    # parses a CPU list such as "0-3,6" into a sorted list of CPU numbers (None for an empty spec)
+    if not spec:
+        return None
+    cpus = set()
+    for part in spec.split(","):
+        first, _, last = part.partition("-")
+        cpus.update(range(int(first), int(last or first) + 1))
+    return sorted(cpus)
+
+def pin_thread(cpus):
+    # restricts the calling thread to the given CPUs (threads it starts afterwards inherit them on Linux but not on
+    # Windows, so threads pin themselves from their own run functions)
+    if cpus is None:
+        return
+    if hasattr(os, "sched_setaffinity"):
+        # pid 0 is the calling thread
+        os.sched_setaffinity(0, cpus)
+    elif win32process is not None:
+        win32process.SetThreadAffinityMask(win32api.GetCurrentThread(), sum(1 << cpu for cpu in cpus))
+    else:
+        raise RuntimeError("Setting the CPU affinity is not supported on this platform")
+
+def pin_process(pid, cpus):
+    # restricts another process (e.g. the capture process of framering.py) to the given CPUs
+    if cpus is None:
+        return
+    if hasattr(os, "sched_setaffinity"):
+        # only the main thread of the process on Linux, which the capture loop runs on
+        os.sched_setaffinity(pid, cpus)
+    elif win32process is not None:
+        import win32con
+        handle = win32api.OpenProcess(win32con.PROCESS_SET_INFORMATION | win32con.PROCESS_QUERY_INFORMATION, False, pid)
+        win32process.SetProcessAffinityMask(handle, sum(1 << cpu for cpu in cpus))
+    else:
+        raise RuntimeError("Setting the CPU affinity is not supported on this platform")
+
+class threadbudget():
+    def __init__(self, intra_op=None, inter_op=1, cv_threads=None, spinning=True,
+                 inference_cpus=None, control_cpus=None, background_cpus=None, capture_cpus=None):
+        # onnxruntime intra-op threads (including the calling thread) and inter-op threads, OpenCV threads
+        # (None leaves the library defaults, which use every core) and whether idle onnxruntime threads spin;
+        # with inference CPUs and no intra-op count, the pool gets one thread per inference CPU
+        if inference_cpus is not None and intra_op is None:
+            intra_op = len(inference_cpus) + 1
+        if inference_cpus is not None and intra_op < 2:
+            raise ValueError("Pinning the inference CPUs needs at least 2 intra-op threads (the calling thread and a pool thread)")
+        self.intra_op = intra_op
+        self.inter_op = inter_op
+        self.cv_threads = cv_threads
+        self.spinning = spinning
+
+        # CPUs of the onnxruntime pool threads, the control loop, the renderer/recorder/encoder threads and the
+        # capture process (None leaves a stage unpinned)
+        self.inference_cpus = inference_cpus
+        self.control_cpus = control_cpus
+        self.background_cpus = background_cpus
+        self.capture_cpus = capture_cpus
+
+    def session_options(self):
+        # onnxruntime session options within the budget; the intra-op pool threads are pinned to the inference CPUs
+        # (the thread calling run also takes part in the inference, on its own CPUs)
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        options.execution_mode = onnxruntime.ExecutionMode.ORT_SEQUENTIAL
+        if self.intra_op is not None:
+            options.intra_op_num_threads = self.intra_op
+        if self.inter_op is not None:
+            options.inter_op_num_threads = self.inter_op
+        if not self.spinning:
+            options.add_session_config_entry("session.intra_op.allow_spinning", "0")
+            options.add_session_config_entry("session.inter_op.allow_spinning", "0")
+        if self.inference_cpus is not None:
+            # one entry per pool thread, with 1-based processor numbers; the pool threads take the inference CPUs in turn
+            cpus = [self.inference_cpus[i % len(self.inference_cpus)] + 1 for i in range(self.intra_op - 1)]
+            options.add_session_config_entry("session.intra_op_thread_affinities", ";".join(map(str, cpus)))
+        return options
+
+    def backend_options(self):
+        # backend_options of UltrafastLaneDetector (and swap_model) for the onnxruntime backend
+        return {"session_options": self.session_options()}
+
+    def apply_opencv(self):
+        # sets the size of the OpenCV thread pool used by resize, cvtColor and addWeighted
+        if self.cv_threads is not None:
+            cv2.setNumThreads(self.cv_threads)
+
+    def pin_background(self):
+        # pins the calling renderer or recorder thread to the background CPUs; called from the thread itself
+        pin_thread(self.background_cpus)
+
+    def pin_background_process(self, pid):
+        # pins a background process (the video encoder) to the background CPUs
+        pin_process(pid, self.background_cpus)
+
+    def pin_control(self):
+        # pins the calling (control loop) thread to the control CPUs, away from the inference CPUs
+        pin_thread(self.control_cpus)
+
+    def pin_capture(self, pid):
+        pin_process(pid, self.capture_cpus)
+
+    def describe(self):
+        # one line summary for logs and benchmark reports
+        cpus = lambda c: "all" if c is None else ",".join(map(str, c))
+        return (f"intra_op={self.intra_op or 'default'} inter_op={self.inter_op or 'default'} cv={self.cv_threads if self.cv_threads is not None else 'default'} "
+                f"spin={int(self.spinning)} inference={cpus(self.inference_cpus)} control={cpus(self.control_cpus)} "
+                f"background={cpus(self.background_cpus)} capture={cpus(self.capture_cpus)}")
@@ -0,0 +1,93 @@
+'''
+  File name: tracing.py
+  Author(s):  Jeramy Luo - entire file
+  Purpose: Optional per-frame span tracer that writes Chrome trace / Perfetto JSON timelines of the pipeline stages.
+'''
+
+import json
+import os
+import threading
+import time
+
+from collections import deque
+from contextlib import contextmanager, nullcontext
+
+class frametracer():
+    def __init__(self, max_events=200000):
+        # recorded spans as (name, frame id, thread id, start, end); only the newest max_events are kept
+        self.events = deque(maxlen=max_events)
+        self.thread_names = {}
+        self.frame_id = 0
+        self.origin = time.perf_counter()
+
+    def next_frame(self):
+        # starts a new frame; spans without an explicit frame id are tagged with it
+        self.frame_id += 1
+        return self.frame_id
+
+    @contextmanager
+    def span(self, name, frame_id=None):
+        # records the time spent in the with block
+        if frame_id is None:
+            frame_id = self.frame_id
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            tid = threading.get_ident()
+            if tid not in self.thread_names:
+                self.thread_names[tid] = threading.current_thread().name
+            self.events.append((name, frame_id, tid, start, end))
+
+    def dump(self, path):
+        # writes the spans as complete ("X") events in the Chrome trace event format
+
+        pid = os.getpid()
+        trace = [{"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": name}}
+                 for tid, name in list(self.thread_names.items())]
+        for name, frame_id, tid, start, end in list(self.events):
+            trace.append({
+                "name": name,
+                "ph": "X",
+                "ts": (start - self.origin)*1e6,
+                "dur": (end - start)*1e6,
+                "pid": pid,
+                "tid": tid,
+                "args": {"frame": frame_id},
+            })
+        with open(path, "w") as f:
+            json.dump({"traceEvents": trace, "displayTimeUnit": "ms"}, f)
+
+# active tracer; None while tracing is off, in which case span() costs a single check
+active = None
+null_span = nullcontext()
+
+def enable(max_events=200000):
+    # turns tracing on for the whole process
+    global active
+    active = frametracer(max_events)
+    return active
+
+def span(name, frame_id=None):
+    # context manager timing a pipeline stage (does nothing while tracing is off)
+    if active is None:
+        return null_span
+    return active.span(name, frame_id)
+
+def next_frame():
+    # starts a new frame and returns its id (0 while tracing is off)
+    if active is None:
+        return 0
+    return active.next_frame()
+
+def frame_id():
+    # returns the id of the current frame (0 while tracing is off)
+    if active is None:
+        return 0
+    return active.frame_id
+
+def dump(path):
+    # writes the trace, if tracing is on
+    if active is not None:
+        active.dump(path)
@@ -1 +1,4 @@
-from ultrafastLaneDetector.ultrafastLaneDetector import UltrafastLaneDetector, ModelType
\ No newline at end of file
+from ultrafastLaneDetector.ultrafastLaneDetector import UltrafastLaneDetector, ModelType, LaneDetection, DetectionBuffers, model_type_from_path
+from ultrafastLaneDetector.detectioncache import DetectionCache
+from ultrafastLaneDetector.backends import InferenceBackend, OnnxRuntimeBackend, OpenCVBackend, TorchBackend
+from ultrafastLaneDetector.sharedweights import SharedWeights
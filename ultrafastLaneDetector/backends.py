@@ -0,0 +1,146 @@
+import cv2
+import numpy as np
+import onnx
+import onnxruntime
+
+from abc import ABC, abstractmethod
+
+class InferenceBackend(ABC):
+	# Interface between UltrafastLaneDetector and an inference engine.
+	# Backends set input_shape, output_names and output_shapes, and run() returns one array per name in output_names
+	# (which UltrafastLaneDetector narrows to the outputs it uses).
+
+	input_shape = None
+	output_names = None
+	output_shapes = None
+
+	@abstractmethod
+	def run(self, input_tensor):
+		# Runs the model on an NCHW float32 batch and returns the outputs as arrays
+		pass
+
+	def bind(self, input_tensor, outputs):
+		# Returns a function running the model on input_tensor and writing the results into the preallocated outputs.
+		# Backends without output binding copy their results.
+		def run():
+			for output, result in zip(outputs, self.run(input_tensor)):
+				np.copyto(output, result)
+		return run
+
+class OnnxRuntimeBackend(InferenceBackend):
+
+	def __init__(self, model_path, session_options=None, providers=None):
+
+		# Every execution provider of the onnxruntime build unless given, in onnxruntime's order of preference
+		self.session = onnxruntime.InferenceSession(model_path, session_options, providers=providers or onnxruntime.get_available_providers())
+
+		self.input_name = self.session.get_inputs()[0].name
+		self.input_shape = self.session.get_inputs()[0].shape
+		self.output_names = [output.name for output in self.session.get_outputs()]
+		self.output_shapes = [output.shape for output in self.session.get_outputs()]
+
+	def run(self, input_tensor):
+		return self.session.run(self.output_names, {self.input_name: input_tensor})
+
+	def bind(self, input_tensor, outputs):
+		# IOBinding on OrtValues sharing memory with the arrays, so inference reads and writes them in place
+		values = [onnxruntime.OrtValue.ortvalue_from_numpy(input_tensor)] + [onnxruntime.OrtValue.ortvalue_from_numpy(output) for output in outputs]
+		binding = self.session.io_binding()
+		binding.bind_ortvalue_input(self.input_name, values[0])
+		for name, value in zip(self.output_names, values[1:]):
+			binding.bind_ortvalue_output(name, value)
+
+		def run():
+			self.session.run_with_iobinding(binding)
+		# The OrtValues must outlive the binding
+		run.values = values
+		return run
+
+class OpenCVBackend(InferenceBackend):
+	# cv2.dnn reading the same ONNX file as onnxruntime
+
+	def __init__(self, model_path):
+
+		self.net = cv2.dnn.readNetFromONNX(model_path)
+		self.net.setPreferableBackend(cv2.dnn.DNN_BACKEND_OPENCV)
+		self.net.setPreferableTarget(cv2.dnn.DNN_TARGET_CPU)
+
+		# Input and output shapes from the model file
+		graph = onnx.load(model_path, load_external_data=False).graph
+		shape = lambda value: [d.dim_value if d.HasField("dim_value") else d.dim_param for d in value.type.tensor_type.shape.dim]
+		initializers = {init.name for init in graph.initializer}
+		self.input_shape = shape(next(i for i in graph.input if i.name not in initializers))
+		self.output_names = [output.name for output in graph.output]
+		self.output_shapes = [shape(output) for output in graph.output]
+
+	def run(self, input_tensor):
+		self.net.setInput(input_tensor)
+		return list(self.net.forward(self.output_names))
+
+class TorchBackend(InferenceBackend):
+	# PyTorch parsingNet loaded from an Ultra-Fast-Lane-Detection checkpoint
+
+	def __init__(self, model_path, cfg, backbone="18", channels_last=True, torchscript=False, num_threads=None):
+
+		# PyTorch is only needed for this backend
+		import torch
+		self.torch = torch
+
+		if num_threads is not None:
+			torch.set_num_threads(num_threads)
+
+		self.channels_last = channels_last
+		self.model = build_parsingnet(backbone, cfg, model_path)
+		if channels_last:
+			self.model = self.model.to(memory_format=torch.channels_last)
+
+		if torchscript:
+			example = self.to_tensor(np.zeros((1, 3, 288, 800), np.float32))
+			with torch.inference_mode():
+				self.model = torch.jit.optimize_for_inference(torch.jit.trace(self.model, example))
+
+		self.input_shape = ["batch", 3, 288, 800]
+		self.output_names = ["output"]
+		self.output_shapes = [["batch", cfg.griding_num + 1, cfg.cls_num_per_lane, 4]]
+
+	def to_tensor(self, input_tensor):
+		x = self.torch.from_numpy(input_tensor)
+		if self.channels_last:
+			x = x.contiguous(memory_format=self.torch.channels_last)
+		return x
+
+	def run(self, input_tensor):
+		with self.torch.inference_mode():
+			return [self.model(self.to_tensor(input_tensor)).numpy()]
+
+def build_parsingnet(backbone, cfg, weights=None):
+	# Build parsingNet without the auxiliary segmentation branch and load an Ultra-Fast-Lane-Detection checkpoint
+
+	import torch
+	from ultrafastLaneDetector.model import parsingNet
+
+	net = parsingNet(pretrained=False, backbone=backbone, cls_dim=(cfg.griding_num + 1, cfg.cls_num_per_lane, 4), use_aux=False)
+
+	if weights is not None:
+		checkpoint = torch.load(weights, map_location="cpu")
+		state_dict = checkpoint.get("model", checkpoint)
+
+		# Remove the DataParallel prefix and the weights of the auxiliary branch
+		state_dict = {k[7:] if k.startswith("module.") else k: v for k, v in state_dict.items()}
+		state_dict = {k: v for k, v in state_dict.items() if not k.startswith("aux_")}
+		net.load_state_dict(state_dict)
+
+	return net.eval()
+
+backends = {
+	"onnxruntime": OnnxRuntimeBackend,
+	"opencv": OpenCVBackend,
+	"torch": TorchBackend,
+}
+
+def create_backend(name, model_path, cfg, **options):
+	# Create an inference backend by name; the torch backend reads a .pth checkpoint, the others an .onnx model
+
+	if name == "torch":
+		return TorchBackend(model_path, cfg, **options)
+	return backends[name](model_path, **options)
@@ -0,0 +1,126 @@
+import hashlib
+import os
+import sqlite3
+import time
+import numpy as np
+
+from ultrafastLaneDetector.ultrafastLaneDetector import LaneDetection
+
+class DetectionCache():
+	# On-disk cache of decoded lane detections keyed by frame content, model and model configuration.
+	# Backed by SQLite in WAL mode so several processes can read and write it at once.
+
+	def __init__(self, path, max_bytes=1 << 30, evict_every=64):
+
+		self.path = path
+		self.max_bytes = max_bytes
+		self.evict_every = evict_every
+		self.puts = 0
+
+		# Connections can't be shared across processes, so one is opened lazily per process
+		self.conn = None
+		self.pid = None
+
+		self.hits = 0
+		self.misses = 0
+
+	def connect(self):
+
+		if self.conn is None or self.pid != os.getpid():
+			self.conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+			self.conn.execute("PRAGMA journal_mode=WAL")
+			self.conn.execute("PRAGMA synchronous=NORMAL")
+			self.conn.execute("""CREATE TABLE IF NOT EXISTS detections (
+				key BLOB PRIMARY KEY,
+				num_lanes INTEGER, num_anchors INTEGER,
+				points BLOB, valid BLOB, detected BLOB,
+				size INTEGER, last_used REAL, confidence BLOB)""")
+			self.conn.execute("CREATE INDEX IF NOT EXISTS detections_last_used ON detections (last_used)")
+			# Caches made before the lane point confidences were stored get the column, their entries keep it NULL
+			columns = [row[1] for row in self.conn.execute("PRAGMA table_info(detections)")]
+			if "confidence" not in columns:
+				try:
+					self.conn.execute("ALTER TABLE detections ADD COLUMN confidence BLOB")
+				except sqlite3.OperationalError:
+					# Added by another process in the meantime
+					pass
+			self.pid = os.getpid()
+		return self.conn
+
+	@staticmethod
+	def model_key(model_path, cfg):
+		# Identity of a model: hash of the model file plus the decoding configuration
+
+		h = hashlib.blake2b(digest_size=16)
+		with open(model_path, "rb") as f:
+			for block in iter(lambda: f.read(1 << 20), b""):
+				h.update(block)
+		h.update(repr((cfg.img_w, cfg.img_h, cfg.griding_num, cfg.cls_num_per_lane, list(cfg.row_anchor))).encode())
+		return h.digest()
+
+	@staticmethod
+	def key(model_key, image):
+		# Cache key of a frame for the given model
+
+		h = hashlib.blake2b(model_key, digest_size=16)
+		h.update(repr((image.shape, image.dtype.str)).encode())
+		h.update(np.ascontiguousarray(image).data)
+		return h.digest()
+
+	def get(self, key):
+
+		conn = self.connect()
+		row = conn.execute("SELECT num_lanes, num_anchors, points, valid, detected, confidence FROM detections WHERE key = ?", (key,)).fetchone()
+		if row is None:
+			self.misses += 1
+			return None
+		self.hits += 1
+
+		# Refresh the LRU timestamp; skipped if another process holds the write lock
+		try:
+			conn.execute("UPDATE detections SET last_used = ? WHERE key = ?", (time.time(), key))
+		except sqlite3.OperationalError:
+			pass
+
+		num_lanes, num_anchors, points, valid, detected, confidence = row
+		if confidence is not None:
+			confidence = np.frombuffer(confidence, dtype=np.float32).reshape(num_lanes, num_anchors).copy()
+		return LaneDetection(np.frombuffer(points, dtype=np.int16).reshape(num_lanes, num_anchors, 2).copy(),
+							np.frombuffer(valid, dtype=np.bool_).reshape(num_lanes, num_anchors).copy(),
+							np.frombuffer(detected, dtype=np.bool_).copy(), confidence)
+
+	def put(self, key, detection):
+
+		conn = self.connect()
+		points = detection.points.astype(np.int16).tobytes()
+		valid = detection.valid.tobytes()
+		detected = detection.detected.tobytes()
+		confidence = detection.confidence.astype(np.float32).tobytes()
+		num_lanes, num_anchors = detection.valid.shape
+		conn.execute("""INSERT OR REPLACE INTO detections (key, num_lanes, num_anchors, points, valid, detected, size, last_used, confidence)
+					VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+					(key, num_lanes, num_anchors, points, valid, detected, len(points) + len(valid) + len(detected) + len(confidence), time.time(), confidence))
+
+		self.puts += 1
+		if self.puts % self.evict_every == 0:
+			self.evict()
+
+	def evict(self):
+		# Drop the least recently used entries until the cache is below 90% of its size limit
+
+		conn = self.connect()
+		total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM detections").fetchone()[0]
+		if total <= self.max_bytes:
+			return
+
+		# Oldest entries first, until the freed size covers the excess
+		excess = total - int(0.9 * self.max_bytes)
+		conn.execute("""DELETE FROM detections WHERE key IN (
+			SELECT key FROM (SELECT key, SUM(size) OVER (ORDER BY last_used, key) - size AS freed FROM detections)
+			WHERE freed < ?)""", (excess,))
+
+	def close(self):
+
+		if self.conn is not None and self.pid == os.getpid():
+			self.conn.close()
+		self.conn = None
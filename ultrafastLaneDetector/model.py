@@ -85,7 +85,8 @@ class parsingNet(torch.nn.Module):
         else:
             aux_seg = None
 
-        fea = self.pool(fea).view(-1, 1800)
+        # reshape rather than view, so channels_last inputs work too
+        fea = self.pool(fea).reshape(-1, 1800)
 
         group_cls = self.cls(fea).view(-1, *self.cls_dim)
 
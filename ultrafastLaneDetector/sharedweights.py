@@ -0,0 +1,118 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import numpy as np
+import onnx
+import onnxruntime
+
+from onnx import external_data_helper
+
+from ultrafastLaneDetector.backends import OnnxRuntimeBackend
+from ultrafastLaneDetector.ultrafastLaneDetector import UltrafastLaneDetector, model_type_from_path
+
+optimization_levels = {
+	"basic": onnxruntime.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+	"extended": onnxruntime.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+	"all": onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL,
+}
+
+class SharedWeights():
+	# Model weights memory-mapped read-only from a node-local file, so every session built from them (in this process,
+	# forked children or other processes on the node) uses the same page cache pages instead of a private copy.
+	# The model is optimized once into a weight-free graph plus a weights file; sessions then run the optimized graph
+	# with the mapped weights added as shared initializers.
+
+	def __init__(self, model_path, cache_dir=None, optimization="all"):
+
+		self.model_path = model_path
+		self.cache_dir = cache_dir or os.path.join(tempfile.gettempdir(), "vts_shared_weights")
+		self.optimization = optimization
+		self.graph_path, self.data_path = self.prepare()
+		self.map()
+
+	def prepare(self):
+		# Write the optimized graph and weights file unless the cache directory already has them for this model
+
+		# Entries are keyed on the model contents, as model variants in different directories often share a file name
+		digest = hashlib.sha256()
+		with open(self.model_path, "rb") as f:
+			for chunk in iter(lambda: f.read(1 << 20), b""):
+				digest.update(chunk)
+		name = f"{os.path.splitext(os.path.basename(self.model_path))[0]}.{digest.hexdigest()[:16]}.{self.optimization}"
+		entry = os.path.join(self.cache_dir, name)
+		graph_path, data_path = os.path.join(entry, "model.onnx"), os.path.join(entry, "model.onnx.data")
+		if os.path.isdir(entry):
+			return graph_path, data_path
+
+		# Both files are written to a temporary directory that is renamed into place in one step, as other processes
+		# on the node may be preparing or reading the same entry
+		os.makedirs(self.cache_dir, exist_ok=True)
+		tmp_dir = tempfile.mkdtemp(prefix=name + ".", suffix=".tmp", dir=self.cache_dir)
+		try:
+			options = onnxruntime.SessionOptions()
+			options.graph_optimization_level = optimization_levels[self.optimization]
+			options.optimized_model_filepath = os.path.join(tmp_dir, "model.onnx")
+			options.add_session_config_entry("session.optimized_model_external_initializers_file_name", "model.onnx.data")
+			options.add_session_config_entry("session.optimized_model_external_initializers_min_size_in_bytes", "1024")
+			onnxruntime.InferenceSession(self.model_path, options, providers=["CPUExecutionProvider"])
+			os.rename(tmp_dir, entry)
+		except OSError:
+			# Another process renamed its entry into place first
+			if not os.path.isdir(entry):
+				raise
+		finally:
+			shutil.rmtree(tmp_dir, ignore_errors=True)
+		return graph_path, data_path
+
+	def map(self):
+		# Map the weights file and wrap every external initializer in an OrtValue viewing the mapping
+
+		model = onnx.load(self.graph_path, load_external_data=False)
+		self.data = np.memmap(self.data_path, np.uint8, mode="r")
+
+		self.initializers = {}
+		for tensor in model.graph.initializer:
+			if not external_data_helper.uses_external_data(tensor):
+				continue
+			info = {entry.key: entry.value for entry in tensor.external_data}
+			offset, length = int(info.get("offset", 0)), int(info["length"])
+			dtype = np.dtype(onnx.helper.tensor_dtype_to_np_dtype(tensor.data_type))
+			array = self.data[offset:offset + length]
+			# Tensors not aligned to their element size can't be viewed in place and get a private copy
+			if offset % dtype.itemsize:
+				array = array.copy()
+			self.initializers[tensor.name] = onnxruntime.OrtValue.ortvalue_from_numpy(array.view(dtype).reshape(tuple(tensor.dims)))
+
+	def __getstate__(self):
+		# Processes receiving the object map the same file again (the OrtValues can't be pickled)
+		return {"model_path": self.model_path, "cache_dir": self.cache_dir, "optimization": self.optimization,
+				"graph_path": self.graph_path, "data_path": self.data_path}
+
+	def __setstate__(self, state):
+		self.__dict__.update(state)
+		self.map()
+
+	def session_options(self, options=None, prepack=False):
+		# Session options running the optimized graph on the shared weights.
+		# CPU kernels prepack some weights (e.g. the large classifier Gemm) into a private layout per session, which is
+		# faster but costs a private copy of those weights; prepacking is off unless asked for.
+
+		options = options or onnxruntime.SessionOptions()
+		options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_DISABLE_ALL
+		for name, value in self.initializers.items():
+			options.add_initializer(name, value)
+		if not prepack:
+			options.add_session_config_entry("session.disable_prepacking", "1")
+		return options
+
+	def backend(self, session_options=None, providers=None, prepack=False):
+		# An onnxruntime backend on the shared weights, which keeps the mapped weights alive
+		backend = OnnxRuntimeBackend(self.graph_path, self.session_options(session_options, prepack), providers)
+		backend.shared_weights = self
+		return backend
+
+	def detector(self, model_type=None, session_options=None, prepack=False, cache=None):
+		# An UltrafastLaneDetector on the shared weights (the model type is guessed from the model path if not given)
+		model_type = model_type if model_type is not None else model_type_from_path(self.model_path)
+		return UltrafastLaneDetector(self.model_path, model_type, cache, backend=self.backend(session_options, prepack=prepack))
@@ -1,13 +1,43 @@
-import onnx
-import onnxruntime
+import os
+import threading
 import scipy.special
 from enum import Enum
 import cv2
 import time
 import numpy as np
 
+from contextlib import nullcontext
+
+from ultrafastLaneDetector.backends import InferenceBackend, create_backend
+
+# the pipeline spans go to the application's tracing module and the lanes are decoded with its Numba kernels when
+# they are enabled; the package also works without them (e.g. outside the repository root), in which case nothing is
+# traced and the lanes are decoded with NumPy
+try:
+	import tracing
+except ImportError:
+	tracing = None
+try:
+	import jitkernels
+except ImportError:
+	jitkernels = None
+
+null_span = nullcontext()
+
+def trace_span(name):
+	# tracing span of a detector stage (does nothing without the tracing module)
+	if tracing is None:
+		return null_span
+	return tracing.span(name)
+
 lane_colors = [(0,0,255),(0,255,0),(255,0,0),(0,255,255)]
 
+# Lanes output by ego-lane models (see egolanemodel.py), placed at these indices of a 4 lane detection
+ego_lanes = [1, 2]
+
+# Outputs of models with in-graph decoding (see graphdecode.py), which decoded models are recognised by
+decoded_outputs = ["lane_x", "lane_valid"]
+
 tusimple_row_anchor = [ 64,  68,  72,  76,  80,  84,  88,  92,  96, 100, 104, 108, 112,
 			116, 120, 124, 128, 132, 136, 140, 144, 148, 152, 156, 160, 164,
 			168, 172, 176, 180, 184, 188, 192, 196, 200, 204, 208, 212, 216,
@@ -19,6 +49,12 @@ class ModelType(Enum):
 	TUSIMPLE = 0
 	CULANE = 1
 
+def model_type_from_path(model_path):
+	# Guess the model type from the file name (e.g. models/culane.onnx), defaulting to TuSimple
+	if "culane" in os.path.basename(model_path).lower():
+		return ModelType.CULANE
+	return ModelType.TUSIMPLE
+
 class ModelConfig():
 
 	def __init__(self, model_type):
@@ -42,45 +78,272 @@ class ModelConfig():
 		self.griding_num = 200
 		self.cls_num_per_lane = 18
 
+class LaneDetection():
+	# Decoded lanes of a single frame, stored in fixed-shape arrays
+	__slots__ = ("points", "valid", "detected", "confidence")
+
+	def __init__(self, points, valid, detected, confidence=None):
+
+		# (lanes, anchors, 2) int16 x, y image coordinates, ordered from the bottom of the image to the top
+		self.points = points
+		# (lanes, anchors) mask of the points that were found
+		self.valid = valid
+		# (lanes,) flag for each lane with enough points to count as detected
+		self.detected = detected
+		# (lanes, anchors) float32 probability the model gives each anchor of having a lane point, used to weight the
+		# lane fits (the valid points count fully where the model gives none, e.g. with in-graph decoding)
+		self.confidence = confidence if confidence is not None else valid.astype(np.float32)
+
+	@classmethod
+	def empty(cls, num_lanes, num_anchors):
+		return cls(np.zeros((num_lanes, num_anchors, 2), dtype=np.int16),
+					np.zeros((num_lanes, num_anchors), dtype=np.bool_),
+					np.zeros(num_lanes, dtype=np.bool_),
+					np.zeros((num_lanes, num_anchors), dtype=np.float32))
+
+	def lane(self, lane_num):
+		# Valid points of a lane as a (points, 2) array
+		return self.points[lane_num][self.valid[lane_num]]
+
+class DetectionBuffers():
+	# Preallocated per-frame arrays of UltrafastLaneDetector for frames of a fixed shape.
+	# detect_lanes reuses them in place, so the steady-state hot path allocates no new arrays.
+
+	def __init__(self, detector, image_shape):
+
+		self.image_shape = tuple(image_shape)
+		self.allocate(detector)
+
+	def allocate(self, detector):
+		# (Re)allocates the arrays for the current model of the detector
+
+		cfg = detector.cfg
+		self.generation = detector.generation
+
+		# prepare_input: colour conversion, resize, normalization and the NCHW input tensor
+		self.rgb = np.empty(self.image_shape, np.uint8)
+		self.resized = np.empty((detector.input_height, detector.input_width, 3), np.uint8)
+		self.scaled = np.empty((detector.input_height, detector.input_width, 3), np.float32)
+		self.input_tensor = np.zeros((1, 3, detector.input_height, detector.input_width), np.float32)
+		self.channels = [self.input_tensor[0, c] for c in range(3)]
+		mean = np.array([0.485, 0.456, 0.406])
+		std = np.array([0.229, 0.224, 0.225])
+		self.scale = tuple(1 / (255.0 * std)) + (0,)
+		self.offset = tuple(mean / std) + (0,)
+
+		# Model outputs, shaped and typed after the warm-up run, bound to the backend so inference writes into them
+		if detector.output_templates is None:
+			detector.warmup()
+		self.outputs = [np.empty_like(output) for output in detector.output_templates]
+		self.run = detector.backend.bind(self.input_tensor, self.outputs)
+
+		# process_output: decoding scratch with the anchors and lanes of the model output flattened into columns,
+		# so reductions over the grid cells are matrix products (NumPy allocates buffers for broadcasting)
+		num_anchors, model_lanes = self.outputs[0].shape[-2:]
+		columns = num_anchors * model_lanes
+		if not detector.decoded:
+			self.logits = self.outputs[0][0].reshape(cfg.griding_num + 1, columns)
+		self.ones = np.ones((cfg.griding_num, 1), np.float32)
+		# Rows summing the probabilities and the probabilities times the cell numbers
+		self.weights = np.vstack((np.ones(cfg.griding_num), np.arange(cfg.griding_num) + 1)).astype(np.float32)
+		self.prob = np.empty((cfg.griding_num, columns), np.float32)
+		self.cell_max = np.empty((1, columns), np.float32)
+		self.sums = np.empty((2, columns), np.float32)
+		self.loc = np.empty(columns, np.float32)
+		self.no_lane = np.empty(columns, np.bool_)
+		self.valid = np.empty(columns, np.bool_)
+		self.confidence = np.empty(columns, np.float32)
+		self.lane_x = np.empty(columns, np.int32)
+		self.count = np.empty(model_lanes, np.intp)
+		col_sample = np.linspace(0, 800 - 1, cfg.griding_num)
+		self.col_sample_w = col_sample[1] - col_sample[0]
+		self.x_scale = np.float32(self.col_sample_w * cfg.img_w / 800)
+
+		# Decoded points as (anchors, lanes), as written by jitkernels.decode_lanes, and as (lanes, anchors)
+		# from the bottom of the image to the top
+		self.valid_anchors = self.valid.reshape(num_anchors, model_lanes)
+		self.lane_x_anchors = self.lane_x.reshape(num_anchors, model_lanes)
+		self.confidence_anchors = self.confidence.reshape(num_anchors, model_lanes)
+		self.valid_lanes = self.valid_anchors[::-1].T
+		self.lane_x_lanes = self.lane_x_anchors[::-1].T
+		self.confidence_lanes = self.confidence_anchors[::-1].T
+		if detector.decoded:
+			self.valid_lanes = self.outputs[1][0].T
+			self.lane_x_lanes = self.outputs[0][0].T
+			self.confidence_lanes = self.valid_lanes
+
+		# Reused detection; the y coordinates are the same for every frame
+		self.detection = LaneDetection.empty(detector.num_lanes, num_anchors)
+		self.detection.points[:, :, 1] = (cfg.img_h * (np.asarray(cfg.row_anchor[::-1]) / 288)).astype(np.int32) - 1
+
+		# Views of the detection written by the model lanes (ego_lanes are contiguous)
+		lanes = slice(ego_lanes[0], ego_lanes[-1] + 1) if detector.ego_lanes_only else slice(None)
+		self.detected = self.detection.detected[lanes]
+		self.detected_valid = self.detection.valid[lanes]
+		self.detected_x = self.detection.points[lanes, :, 0]
+		self.detected_confidence = self.detection.confidence[lanes]
+
+		# draw_lanes: visualization image and lane mask scratch
+		self.visualization = np.empty((cfg.img_h, cfg.img_w, 3), np.uint8)
+		self.lane_segment = np.empty_like(self.visualization)
+
 class UltrafastLaneDetector():
 
-	def __init__(self, model_path, model_type=ModelType.TUSIMPLE):
+	# Attributes describing the loaded model, exchanged by a model swap
+	model_attributes = ("cfg", "backend", "input_shape", "channes", "input_height", "input_width", "output_shape",
+						"decoded", "num_points", "num_anchors", "ego_lanes_only", "num_lanes", "model_key", "output_templates")
+
+	def __init__(self, model_path, model_type=ModelType.TUSIMPLE, cache=None, backend="onnxruntime", backend_options=None):
 
 		self.fps = 0
 		self.timeLastPrediction = time.time()
 		self.frameCounter = 0
 
+		# Model swap state: the number of swaps so far, the warmed-up model waiting to be switched to and the loading thread
+		self.generation = 0
+		self.pending = None
+		self.swap_thread = None
+		self.swap_error = None
+		self.output_templates = None
+
 		# Load model configuration based on the model type
 		self.cfg = ModelConfig(model_type)
 
 		# Initialize model
-		self.initialize_model(model_path)
+		self.initialize_model(model_path, backend, backend_options or {})
+
+		# Optional DetectionCache used to skip inference on frames that were already seen
+		self.cache = cache
+		self.model_key = cache.model_key(model_path, self.cfg) if cache is not None else None
 		
 
-	def initialize_model(self, model_path):
+	def initialize_model(self, model_path, backend="onnxruntime", backend_options=None):
 
-		self.session = onnxruntime.InferenceSession(model_path)
+		# Inference engine: a backend name (see backends.py) or an InferenceBackend instance
+		if isinstance(backend, InferenceBackend):
+			self.backend = backend
+		else:
+			self.backend = create_backend(backend, model_path, self.cfg, **(backend_options or {}))
 
 		# Get model info
 		self.getModel_input_details()
 		self.getModel_output_details()
 
-	def detect_lanes(self, image, draw_points=True):
+	def detect_lanes(self, image, draw_points=True, draw=True, buffers=None):
+		# buffers (see allocate_buffers) are reused in place; the returned image and detection are then overwritten by the next call
+
+		# Switch to a swapped-in model between frames
+		if self.pending is not None:
+			self.apply_swap()
+		if buffers is not None and buffers.generation != self.generation:
+			buffers.allocate(self)
+
+		# Look up the frame in the detection cache
+		self.detection = None
+		if self.cache is not None:
+			cache_key = self.cache.key(self.model_key, image)
+			self.detection = self.cache.get(cache_key)
+
+		if self.detection is None:
+			with trace_span("prepare_input"):
+				input_tensor = self.prepare_input(image, buffers)
+
+			# Perform inference on the image
+			with trace_span("inference"):
+				output = self.inference(input_tensor, buffers)
+
+			# Process output data
+			with trace_span("process_output"):
+				if buffers is None:
+					self.detection = self.process_output(output, self.cfg)
+				else:
+					self.detection = self.process_output_buffers(buffers)
+
+			if self.cache is not None:
+				self.cache.put(cache_key, self.detection)
+
+		# # Draw depth image (skipped when a background renderer does the drawing)
+		if draw:
+			with trace_span("draw_lanes"):
+				if buffers is None:
+					visualization_img = self.draw_lanes(image, self.detection, self.cfg, draw_points)
+				else:
+					visualization_img = self.draw_lanes(image, self.detection, self.cfg, draw_points, buffers.visualization, buffers.lane_segment)
+		else:
+			visualization_img = None
 
-		input_tensor = self.prepare_input(image)
+		return visualization_img, self.detection
 
-		# Perform inference on the image
-		output = self.inference(input_tensor)
+	def detect_lanes_batch(self, images):
+		# Detect the lanes in several frames, batching them into one inference call if the model has a dynamic batch axis
 
-		# Process output data
-		self.lanes_points, self.lanes_detected = self.process_output(output, self.cfg)
+		if self.pending is not None:
+			self.apply_swap()
 
-		# # Draw depth image
-		visualization_img = self.draw_lanes(image, self.lanes_points, self.lanes_detected, self.cfg, draw_points)
+		with trace_span("prepare_input"):
+			input_tensor = np.concatenate([self.prepare_input(image) for image in images])
 
-		return visualization_img, self.lanes_points, self.lanes_detected
+		with trace_span("inference"):
+			if isinstance(self.input_shape[0], int):
+				# Fixed batch size, run the frames one by one
+				outputs = [self.inference(input_tensor[i:i+1]) for i in range(len(images))]
+			else:
+				output = self.inference(input_tensor)
+				outputs = [[o[i:i+1] for o in output] for i in range(len(images))]
+
+		with trace_span("process_output"):
+			return [self.process_output(output, self.cfg) for output in outputs]
+
+	def warmup(self):
+		# Run the model once on a blank input, as the first run of a session is slow, and keep the output shapes and types for DetectionBuffers
+		input_tensor = np.zeros((1, 3, self.input_height, self.input_width), np.float32)
+		self.output_templates = [np.empty_like(output) for output in self.inference(input_tensor)]
+
+	def swap_model(self, model_path, model_type=ModelType.TUSIMPLE, backend="onnxruntime", backend_options=None):
+		# Load and warm up another model on a background thread; detect_lanes switches to it at the start of the next frame once it is ready
+
+		if self.swap_thread is not None and self.swap_thread.is_alive():
+			raise RuntimeError("A model swap is already in progress")
+		self.swap_error = None
+		self.swap_thread = threading.Thread(target=self.load_swap, args=(model_path, model_type, backend, backend_options), name="modelswap", daemon=True)
+		self.swap_thread.start()
+
+	def load_swap(self, model_path, model_type, backend, backend_options):
+		# Main function of the swap thread
+
+		try:
+			model = UltrafastLaneDetector(model_path, model_type, self.cache, backend, backend_options)
+			model.warmup()
+		except Exception as e:
+			self.swap_error = e
+			return
+
+		model.swapped = threading.Event()
+		self.pending = model
+
+		# After the swap the model holds the old session, which is released when this thread drops it
+		# (or when the last DetectionBuffers bound to it are reallocated)
+		model.swapped.wait()
+
+	def apply_swap(self):
+		# Switch to the model loaded by swap_model, handing the old one back to the swap thread
+
+		model, self.pending = self.pending, None
+		for name in self.model_attributes:
+			value = getattr(self, name)
+			setattr(self, name, getattr(model, name))
+			setattr(model, name, value)
+		self.generation += 1
+		model.swapped.set()
+
+	def allocate_buffers(self, image_shape):
+		# Preallocate the per-frame arrays of detect_lanes for frames of image_shape
+		return DetectionBuffers(self, image_shape)
+
+	def prepare_input(self, image, buffers=None):
+		if buffers is not None:
+			return self.prepare_input_buffers(image, buffers)
 
-	def prepare_input(self, image):
 		img = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
 		self.img_height, self.img_width, self.img_channels = img.shape
 
@@ -97,88 +360,202 @@ class UltrafastLaneDetector():
 
 		return img_input.astype(np.float32)
 
-	def inference(self, input_tensor):
-		input_name = self.session.get_inputs()[0].name
-		output_name = self.session.get_outputs()[0].name
+	def prepare_input_buffers(self, image, buffers):
+		# prepare_input writing into the preallocated buffers (normalized in float32)
 
-		output = self.session.run([output_name], {input_name: input_tensor})
+		# OpenCV silently allocates a new array if dst doesn't fit
+		if image.shape != buffers.image_shape:
+			raise ValueError(f"Frame shape {image.shape} does not match the buffers shape {buffers.image_shape}")
+		self.img_height, self.img_width, self.img_channels = image.shape
 
-		return output
+		cv2.cvtColor(image, cv2.COLOR_BGR2RGB, dst=buffers.rgb)
+		cv2.resize(buffers.rgb, (self.input_width,self.input_height), dst=buffers.resized)
 
+		# OpenCV arithmetic and split, as NumPy allocates temporary buffers for casting and transposing
+		cv2.multiply(buffers.resized, buffers.scale, dst=buffers.scaled, dtype=cv2.CV_32F)
+		cv2.subtract(buffers.scaled, buffers.offset, dst=buffers.scaled)
+		cv2.split(buffers.scaled, buffers.channels)
 
-	def getModel_input_details(self):
+		return buffers.input_tensor
 
-		self.input_shape = self.session.get_inputs()[0].shape
-		self.channes = self.input_shape[2]
-		self.input_height = self.input_shape[2]
-		self.input_width = self.input_shape[3]
+	def inference(self, input_tensor, buffers=None):
 
-	def getModel_output_details(self):
+		if buffers is not None:
+			# The backend is bound to the buffers' input tensor and outputs
+			buffers.run()
+			return buffers.outputs
 
-		self.output_shape = self.session.get_outputs()[0].shape
-		self.num_points = self.output_shape[1]
-		self.num_anchors = self.output_shape[2]
-		self.num_lanes = self.output_shape[3]
+		output = self.backend.run(input_tensor)
 
-	@staticmethod
-	def process_output(output, cfg):		
-		# Parse the output of the model
-
-		processed_output = np.squeeze(output[0])
-		# print(processed_output.shape)
-		# print(np.min(processed_output), np.max(processed_output))
-		# print(processed_output.reshape((1,-1)))
-		processed_output = processed_output[:, ::-1, :]
-		prob = scipy.special.softmax(processed_output[:-1, :, :], axis=0)
-		idx = np.arange(cfg.griding_num) + 1
-		idx = idx.reshape(-1, 1, 1)
-		loc = np.sum(prob * idx, axis=0)
-		processed_output = np.argmax(processed_output, axis=0)
-		loc[processed_output == cfg.griding_num] = 0
-		processed_output = loc
+		return output
 
 
-		col_sample = np.linspace(0, 800 - 1, cfg.griding_num)
-		col_sample_w = col_sample[1] - col_sample[0]
+	def getModel_input_details(self):
 
-		lanes_points = []
-		lanes_detected = []
+		self.input_shape = self.backend.input_shape
+		self.channes = self.input_shape[2]
+		self.input_height = self.input_shape[2]
+		self.input_width = self.input_shape[3]
 
-		max_lanes = processed_output.shape[1]
-		for lane_num in range(max_lanes):
-			lane_points = []
-			# Check if there are any points detected in the lane
-			if np.sum(processed_output[:, lane_num] != 0) > 2:
+	def getModel_output_details(self):
 
-				lanes_detected.append(True)
+		# Models with in-graph decoding output lane_x and lane_valid of shape (batch, anchors, lanes); other models are
+		# run for their first output, the griding logits, leaving out any others (e.g. an auxiliary head)
+		names = self.backend.output_names
+		self.decoded = all(name in names for name in decoded_outputs)
+		used = [names.index(name) for name in decoded_outputs] if self.decoded else [0]
+		self.backend.output_names = [names[i] for i in used]
+		self.backend.output_shapes = [self.backend.output_shapes[i] for i in used]
+
+		self.output_shape = self.backend.output_shapes[0]
+		if self.decoded:
+			self.num_points = None
+			self.num_anchors = self.output_shape[1]
+			model_lanes = self.output_shape[2]
+		else:
+			self.num_points = self.output_shape[1]
+			self.num_anchors = self.output_shape[2]
+			model_lanes = self.output_shape[3]
 
-				# Process each of the points for each lane
-				for point_num in range(processed_output.shape[0]):
-					if processed_output[point_num, lane_num] > 0:
-						lane_point = [int(processed_output[point_num, lane_num] * col_sample_w * cfg.img_w / 800) - 1, int(cfg.img_h * (cfg.row_anchor[cfg.cls_num_per_lane-1-point_num]/288)) - 1 ]
-						lane_points.append(lane_point)
-			else:
-				lanes_detected.append(False)
+		# Ego-lane models only output lanes 1 and 2, but their detections still hold all 4 lanes
+		self.ego_lanes_only = model_lanes == len(ego_lanes)
+		self.num_lanes = 4 if self.ego_lanes_only else model_lanes
 
-			lanes_points.append(lane_points)
-		return np.array(lanes_points), np.array(lanes_detected)
+	@staticmethod
+	def process_output(output, cfg, detection=None):		
+		# Parse the output of the model into a LaneDetection (filled in place if one is given)
+
+		if len(output) == 2:
+			# Models with in-graph decoding (see graphdecode.py) already output the x coordinates and valid points
+			# (the detector only runs their decoded outputs, and only the logits of other models)
+			lane_x = np.squeeze(output[0], axis=0).T
+			valid = np.squeeze(output[1], axis=0).T
+			confidence = valid
+		elif jitkernels is not None and jitkernels.enabled:
+			# Fused decoding kernel, in the anchor order of the model
+			processed_output = output[0][0]
+			lane_x = np.empty(processed_output.shape[1:], np.int32)
+			valid = np.empty(processed_output.shape[1:], np.bool_)
+			confidence = np.empty(processed_output.shape[1:], np.float32)
+			col_sample_w = np.linspace(0, 800 - 1, cfg.griding_num)[1]
+			jitkernels.decode_lanes(processed_output, cfg.griding_num, col_sample_w, cfg.img_w, lane_x, valid, confidence)
+			lane_x = lane_x[::-1].T
+			valid = valid[::-1].T
+			confidence = confidence[::-1].T
+		else:
+			processed_output = np.squeeze(output[0])
+			processed_output = processed_output[:, ::-1, :]
+			# Probability of a lane point on each anchor: all but the last, no-lane, cell of the softmax over the cells
+			confidence = scipy.special.softmax(processed_output, axis=0)[:-1].sum(axis=0).T
+			prob = scipy.special.softmax(processed_output[:-1, :, :], axis=0)
+			idx = np.arange(cfg.griding_num) + 1
+			idx = idx.reshape(-1, 1, 1)
+			loc = np.sum(prob * idx, axis=0)
+			processed_output = np.argmax(processed_output, axis=0)
+			loc[processed_output == cfg.griding_num] = 0
+			processed_output = loc.T
+
+
+			col_sample = np.linspace(0, 800 - 1, cfg.griding_num)
+			col_sample_w = col_sample[1] - col_sample[0]
+
+			# Scale the points to the image size
+			valid = processed_output != 0
+			lane_x = (processed_output * col_sample_w * cfg.img_w / 800).astype(np.int32) - 1
+
+		max_lanes, num_anchors = valid.shape
+
+		# Outputs of ego-lane models go to lanes 1 and 2
+		if max_lanes == len(ego_lanes):
+			lane_ids = ego_lanes
+			num_lanes = 4
+		else:
+			lane_ids = slice(None)
+			num_lanes = max_lanes
+		if detection is None:
+			detection = LaneDetection.empty(num_lanes, num_anchors)
+
+		# Check which lanes have more than two points detected
+		detected = np.sum(valid, axis=1) > 2
+		detection.detected[lane_ids] = detected
+		detection.valid[lane_ids] = valid & detected[:, np.newaxis]
+
+		detection.points[lane_ids, :, 0] = lane_x
+		detection.points[:, :, 1] = (cfg.img_h * (np.asarray(cfg.row_anchor[::-1]) / 288)).astype(np.int32) - 1
+		detection.confidence[lane_ids] = confidence
+
+		return detection
+
+	def process_output_buffers(self, buffers):
+		# process_output decoding into the preallocated buffers and their reused detection
+
+		# Models with in-graph decoding write straight into valid_lanes and lane_x_lanes
+		if not self.decoded and jitkernels is not None and jitkernels.enabled:
+			jitkernels.decode_lanes(buffers.outputs[0][0], self.cfg.griding_num, buffers.col_sample_w, self.cfg.img_w,
+									buffers.lane_x_anchors, buffers.valid_anchors, buffers.confidence_anchors)
+		elif not self.decoded:
+			# Expected grid cell from the softmax over the cells (without the last, no-lane, cell)
+			cells = buffers.logits[:-1]
+			np.max(cells, axis=0, out=buffers.cell_max[0])
+			np.dot(buffers.ones, buffers.cell_max, out=buffers.prob)
+			np.subtract(cells, buffers.prob, out=buffers.prob)
+			np.exp(buffers.prob, out=buffers.prob)
+			np.dot(buffers.weights, buffers.prob, out=buffers.sums)
+			np.divide(buffers.sums[1], buffers.sums[0], out=buffers.loc)
+
+			# argmax is the no-lane cell exactly when it beats every other cell (ties go to the first cell)
+			np.greater(buffers.logits[-1], buffers.cell_max[0], out=buffers.no_lane)
+			np.copyto(buffers.loc, 0, where=buffers.no_lane)
+
+			# Probability of a lane point, from the same softmax with the no-lane cell added
+			np.subtract(buffers.logits[-1], buffers.cell_max[0], out=buffers.confidence)
+			np.exp(buffers.confidence, out=buffers.confidence)
+			np.add(buffers.confidence, buffers.sums[0], out=buffers.confidence)
+			np.divide(buffers.sums[0], buffers.confidence, out=buffers.confidence)
+
+			# Scale the points to the image size
+			np.not_equal(buffers.loc, 0, out=buffers.valid)
+			np.multiply(buffers.loc, buffers.x_scale, out=buffers.loc)
+			np.copyto(buffers.lane_x, buffers.loc, casting="unsafe")
+			np.subtract(buffers.lane_x, 1, out=buffers.lane_x)
+
+		# Check which lanes have more than two points detected
+		np.sum(buffers.valid_lanes, axis=1, out=buffers.count)
+		np.greater(buffers.count, 2, out=buffers.detected)
+		np.logical_and(buffers.valid_lanes, buffers.detected[:, np.newaxis], out=buffers.detected_valid)
+		np.copyto(buffers.detected_x, buffers.lane_x_lanes, casting="unsafe")
+		np.copyto(buffers.detected_confidence, buffers.confidence_lanes)
+
+		return buffers.detection
 
 	@staticmethod
-	def draw_lanes(input_img, lanes_points, lanes_detected, cfg, draw_points=True):
-		# Write the detected line points in the image
-		visualization_img = cv2.resize(input_img, (cfg.img_w, cfg.img_h), interpolation = cv2.INTER_AREA)
+	def draw_lanes(input_img, detection, cfg, draw_points=True, out=None, lane_segment=None):
+		# Write the detected line points in the image (drawn into out, using lane_segment as scratch, if given)
+		visualization_img = cv2.resize(input_img, (cfg.img_w, cfg.img_h), dst=out, interpolation = cv2.INTER_AREA)
 
 		# Draw a mask for the current lane
-		if(lanes_detected[1] and lanes_detected[2]):
-			lane_segment_img = visualization_img.copy()
-			
-			cv2.fillPoly(lane_segment_img, pts = [np.vstack((lanes_points[1],np.flipud(lanes_points[2])))], color =(255,191,0))
-			visualization_img = cv2.addWeighted(visualization_img, 0.7, lane_segment_img, 0.3, 0)
+		if(detection.detected[1] and detection.detected[2]):
+			lane_polygon = np.vstack((detection.lane(1),np.flipud(detection.lane(2)))).astype(np.int32)
+
+			# Only blend inside the bounding box of the lane polygon
+			x, y, w, h = cv2.boundingRect(lane_polygon)
+			x0, y0 = max(x, 0), max(y, 0)
+			x1, y1 = min(x + w, cfg.img_w), min(y + h, cfg.img_h)
+			if x1 > x0 and y1 > y0:
+				lane_roi = visualization_img[y0:y1, x0:x1]
+				if lane_segment is None:
+					lane_segment_img = lane_roi.copy()
+				else:
+					lane_segment_img = lane_segment[y0:y1, x0:x1]
+					np.copyto(lane_segment_img, lane_roi)
+
+				cv2.fillPoly(lane_segment_img, pts = [lane_polygon - np.int32([x0, y0])], color =(255,191,0))
+				cv2.addWeighted(lane_roi, 0.7, lane_segment_img, 0.3, 0, dst=lane_roi)
 
 		if(draw_points):
-			for lane_num,lane_points in enumerate(lanes_points):
-				for lane_point in lane_points:
-					cv2.circle(visualization_img, (lane_point[0],lane_point[1]), 3, lane_colors[lane_num], -1)
+			for lane_num in range(detection.points.shape[0]):
+				for lane_point in detection.lane(lane_num):
+					cv2.circle(visualization_img, (int(lane_point[0]),int(lane_point[1])), 3, lane_colors[lane_num], -1)
 
 		return visualization_img
 
@@ -0,0 +1,87 @@
+'''
+  File name: videorecorder.py
+  Author(s):  Jeramy Luo - entire file
+  Purpose: Background encoder process writing the annotated lane detection frames and the control panel to a video file.
+'''
+
+import multiprocessing as mp
+import queue
+import cv2
+import numpy as np
+
+def compose(annotated, panel):
+    # stacks the control panel, scaled to the width of the annotated frame, under the frame
+
+    height = int(panel.shape[0]*annotated.shape[1]/panel.shape[1])
+    return np.vstack((annotated, cv2.resize(panel, (annotated.shape[1], height), interpolation=cv2.INTER_AREA)))
+
+def encode_loop(path, fps, fourcc, frames):
+    # main loop of the encoder process; the video size is taken from the first frame
+
+    writer = None
+    while True:
+        item = frames.get()
+        # None marks the end of the recording
+        if item is None:
+            break
+
+        image = compose(*item)
+        if writer is None:
+            writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*fourcc), fps, (image.shape[1], image.shape[0]))
+            if not writer.isOpened():
+                raise RuntimeError(f"Could not open {path} for writing with the {fourcc} codec")
+        writer.write(image)
+
+    if writer is not None:
+        writer.release()
+
+class videorecorder():
+    def __init__(self, path, fps=15, every=2, fourcc="mp4v", queue_size=8):
+        # keeping every Nth submitted frame; fps is the frame rate written to the file
+        self.every = every
+
+        # recorder statistics
+        self.offered = 0
+        self.sent = 0
+        self.dropped = 0
+
+        # starting the encoder process
+        self.queue = mp.Queue(queue_size)
+        self.process = mp.Process(target=encode_loop, args=(path, fps, fourcc, self.queue), daemon=True)
+        self.process.start()
+
+    def submit(self, annotated, panel):
+        # offers an annotated frame and the control panel; never waits on the encoder and drops the frame if it is behind
+
+        self.offered += 1
+        if (self.offered - 1) % self.every:
+            return False
+
+        # the queue pickles in a background thread, so the (possibly reused) arrays are copied now
+        try:
+            self.queue.put_nowait((annotated.copy(), panel.copy()))
+        except queue.Full:
+            self.dropped += 1
+            return False
+        self.sent += 1
+        return True
+
+    def stats(self):
+        # returns the number of offered, sent and dropped frames
+        return {"offered": self.offered, "sent": self.sent, "dropped": self.dropped}
+
+    def close(self, timeout=10):
+        # lets the encoder write the queued frames and finish the file; an encoder that died or doesn't finish within
+        # timeout seconds is terminated instead of blocking the caller
+        if self.process.is_alive():
+            try:
+                self.queue.put(None, timeout=timeout)
+            except queue.Full:
+                pass
+            self.process.join(timeout)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+        # the queue's feeder thread would otherwise wait to flush frames no one reads any more
+        self.queue.cancel_join_thread()
+        return self.process.exitcode == 0
@@ -9,44 +9,89 @@ import cv2
 
 from shapely.geometry import Polygon
 
+import tracing
+import jitkernels
+
+from lanefit import fit_lanes, eval_fits
+
 class vistaskspec():
-    def __init__(self):
+    def __init__(self, width=1280, fit_degree=1):
         # initializing task list
         self.task_list = ["point2point", "point2line", "cent2point", "cent2line", "parlines", "line2line"]
+        # degree of the least squares fits of the lanes (lines or quadratics) the lane line of the line tasks is taken from
+        self.fit_degree = fit_degree
+
+        # width of the lane point coordinate space, used when no output image is given
+        self.width = width
+
+        # overlays describing the last visual task, drawn here or by a background renderer
+        self.overlays = []
     
-    def get_error(self, lane_points, detected, output_img, mode):
+    def get_error(self, detection, output_img, mode):
         # this function calls the function corresponding to the defined visual specification task
+        # output_img may be None, in which case the overlays are only stored for a background renderer
+
+        self.overlays = []
 
         # checking if adjacent lanes are detected:
-        if detected[1] and detected[2] == 1:
+        if detection.detected[1] and detection.detected[2]:
             # defining the visual task based on the mode
             visual_task = getattr(self, f"{self.task_list[mode]}")
-            # extracting left and right lane
-            left_lane = np.array(lane_points[1]).transpose()
-            right_lane = np.array(lane_points[2]).transpose()
+            # extracting left and right lane as (x, y) rows
+            left_lane = detection.lane(1).transpose()
+            right_lane = detection.lane(2).transpose()
 
             # finding screen width
-            width = output_img.shape[1]
-            # calling function corresponding to task
-            error, output_img = visual_task(left_lane, right_lane, width, output_img)
-            # showing output image
-            cv2.imshow("Lane Detection", output_img[0:620, 320:960])
-            # returning error and output image
-            return error
-        # if lanes aren't detected, shows unmodified output image and returns None for error
+            width = output_img.shape[1] if output_img is not None else self.width
+            # calling function corresponding to task (the line tasks fit the lanes of the whole detection)
+            with tracing.span(self.task_list[mode]):
+                error, self.overlays = visual_task(left_lane, right_lane, width, detection)
+        # if lanes aren't detected, returns None for error and draws no task overlays
         else:
-            cv2.imshow("Lane Detection", output_img[0:620, 320:960])
-            return None
+            error = None
+
+        if output_img is not None:
+            # drawing the task onto the output image and showing it
+            self.draw_overlays(output_img, self.overlays)
+            cv2.imshow("Lane Detection", self.crop(output_img))
+
+        return error
+
+    @staticmethod
+    def crop(output_img):
+        # crops the output image to the captured screen region (without the border added in process_input)
+        # the crop is 0:620, 320:960 for the 1280x720 TuSimple output and scales with the model resolution
+        height, width = output_img.shape[:2]
+        return output_img[0:int(height*620/720), int(width/4):int(width*3/4)]
+
+    @staticmethod
+    def draw_overlays(output_img, overlays):
+        # draws the overlays returned by a visual task onto the output image
+
+        for overlay in overlays:
+            if overlay[0] == "circle":
+                cv2.circle(output_img, overlay[1], 5, overlay[2], 3)
+            elif overlay[0] == "line":
+                cv2.line(output_img, overlay[1], overlay[2], overlay[3], 4)
+            elif overlay[0] == "arrow":
+                cv2.arrowedLine(output_img, overlay[1], overlay[2], overlay[3], 4)
+        return output_img
     
     def get_centroid(self, left_lane, right_lane):
         # this function finds the centroid of lane polygon
 
+        if jitkernels.enabled:
+            return jitkernels.polygon_centroid(left_lane[0], left_lane[1], right_lane[0], right_lane[1])
+
         points = np.vstack((left_lane.transpose(),np.flipud(right_lane.transpose())))
         p1 = Polygon(points)
-        return np.array(p1.centroid)
+        return np.array(p1.centroid.coords[0])
 
-    def point2point(self, left_lane, right_lane, width, output_img):
-        # finds the point to point visual task specification
+    def lane_midpoint(self, left_lane, right_lane):
+        # this function finds the midpoint of the lane at the height of the middle points of both lanes
+
+        if jitkernels.enabled:
+            return jitkernels.lane_midpoint(left_lane[0], left_lane[1], right_lane[0], right_lane[1])
 
         # finding y value of the midpoint of the lane
         middle_y = int((left_lane[1][int(left_lane.shape[1]/2)] + right_lane[1][int(right_lane.shape[1]/2)])/2)
@@ -58,57 +103,80 @@ class vistaskspec():
         # finding the x value of the midpoint of the lane
         middle_x = int((left_lane[0][left_idx] + right_lane[0][right_idx])/2)
 
+        return middle_x, middle_y
+
+    def point_line_error(self, point, width):
+        # this function finds the error between a point and the vehicle path line (taken as the middle of the screen)
+
+        if jitkernels.enabled:
+            return jitkernels.point_line_error(float(point[0]), float(point[1]), float(width))
+
+        # creating homogenous coordinates for the line of the vehicle path
+        line_mid = np.cross((width/2, 500, 1), (width/2, 0, 1))
+
+        return (np.dot(point, line_mid))/1000
+
+    def lane_line(self, left_lane, right_lane, detection):
+        # this function finds the start and end of the lane centre line, at the bottom and top of the left lane,
+        # from least squares fits of both lanes over all their valid points, weighted by the model's confidence in them
+
+        fits, _ = fit_lanes(detection.points[1:3], detection.valid[1:3], self.fit_degree, detection.confidence[1:3])
+
+        y = np.array([left_lane[1][0], left_lane[1][-1]], np.float64)
+        x = eval_fits(fits, y).mean(axis=0)
+        return (int(x[0]), int(y[0]), 1), (int(x[1]), int(y[1]), 1)
+
+    def point2point(self, left_lane, right_lane, width, detection):
+        # finds the point to point visual task specification
+
+        # finding the midpoint of the lane
+        middle_x, middle_y = self.lane_midpoint(left_lane, right_lane)
+
         # creating homogenous coordinates for the middle of the lane
         mid_pt_lane = (middle_x, middle_y, 1)
 
         # finding the error term
         e_p2p = mid_pt_lane[0] - width/2
 
-        # drawing midpoint of lane onto output image
-        cv2.circle(output_img, (middle_x, middle_y), 5, (0, 0, 255), 3)
+        overlays = [
+            # drawing midpoint of lane onto output image
+            ("circle", (middle_x, middle_y), (0, 0, 255)),
 
-        # drawing midpoint of vehicle path (taken as the middle of the screen)
-        cv2.circle(output_img, (int(width/2), middle_y), 5, (0, 255, 0), 3)
+            # drawing midpoint of vehicle path (taken as the middle of the screen)
+            ("circle", (int(width/2), middle_y), (0, 255, 0)),
 
-        # drawing an arrow showing the error between the two points
-        cv2.arrowedLine(output_img, (int(width/2), middle_y), (middle_x, middle_y), (255, 0, 0), 4)
-        
-        return e_p2p, output_img
+            # drawing an arrow showing the error between the two points
+            ("arrow", (int(width/2), middle_y), (middle_x, middle_y), (255, 0, 0)),
+        ]
+
+        return e_p2p, overlays
     
-    def point2line(self, left_lane, right_lane, width, output_img):
+    def point2line(self, left_lane, right_lane, width, detection):
         # finds the point to line visual task specification
 
-        # finding y value of the midpoint of the lane
-        middle_y = int((left_lane[1][int(left_lane.shape[1]/2)] + right_lane[1][int(right_lane.shape[1]/2)])/2)
-
-        # finding the corresponding indicies to the points in each lane closest to the middle_y value
-        left_idx = (np.abs(left_lane[1] - middle_y)).argmin()
-        right_idx = (np.abs(right_lane[1] - middle_y)).argmin()
-
-        # finding the x value of the midpoint of the lane
-        middle_x = int((left_lane[0][left_idx] + right_lane[0][right_idx])/2)
+        # finding the midpoint of the lane
+        middle_x, middle_y = self.lane_midpoint(left_lane, right_lane)
 
         # creating homogenous coordinates for the middle of the lane
         mid_pt_lane = (middle_x, middle_y, 1)
 
-        # creating homogenous coordinates for the line of the vehicle path
-        line_mid = np.cross((width/2, 500, 1), (width/2, 0, 1))
-
         # finding the error term
-        e_p2l = (np.dot(mid_pt_lane, line_mid))/1000
+        e_p2l = self.point_line_error(mid_pt_lane, width)
 
-        # drawing midpoint of lane onto output image
-        cv2.circle(output_img, (middle_x, middle_y), 5, (0, 0, 255), 3)
+        overlays = [
+            # drawing midpoint of lane onto output image
+            ("circle", (middle_x, middle_y), (0, 0, 255)),
 
-        # drawing line of vehicle path (taken as the middle of the screen)
-        cv2.line(output_img, (int(width/2), 550), (int(width/2), 400), (0, 255, 0), 4)
+            # drawing line of vehicle path (taken as the middle of the screen)
+            ("line", (int(width/2), 550), (int(width/2), 400), (0, 255, 0)),
 
-        # drawing an arrow showing the error between the vehicle path line and the midpoint of the lane
-        cv2.arrowedLine(output_img, (int(width/2), middle_y), (middle_x, middle_y), (255, 0, 0), 4)
+            # drawing an arrow showing the error between the vehicle path line and the midpoint of the lane
+            ("arrow", (int(width/2), middle_y), (middle_x, middle_y), (255, 0, 0)),
+        ]
 
-        return e_p2l, output_img
+        return e_p2l, overlays
     
-    def cent2point(self, left_lane, right_lane, width, output_img):
+    def cent2point(self, left_lane, right_lane, width, detection):
         # finds the point to point visual task specification but uses the centroid rather than the midpoint of the lane
 
         # finding the centroid of the lane polygon
@@ -117,18 +185,20 @@ class vistaskspec():
         # finding the error term
         e_p2p = cent[0] - width/2
 
-        # drawing centroid of lane onto output image
-        cv2.circle(output_img, (int(cent[0]), int(cent[1])), 5, (0, 0, 255), 3)
+        overlays = [
+            # drawing centroid of lane onto output image
+            ("circle", (int(cent[0]), int(cent[1])), (0, 0, 255)),
 
-        # drawing midpoint of vehicle path (taken as the middle of the screen)
-        cv2.circle(output_img, (int(width/2), int(cent[1])), 5, (0, 255, 0), 3)
+            # drawing midpoint of vehicle path (taken as the middle of the screen)
+            ("circle", (int(width/2), int(cent[1])), (0, 255, 0)),
 
-        # drawing an arrow showing the error between the two points
-        cv2.arrowedLine(output_img, (int(width/2), int(cent[1])), (int(cent[0]), int(cent[1])), (255, 0, 0), 4)
+            # drawing an arrow showing the error between the two points
+            ("arrow", (int(width/2), int(cent[1])), (int(cent[0]), int(cent[1])), (255, 0, 0)),
+        ]
 
-        return e_p2p, output_img
+        return e_p2p, overlays
         
-    def cent2line(self, left_lane, right_lane, width, output_img):
+    def cent2line(self, left_lane, right_lane, width, detection):
         # finds the point to line visual task specification but uses the centroid rather than the midpoint of the lane
 
         # finding the centroid of the lane polygon
@@ -137,67 +207,74 @@ class vistaskspec():
         # converting to homogenous coordinates
         cent_h = (cent[0], cent[1], 1)
 
-        # finding the vehicle path line
-        line_mid = np.cross((width/2, 500, 1), (width/2, 0, 1))
-
         # finding the error term
-        e_p2l = (np.dot(cent_h, line_mid))/1000
+        e_p2l = self.point_line_error(cent_h, width)
 
-        # drawing centroid of lane onto output image
-        cv2.circle(output_img, (int(cent[0]), int(cent[1])), 5, (0, 0, 255), 3)
+        overlays = [
+            # drawing centroid of lane onto output image
+            ("circle", (int(cent[0]), int(cent[1])), (0, 0, 255)),
 
-        # drawing midpoint of vehicle path (taken as the middle of the screen)
-        cv2.line(output_img, (int(width/2), 550), (int(width/2), 400), (0, 255, 0), 4)
+            # drawing midpoint of vehicle path (taken as the middle of the screen)
+            ("line", (int(width/2), 550), (int(width/2), 400), (0, 255, 0)),
 
-        # drawing an arrow showing the error between the vehicle path line and the centroid of the lane
-        cv2.arrowedLine(output_img, (int(width/2), int(cent[1])), (int(cent[0]), int(cent[1])), (255, 0, 0), 4)
+            # drawing an arrow showing the error between the vehicle path line and the centroid of the lane
+            ("arrow", (int(width/2), int(cent[1])), (int(cent[0]), int(cent[1])), (255, 0, 0)),
+        ]
 
-        return e_p2l, output_img
+        return e_p2l, overlays
 
-    def parlines(self, left_lane, right_lane, width, output_img):
+    def parlines(self, left_lane, right_lane, width, detection):
         # finds the parallel lines task specification
 
         # finding the start and end of the lane
-        lane_end = (int((left_lane[0][-1] + right_lane[0][-1])/2), left_lane[1][-1], 1)
-        lane_start = (int((left_lane[0][0] + right_lane[0][0])/2), left_lane[1][0], 1)
+        lane_start, lane_end = self.lane_line(left_lane, right_lane, detection)
 
         # finding the start and end of the midline
         midline_end = (width/2, left_lane[1][-1], 1)
         midline_start = (width/2, left_lane[1][0], 1)
 
-        # finding the midline and lane in homogeneous coordinates
-        midline = np.cross(midline_end, midline_start)
-        lane = np.cross(lane_end, lane_start)
+        if jitkernels.enabled:
+            e_pl = jitkernels.lines_error(*map(float, lane_start[:2] + lane_end[:2] + midline_start[:2] + midline_end[:2]))
+        else:
+            # finding the midline and lane in homogeneous coordinates
+            midline = np.cross(midline_end, midline_start)
+            lane = np.cross(lane_end, lane_start)
 
-        # finding the error term
-        e_pl_v = np.cross(midline, lane)
-        e_pl = (np.sign(e_pl_v[1])*np.linalg.norm(e_pl_v))/1000000
+            # finding the error term
+            e_pl_v = np.cross(midline, lane)
+            e_pl = (np.sign(e_pl_v[1])*np.linalg.norm(e_pl_v))/1000000
 
-        # drawing the two lines
-        cv2.arrowedLine(output_img, (int(lane_start[0]), int(lane_start[1])), (int(lane_end[0]), int(lane_end[1])), (0, 0, 255), 4)
-        cv2.arrowedLine(output_img, (int(midline_start[0]), int(midline_start[1])), (int(midline_end[0]), int(midline_end[1])), (0, 255, 0), 4)
+        overlays = [
+            # drawing the two lines
+            ("arrow", (int(lane_start[0]), int(lane_start[1])), (int(lane_end[0]), int(lane_end[1])), (0, 0, 255)),
+            ("arrow", (int(midline_start[0]), int(midline_start[1])), (int(midline_end[0]), int(midline_end[1])), (0, 255, 0)),
+        ]
 
-        return e_pl, output_img
+        return e_pl, overlays
     
-    def line2line(self, left_lane, right_lane, width, output_img):
+    def line2line(self, left_lane, right_lane, width, detection):
         # finds the parallel lines task specification
 
         # finding the start and end of the lane
-        lane_end = ((int((left_lane[0][-1] + right_lane[0][-1])/2)), left_lane[1][-1], 1)
-        lane_start = ((int((left_lane[0][1] + right_lane[0][1])/2)), left_lane[1][0], 1)
+        lane_start, lane_end = self.lane_line(left_lane, right_lane, detection)
 
         # finding the start and end of the midline
         middle_end = (width/2, left_lane[1][-1], 1)
         middle_start = (width/2, left_lane[1][0], 1)
 
-        # finding the lane in homogeneous coordinates
-        lane = np.cross(lane_end, lane_start)
+        if jitkernels.enabled:
+            e_l2l = jitkernels.line_distance_error(*map(float, lane_start[:2] + lane_end[:2] + middle_start[:2] + middle_end[:2]))
+        else:
+            # finding the lane in homogeneous coordinates
+            lane = np.cross(lane_end, lane_start)
 
-        # finding the error term
-        e_l2l = (np.dot(middle_end, lane) + np.dot(middle_start, lane))/1000
+            # finding the error term
+            e_l2l = (np.dot(middle_end, lane) + np.dot(middle_start, lane))/1000
 
-        # drawing the two lines
-        cv2.arrowedLine(output_img, (int(lane_start[0]), int(lane_start[1])), (int(lane_end[0]), int(lane_end[1])), (0, 0, 255), 4)
-        cv2.arrowedLine(output_img, (int(middle_start[0]), int(middle_start[1])), (int(middle_end[0]), int(middle_end[1])), (0, 255, 0), 4)
+        overlays = [
+            # drawing the two lines
+            ("arrow", (int(lane_start[0]), int(lane_start[1])), (int(lane_end[0]), int(lane_end[1])), (0, 0, 255)),
+            ("arrow", (int(middle_start[0]), int(middle_start[1])), (int(middle_end[0]), int(middle_end[1])), (0, 255, 0)),
+        ]
 
-        return e_l2l, output_img
+        return e_l2l, overlays